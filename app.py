@@ -1,22 +1,40 @@
-from fastapi import FastAPI, Request, UploadFile, File, BackgroundTasks
+from fastapi import FastAPI, Request, UploadFile, File, Header
 from fastapi.templating import Jinja2Templates
-from fastapi.responses import HTMLResponse, FileResponse, JSONResponse
+from fastapi.responses import HTMLResponse, FileResponse, JSONResponse, StreamingResponse, PlainTextResponse
 from fastapi.staticfiles import StaticFiles
 import uvicorn
 import shutil
 import os
+import glob
+import threading
 import zipfile
 import uuid
 import asyncio
 from concurrent.futures import ThreadPoolExecutor
-from automation import process_data_and_generate_reports
+from pydantic import BaseModel
+from typing import Optional
+from automation import (process_data_and_generate_reports, read_sheet_header, detect_sheet_format,
+                        dedup_column_names, SHEET_CONFIG, IMAGE_CACHE, PREPARED_IMAGE_CACHE, FETCH_ENGINE,
+                        IMAGE_HEALTH, discard_render_pool)
+from zip_stream import stream_zip, choose_compress_type
+from jobs import TaskStore, JobScheduler, FINISHED_STATUSES
+from progress_stream import ProgressBroker, format_sse, DONE_EVENT
+from metrics import REGISTRY, StageTimer, TASKS, ZIP_BYTES, ZIP_STREAM_SECONDS
+from upload_sessions import UploadManager, UploadError, DEFAULT_CHUNK_SIZE
 import logging
 import sys
 import socket
+import time
+import multiprocessing
+
+# A PDF render worker started with "spawn" (PDF_RENDER_MODE = "process" on
+# Windows/macOS) re-imports this script as __mp_main__. It only needs the
+# definitions: not the log file, the task database or a fresh log.
+RENDER_WORKER = __name__ == "__mp_main__"
 
 # Ensure log file is deleted on startup for a fresh start
 LOG_FILE = "server_app.log"
-if os.path.exists(LOG_FILE):
+if not RENDER_WORKER and multiprocessing.parent_process() is None and os.path.exists(LOG_FILE):
     try:
         os.remove(LOG_FILE)
     except:
@@ -26,7 +44,7 @@ if os.path.exists(LOG_FILE):
 logging.basicConfig(
     level=logging.INFO,
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    handlers=[
+    handlers=[logging.StreamHandler(sys.stdout)] if RENDER_WORKER else [
         logging.FileHandler(LOG_FILE),
         logging.StreamHandler(sys.stdout)
     ]
@@ -59,64 +77,258 @@ for d in [UPLOAD_FOLDER, OUTPUT_DIR, ZIPS_DIR]:
 
 ALLOWED_EXTENSIONS = {'xlsx', 'csv'}
 
-# Global store for task progress
-# Format: {task_id: {"status": "processing", "message": "...", "percent": 0, "result": None}}
-task_progress = {}
+# "stream": the ZIP is built on the fly from the task's PDFs at /stream/{task_id}
+#           (no copy in zips/, download can start while partners are still rendering)
+# "file":   the ZIP is written to zips/ as reports finish and served from /download
+ZIP_MODE = "stream"
+
+# Job queue: at most MAX_CONCURRENT_JOBS uploads are processed at once, the rest
+# wait in FIFO order. Task state lives in TASKS_DB (SQLite) and finished tasks
+# are removed, together with their files, TASK_TTL_SECONDS after finishing.
+MAX_CONCURRENT_JOBS = 2
+TASKS_DB = "tasks.db"
+TASK_TTL_SECONDS = 24 * 60 * 60
+CLEANUP_INTERVAL_SECONDS = 10 * 60
+
+# Stage/render/download metrics, exposed in Prometheus format at /metrics.
+# When off, instrumented code skips all bookkeeping (per-task timings in /status remain).
+METRICS_ENABLED = True
+REGISTRY.enabled = METRICS_ENABLED
+
+# Chunked uploads (/uploads): chunks are written straight to uploads/partial/ and
+# an interrupted upload resumes by sending only the missing chunks. Sessions that
+# are never completed are removed after UPLOAD_SESSION_TTL_SECONDS.
+UPLOAD_PARTIAL_DIR = os.path.join(UPLOAD_FOLDER, "partial")
+UPLOAD_CHUNK_SIZE = DEFAULT_CHUNK_SIZE
+UPLOAD_SESSION_TTL_SECONDS = 24 * 60 * 60
+
+# Durable store for task progress
+# Format: {"status": "processing", "message": "...", "percent": 0, ...} per task_id
+task_store = None if RENDER_WORKER else TaskStore(TASKS_DB)
+scheduler = JobScheduler(max_concurrent=MAX_CONCURRENT_JOBS, on_dequeue=lambda waiting: publish_queue_positions(waiting))
+
+# Pushes progress to clients connected to /events/{task_id}
+progress_broker = ProgressBroker()
+
+REGISTRY.gauge_callback("biochar_jobs_queued", "Uploaded tasks waiting for a worker.", scheduler.queued_count)
+REGISTRY.gauge_callback("biochar_jobs_running", "Tasks being processed.", scheduler.running_count)
+REGISTRY.gauge_callback(
+    "biochar_image_cache_hit_ratio", "Share of image cache lookups served from the cache.",
+    lambda: {"downloaded": IMAGE_CACHE.stats()["hit_rate"], "prepared": PREPARED_IMAGE_CACHE.stats()["hit_rate"]},
+    labels=("cache",))
+REGISTRY.gauge_callback(
+    "biochar_image_cache_bytes", "Bytes held by the image caches on disk.",
+    lambda: {"downloaded": IMAGE_CACHE.stats()["disk_bytes"], "prepared": PREPARED_IMAGE_CACHE.stats()["disk_bytes"]},
+    labels=("cache",))
+REGISTRY.gauge_callback(
+    "biochar_image_hosts_unavailable", "Image hosts currently skipped by the circuit breaker.",
+    lambda: len(IMAGE_HEALTH.stats()["open_hosts"]))
+
+# Finished report paths per task, for streaming downloads
+# Format: {task_id: {"files": [...], "done": False}}
+task_reports = {}
 
 def allowed_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
-def zip_results(task_id, file_paths):
-    zip_filename = f"reports_{task_id}.zip"
-    zip_path = os.path.join(ZIPS_DIR, zip_filename)
-    
-    with zipfile.ZipFile(zip_path, 'w') as zipf:
-        for file in file_paths:
-            if os.path.exists(file):
-                 zipf.write(file, os.path.basename(file))
-    return zip_path
+def check_sheet_header(header):
+    """(True, format name) if the header row matches a known sheet format, else (False, message)."""
+    if not header or not any(str(col).strip() for col in header if col is not None):
+        return False, "The file has no header row."
+    sheet_format = detect_sheet_format(dedup_column_names(list(header)))
+    if sheet_format is None:
+        return False, (f"The header row does not match a known sheet format "
+                       f"(expected columns such as '{SHEET_CONFIG['meta_map']['partner']}').")
+    return True, sheet_format
+
+upload_manager = UploadManager(UPLOAD_PARTIAL_DIR, check_sheet_header, read_header=read_sheet_header,
+                               chunk_size=UPLOAD_CHUNK_SIZE, allowed_extensions=ALLOWED_EXTENSIONS)
+
+def queue_task(task_id, file_path, filename):
+    task_store.create(task_id, file_path, {"status": "queued", "message": "Queued..."})
+    logger.info(f"New upload received: {filename}, assigned task_id: {task_id}")
+    scheduler.submit(task_id, run_automation_task, task_id, file_path)
+
+def set_task_state(task_id, data):
+    """Saves the task's state and pushes it to any listening /events clients."""
+    task_store.set(task_id, data)
+    event = DONE_EVENT if data.get("status") in FINISHED_STATUSES else "progress"
+    progress_broker.publish(task_id, event, data)
+
+def queued_state(position):
+    return {"status": "queued", "message": f"Queued (position {position})...", "queue_position": position}
+
+def publish_queue_positions(waiting_ids):
+    """Tells every waiting task its new place in the queue (called as a job starts)."""
+    for position, task_id in enumerate(waiting_ids, start=1):
+        progress_broker.publish(task_id, "progress", queued_state(position))
+
+def get_task_state(task_id):
+    """The task's stored state, with its current queue position while it waits."""
+    data = task_store.get(task_id)
+    if data is not None and data.get("status") == "queued":
+        position = scheduler.queue_position(task_id)
+        if position:
+            data.update(queued_state(position))
+    return data
+
+def is_task_id(task_id):
+    """True for ids of the form this server issues (canonical UUIDs), which are safe in paths."""
+    try:
+        return str(uuid.UUID(task_id)) == task_id
+    except (ValueError, TypeError):
+        return False
+
+def task_output_dir(task_id):
+    if not is_task_id(task_id):
+        raise ValueError(f"Invalid task id: {task_id!r}")
+    return os.path.join(OUTPUT_DIR, task_id)
+
+def iter_task_reports(task_id, poll_interval=0.25):
+    """Yields the task's report paths as they finish, until the task is done."""
+    sent = 0
+    while True:
+        reports = task_reports.get(task_id)
+        if reports is None:
+            # Finished before a restart: serve whatever is on disk
+            if sent == 0 and os.path.isdir(task_output_dir(task_id)):
+                yield from sorted(glob.glob(os.path.join(task_output_dir(task_id), "*.pdf")))
+            return
+        files = reports["files"]
+        while sent < len(files):
+            yield files[sent]
+            sent += 1
+        if reports["done"] and sent >= len(reports["files"]):
+            return
+        time.sleep(poll_interval)
 
 def run_automation_task(task_id, file_path):
+    timings = StageTimer()
+
     def update_progress(msg, percent=0, eta=None):
-        data = {"status": "processing", "message": msg, "percent": percent}
+        data = {"status": "processing", "message": msg, "percent": percent, "timings": timings.snapshot()}
         if eta:
             data["eta"] = eta
-        task_progress[task_id] = data
+        if ZIP_MODE == "stream" and task_reports[task_id]["files"]:
+            data["stream_url"] = f"/stream/{task_id}"
+        set_task_state(task_id, data)
     
+    # Each task renders into its own folder so concurrent tasks never share PDFs
+    output_dir = task_output_dir(task_id)
+    zip_path = os.path.join(ZIPS_DIR, f"reports_{task_id}.zip")
+    task_reports[task_id] = {"files": [], "done": False}
+    zipf = zipfile.ZipFile(zip_path, 'w') if ZIP_MODE == "file" else None
+    zipped = set()
+
+    def on_report(report_path):
+        task_reports[task_id]["files"].append(report_path)
+        # In file mode ZIP entries are added as each partner's PDF finishes
+        arcname = os.path.basename(report_path)
+        if zipf is not None and arcname not in zipped and os.path.exists(report_path):
+            with timings.stage("zip"):
+                zipf.write(report_path, arcname, compress_type=choose_compress_type(report_path))
+            zipped.add(arcname)
+
     try:
-        task_progress[task_id] = {"status": "processing", "message": "Starting...", "percent": 0}
+        set_task_state(task_id, {"status": "processing", "message": "Starting...", "percent": 0})
         
         logger.info(f"Task {task_id}: Starting automation processing for {file_path}")
-        success, message, file_paths = process_data_and_generate_reports(file_path, progress_callback=update_progress)
+        success, message, file_paths = process_data_and_generate_reports(
+            file_path, progress_callback=update_progress, report_callback=on_report, output_dir=output_dir,
+            event_callback=lambda event, data: progress_broker.publish(task_id, event, data), timings=timings)
+        if zipf is not None:
+            zipf.close()
+            if os.path.exists(zip_path):
+                ZIP_BYTES.inc(os.path.getsize(zip_path))
         
         if success and file_paths:
-            logger.info(f"Task {task_id}: Processing successful. Zipping {len(file_paths)} files.")
-            zip_path = zip_results(task_id, file_paths)
-            task_progress[task_id] = {
+            if zipf is not None:
+                logger.info(f"Task {task_id}: {message} Zipped {len(zipped)} files.")
+                download_url = f"/download/{os.path.basename(zip_path)}"
+            else:
+                logger.info(f"Task {task_id}: {message} {len(file_paths)} files ready to stream.")
+                download_url = f"/stream/{task_id}"
+            logger.info(f"Task {task_id}: timings {timings.snapshot()}")
+            TASKS.inc(status="complete")
+            set_task_state(task_id, {
                 "status": "complete", 
                 "message": "Done!", 
-                "download_url": f"/download/{os.path.basename(zip_path)}"
-            }
+                "summary": message,
+                "download_url": download_url,
+                "timings": timings.snapshot()
+            })
         else:
              logger.warning(f"Task {task_id}: Processing failed or no rejections found. Message: {message}")
-             task_progress[task_id] = {"status": "error", "message": message}
+             TASKS.inc(status="error")
+             set_task_state(task_id, {"status": "error", "message": message, "timings": timings.snapshot()})
              
     except Exception as e:
         logger.exception(f"Task {task_id}: Unhandled exception during processing")
-        task_progress[task_id] = {"status": "error", "message": str(e)}
+        TASKS.inc(status="error")
+        set_task_state(task_id, {"status": "error", "message": str(e), "timings": timings.snapshot()})
     finally:
+        task_reports[task_id]["done"] = True
+        if zipf is not None:
+            zipf.close()
+            if not zipped and os.path.exists(zip_path):
+                os.remove(zip_path)
         # Cleanup upload
         if os.path.exists(file_path):
             os.remove(file_path)
 
+def cleanup_expired_tasks():
+    """Deletes finished tasks older than TASK_TTL_SECONDS and all of their files."""
+    for task_id in task_store.expired(TASK_TTL_SECONDS):
+        for path in glob.glob(os.path.join(UPLOAD_FOLDER, f"{task_id}_*")):
+            os.remove(path)
+        shutil.rmtree(task_output_dir(task_id), ignore_errors=True)
+        zip_path = os.path.join(ZIPS_DIR, f"reports_{task_id}.zip")
+        if os.path.exists(zip_path):
+            os.remove(zip_path)
+        task_reports.pop(task_id, None)
+        task_store.delete(task_id)
+        logger.info(f"Task {task_id}: expired, files removed")
+    for upload_id in upload_manager.expire(UPLOAD_SESSION_TTL_SECONDS):
+        logger.info(f"Upload {upload_id}: expired, partial file removed")
+
+def cleanup_loop():
+    while True:
+        try:
+            cleanup_expired_tasks()
+        except Exception:
+            logger.exception("Task cleanup failed")
+        time.sleep(CLEANUP_INTERVAL_SECONDS)
+
+@app.on_event("startup")
+async def start_fetch_engine():
+    # Image downloads share the server's event loop and one keep-alive client
+    FETCH_ENGINE.start(asyncio.get_running_loop())
+
+@app.on_event("shutdown")
+async def stop_fetch_engine():
+    await FETCH_ENGINE.aclose()
+    await asyncio.to_thread(discard_render_pool)
+
+@app.on_event("startup")
+def start_job_queue():
+    scheduler.start()
+    # Re-queue tasks interrupted by a restart if their upload is still there
+    for task_id, status, file_path in task_store.unfinished():
+        if file_path and os.path.exists(file_path):
+            logger.info(f"Task {task_id}: re-queued after restart (was {status})")
+            set_task_state(task_id, {"status": "queued", "message": "Queued..."})
+            scheduler.submit(task_id, run_automation_task, task_id, file_path)
+        else:
+            set_task_state(task_id, {"status": "error", "message": "Task was interrupted by a server restart. Please upload the file again."})
+    threading.Thread(target=cleanup_loop, name="task-cleanup", daemon=True).start()
+
 @app.get("/", response_class=HTMLResponse)
 async def read_root(request: Request):
     return templates.TemplateResponse("index.html", {"request": request})
 
 @app.post("/upload")
 async def process_file(
-    file: UploadFile = File(...),
-    background_tasks: BackgroundTasks = None
+    file: UploadFile = File(...)
 ):
     if not file.filename:
         return JSONResponse(status_code=400, content={"message": "No file selected"})
@@ -129,17 +341,136 @@ async def process_file(
     
     with open(file_path, "wb") as buffer:
         shutil.copyfileobj(file.file, buffer)
-        
-    task_progress[task_id] = {"status": "queued", "message": "Queued..."}
-    
-    logger.info(f"New upload received: {file.filename}, assigned task_id: {task_id}")
-    background_tasks.add_task(run_automation_task, task_id, file_path)
-    
+
+    # Refuse files with the wrong columns now rather than after queueing
+    try:
+        ok, result = check_sheet_header(await asyncio.to_thread(read_sheet_header, file_path))
+    except Exception as e:
+        ok, result = False, f"Could not read the file: {e}"
+    if not ok:
+        os.remove(file_path)
+        return JSONResponse(status_code=422, content={"message": result})
+
+    queue_task(task_id, file_path, file.filename)
     return {"task_id": task_id}
 
+class UploadSessionRequest(BaseModel):
+    filename: str
+    size: int
+    chunk_size: Optional[int] = None
+    sha256: Optional[str] = None
+
+@app.exception_handler(UploadError)
+async def upload_error_handler(request: Request, exc: UploadError):
+    return JSONResponse(status_code=exc.status_code, content={"message": exc.message})
+
+@app.post("/uploads")
+async def create_upload(body: UploadSessionRequest):
+    """Starts a chunked upload. The response's upload_id and chunk_size say where to PUT each chunk."""
+    session = upload_manager.create(body.filename, body.size, body.chunk_size, body.sha256)
+    logger.info(f"Upload {session.upload_id}: started for {session.filename} ({session.size} bytes)")
+    return session.to_dict()
+
+@app.get("/uploads/{upload_id}")
+async def get_upload(upload_id: str):
+    """Upload progress, including which chunks have arrived (to resume after an interruption)."""
+    session = upload_manager.get(upload_id)
+    if session is None:
+        return JSONResponse(status_code=404, content={"message": "Upload not found"})
+    return session.to_dict()
+
+@app.put("/uploads/{upload_id}/chunks/{index}")
+async def put_upload_chunk(upload_id: str, index: int, request: Request,
+                           x_chunk_sha256: str = Header(None)):
+    """Raw chunk bytes as the request body, with their SHA-256 hex digest in X-Chunk-Sha256.
+       Responds 422 as soon as the header row shows the file has the wrong columns."""
+    session = await upload_manager.write_chunk(upload_id, index, request.stream(), x_chunk_sha256)
+    return session.to_dict()
+
+@app.post("/uploads/{upload_id}/complete")
+async def complete_upload(upload_id: str):
+    session = upload_manager.get(upload_id)
+    if session is None:
+        return JSONResponse(status_code=404, content={"message": "Upload not found"})
+    task_id = str(uuid.uuid4())
+    file_path = os.path.join(UPLOAD_FOLDER, f"{task_id}_{session.filename}")
+    await upload_manager.complete(upload_id, file_path)
+    queue_task(task_id, file_path, session.filename)
+    return {"task_id": task_id}
+
+@app.delete("/uploads/{upload_id}")
+async def cancel_upload(upload_id: str):
+    upload_manager.discard(upload_id)
+    return {"status": "cancelled"}
+
 @app.get("/status/{task_id}")
 async def get_status(task_id: str):
-    return task_progress.get(task_id, {"status": "unknown"})
+    data = get_task_state(task_id)
+    if data is None:
+        return {"status": "unknown"}
+    return data
+
+@app.get("/cache/stats")
+async def get_cache_stats():
+    return {"downloaded": IMAGE_CACHE.stats(), "prepared": PREPARED_IMAGE_CACHE.stats(),
+            "image_health": IMAGE_HEALTH.stats()}
+
+@app.get("/metrics")
+async def get_metrics():
+    if not METRICS_ENABLED:
+        return JSONResponse(status_code=404, content={"message": "Metrics are disabled"})
+    return PlainTextResponse(REGISTRY.render(), media_type="text/plain; version=0.0.4")
+
+@app.get("/events/{task_id}")
+async def progress_events(task_id: str, request: Request):
+    """Server-sent events: 'progress' (coalesced status updates), 'images' (download
+       counts), 'partner' (each finished report) and a final 'done'. /status remains
+       available for clients without EventSource."""
+    if not is_task_id(task_id):
+        return JSONResponse(status_code=404, content={"message": "Task not found"})
+    sub = progress_broker.subscribe(task_id)
+
+    async def events():
+        try:
+            current = get_task_state(task_id) or {"status": "unknown"}
+            if current.get("status") in FINISHED_STATUSES or current.get("status") == "unknown":
+                yield format_sse(DONE_EVENT, current)
+                return
+            yield format_sse("progress", current)
+            while True:
+                if await request.is_disconnected():
+                    return
+                batch = await sub.next_batch(timeout=15)
+                if not batch:
+                    yield ": keep-alive\n\n"
+                    continue
+                for event, data in batch:
+                    yield format_sse(event, data)
+                    if event == DONE_EVENT:
+                        return
+        finally:
+            progress_broker.unsubscribe(sub)
+
+    return StreamingResponse(events(), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+@app.get("/stream/{task_id}")
+async def stream_reports(task_id: str):
+    """Streams the task's reports as a ZIP, starting with whichever PDFs are already done."""
+    if not is_task_id(task_id) or (task_id not in task_reports and task_store.get(task_id) is None):
+        return JSONResponse(status_code=404, content={"message": "Task not found"})
+    def measured(chunks):
+        start = time.perf_counter()
+        for chunk in chunks:
+            ZIP_BYTES.inc(len(chunk))
+            yield chunk
+        ZIP_STREAM_SECONDS.observe(time.perf_counter() - start)
+
+    return StreamingResponse(
+        measured(stream_zip(iter_task_reports(task_id))),
+        media_type="application/zip",
+        headers={"Content-Disposition": f'attachment; filename="reports_{task_id}.zip"'},
+    )
 
 @app.get("/download/{filename}")
 async def download_file(filename: str):
@@ -160,6 +491,7 @@ def find_free_port(start_port=8000):
             port += 1
 
 if __name__ == "__main__":
+    multiprocessing.freeze_support()  # PyInstaller builds: let render workers start
     port = find_free_port()
     print(f"Server started! Open http://127.0.0.1:{port} in your browser to start using the tool.")
     logger.info(f"Starting FastAPI server on port {port}...")
@@ -0,0 +1,250 @@
+import asyncio
+import concurrent.futures
+import threading
+import time
+from urllib.parse import urlsplit
+
+import httpx
+
+from image_fetcher import DownloadAttempts
+from metrics import IMAGE_FETCH_QUEUE
+
+
+class ImageTooLarge(Exception):
+    pass
+
+
+class AsyncFetchEngine:
+    """Downloads images with one shared keep-alive httpx.AsyncClient on an event loop.
+
+       - max_concurrency bounds in-flight requests across all tasks.
+       - per_host bounds in-flight requests to any single host.
+       - Bodies are streamed and abandoned once they exceed max_bytes.
+       - Cache lookups/writes and transforms (e.g. downscaling) run on a small
+         thread pool so they never block the loop.
+       The loop is either the web server's (start(loop) from a startup hook) or a
+       private one on a daemon thread (start() with no loop, e.g. from the CLI).
+       Each job uses its own session() for deduplication, budget and cancellation.
+       Outcomes are handled by DownloadAttempts, as in ImageFetcher."""
+
+    def __init__(self, max_concurrency=256, per_host=8, timeout=10, retries=2, backoff=0.5,
+                 max_bytes=25 * 1024**2, worker_threads=4, health=None):
+        self.health = health
+        self.max_concurrency = max_concurrency
+        self.per_host = per_host
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.max_bytes = max_bytes
+        self.worker_threads = worker_threads
+        self.loop = None
+        self._client = None
+        self._slots = None
+        self._host_slots = {}
+        self._start_lock = threading.Lock()
+        self._executor = None
+        self._tasks = set()
+
+    def start(self, loop=None):
+        """Binds the engine to `loop` (or a new background loop). No-op if already running."""
+        with self._start_lock:
+            if self.loop is not None and not self.loop.is_closed():
+                return
+            if loop is None:
+                loop = asyncio.new_event_loop()
+                threading.Thread(target=loop.run_forever, name="image-fetch-loop", daemon=True).start()
+            self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.worker_threads,
+                                                                   thread_name_prefix="image-fetch")
+            self._client = None
+            self._host_slots = {}
+            self.loop = loop
+
+    def _ensure_client(self):
+        # Created lazily on the loop thread, so it binds to the right loop
+        if self._client is None:
+            limits = httpx.Limits(max_connections=self.max_concurrency, max_keepalive_connections=self.max_concurrency)
+            self._client = httpx.AsyncClient(limits=limits, follow_redirects=True)
+            self._slots = asyncio.Semaphore(self.max_concurrency)
+        return self._client
+
+    def _host_slot(self, url):
+        host = urlsplit(url).netloc.lower()
+        if host not in self._host_slots:
+            self._host_slots[host] = asyncio.Semaphore(self.per_host)
+        return self._host_slots[host]
+
+    async def aclose(self):
+        """Cancels outstanding downloads and closes the client. Call on the engine's loop."""
+        pending = list(self._tasks)
+        for task in pending:
+            task.cancel()
+        if pending:
+            await asyncio.gather(*pending, return_exceptions=True)
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+        self.loop = None
+
+    def run_blocking(self, fn, *args):
+        return self.loop.run_in_executor(self._executor, fn, *args)
+
+    async def _read_limited(self, response, url):
+        length = response.headers.get("content-length")
+        if length and length.isdigit() and int(length) > self.max_bytes:
+            raise ImageTooLarge(f"{url} is {int(length)} bytes (limit {self.max_bytes})")
+        chunks = []
+        size = 0
+        async for chunk in response.aiter_bytes():
+            size += len(chunk)
+            if size > self.max_bytes:
+                raise ImageTooLarge(f"{url} exceeds {self.max_bytes} bytes")
+            chunks.append(chunk)
+        return b"".join(chunks)
+
+    async def fetch(self, url, cache=None, deadline=None, failures=None):
+        """Returns the image bytes for url, or None if it could not be fetched.
+           The reason for a failure is stored in failures[url] when a dict is given."""
+        if not isinstance(url, str) or not url.startswith('http'):
+            return None
+        if cache is not None:
+            cached = await self.run_blocking(cache.get, url)
+            if cached is not None:
+                return cached
+        attempts = DownloadAttempts(url, self.retries, self.backoff, self.health, failures)
+        if attempts.blocked():
+            return None
+
+        client = self._ensure_client()
+        while True:
+            remaining = self.timeout if deadline is None else deadline - time.time()
+            if remaining <= 0:
+                print(f"Image fetch budget exhausted, skipping {url}")
+                attempts.give_up("skipped (fetch budget exhausted)")
+                return None
+            wait = attempts.host_ready()
+            if wait is None:
+                break
+            if wait:
+                await asyncio.sleep(min(wait, remaining))
+                continue
+            started = time.time()
+            try:
+                async with self._slots, self._host_slot(url):
+                    # Another request may have tripped the breaker while this one waited
+                    wait = attempts.host_ready()
+                    if wait is None:
+                        break
+                    if wait:
+                        continue
+                    async with client.stream("GET", url, timeout=min(self.timeout, remaining)) as response:
+                        status = response.status_code
+                        attempts.responded(status)
+                        content = await self._read_limited(response, url) if status == 200 else None
+                if content is not None:
+                    if cache is not None:
+                        cache.record_download(len(content), time.time() - started)
+                        await self.run_blocking(cache.put, url, content)
+                    attempts.succeeded(len(content))
+                    return content
+                retry = attempts.http_error(status)
+            except ImageTooLarge as e:
+                attempts.rejected(str(e))
+                retry = False
+            except httpx.HTTPError as e:
+                retry = attempts.request_error(e, timed_out=isinstance(e, httpx.TimeoutException))
+            if not retry:
+                break
+            await asyncio.sleep(attempts.next_attempt())
+        attempts.give_up()
+        return None
+
+    async def fetch_and_transform(self, url, cache, deadline, transform, failures=None):
+        task = asyncio.current_task()
+        self._tasks.add(task)
+        try:
+            data = await self.fetch(url, cache, deadline, failures)
+            if data is not None and transform is not None:
+                data = await self.run_blocking(transform, url, data)
+                if data is None and failures is not None:
+                    failures[url] = "not a readable image"
+            return data
+        finally:
+            self._tasks.discard(task)
+
+    def session(self, cache=None, budget_seconds=900):
+        if self.loop is None:
+            self.start()
+        return AsyncImageFetcher(self, cache, budget_seconds)
+
+
+class AsyncImageFetcher:
+    """One job's view of an AsyncFetchEngine, with the same interface as ImageFetcher
+       (submit / close), so the pipeline can use either.
+       Futures are plain concurrent.futures.Future objects resolved off the event loop,
+       so pipeline callbacks attached to them never run on (or block) the loop.
+       Failed URLs are kept in `failures` ({url: reason})."""
+
+    def __init__(self, engine, cache=None, budget_seconds=900):
+        self.engine = engine
+        self.failures = {}
+        self.cache = cache
+        self.budget_seconds = budget_seconds
+        self._lock = threading.Lock()
+        self._deadline = None
+        self._submitted = {}
+        self._inner = {}
+
+    def _schedule(self, url, deadline, transform):
+        outer = concurrent.futures.Future()
+        inner = asyncio.run_coroutine_threadsafe(
+            self.engine.fetch_and_transform(url, self.cache, deadline, transform, self.failures), self.engine.loop)
+        IMAGE_FETCH_QUEUE.inc()
+
+        def resolve(_inner):
+            if outer.done():
+                return
+            try:
+                if _inner.cancelled():
+                    outer.cancel()
+                elif _inner.exception() is not None:
+                    outer.set_exception(_inner.exception())
+                else:
+                    outer.set_result(_inner.result())
+            except concurrent.futures.InvalidStateError:
+                pass  # cancelled by the pipeline in the meantime
+
+        def on_inner_done(_inner):
+            IMAGE_FETCH_QUEUE.dec()
+            try:
+                self.engine._executor.submit(resolve, _inner)
+            except RuntimeError:
+                resolve(_inner)  # engine shutting down
+
+        inner.add_done_callback(on_inner_done)
+        outer.add_done_callback(lambda f: f.cancelled() and inner.cancel())
+        return outer, inner
+
+    def submit(self, url, transform=None):
+        """Schedules url on the engine and returns a Future of its bytes (or None). Each URL
+           is scheduled only once per session; the budget deadline starts with the first submit."""
+        with self._lock:
+            future = self._submitted.get(url)
+            if future is None:
+                if self._deadline is None and self.budget_seconds:
+                    self._deadline = time.time() + self.budget_seconds
+                future, inner = self._schedule(url, self._deadline, transform)
+                self._submitted[url] = future
+                self._inner[url] = inner
+            return future
+
+    def close(self, cancel_pending=False):
+        """Forgets this session's downloads; with cancel_pending, in-flight ones are cancelled
+           (e.g. when the job fails or is abandoned). The shared client stays open."""
+        with self._lock:
+            inner, self._inner = self._inner, {}
+            self._submitted = {}
+        if cancel_pending:
+            for future in inner.values():
+                future.cancel()
@@ -1,18 +1,39 @@
 import pandas as pd
-import requests
+import numpy as np
 import concurrent.futures
+import multiprocessing
 import time
 
 from reportlab.lib.pagesizes import A4
-from reportlab.lib import colors
-from reportlab.platypus import SimpleDocTemplate, Table, TableStyle, Paragraph, Image as RLImage, Spacer, PageBreak
-from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
+from reportlab import rl_config
+from pypdf import PdfWriter
+from reportlab.platypus import SimpleDocTemplate, Table, Paragraph, Spacer, PageBreak
 from reportlab.lib.units import inch
 from io import BytesIO
+from PIL import Image, ImageOps
 import os
+import shutil
+import tempfile
+import hashlib
 import json
 import traceback
 import re
+import sys
+import glob
+import argparse
+import csv
+import queue
+import threading
+from collections import defaultdict
+
+from image_cache import ImageCache
+from image_fetcher import ImageFetcher
+from async_image_fetcher import AsyncFetchEngine
+from image_health import ImageHealth
+from report_manifest import ReportManifest
+from sheet_cache import SheetCache
+from report_template import get_report_template, ImageReaderCache, SharedImage
+from metrics import StageTimer, STAGE_SECONDS, PARTNER_RENDER_SECONDS, RENDER_QUEUE
 
 # ==========================================
 # CONFIGURATION
@@ -23,6 +44,132 @@ OUTPUT_DIR = "generated_reports"
 if not os.path.exists(OUTPUT_DIR):
     os.makedirs(OUTPUT_DIR)
 
+# Persistent image cache shared by every task and partner.
+# Disk tier survives restarts; memory tier avoids re-reading hot images.
+IMAGE_CACHE_DIR = "image_cache"
+IMAGE_CACHE_MAX_BYTES = 2 * 1024**3         # 2 GB on disk, LRU evicted
+IMAGE_CACHE_MEMORY_BYTES = 256 * 1024**2    # 256 MB in process
+
+IMAGE_CACHE = ImageCache(IMAGE_CACHE_DIR, disk_max_bytes=IMAGE_CACHE_MAX_BYTES, memory_max_bytes=IMAGE_CACHE_MEMORY_BYTES)
+
+# Global image prefetch: one pooled HTTP session for every partner in a run.
+IMAGE_FETCH_WORKERS = 32        # total concurrent downloads
+IMAGE_FETCH_PER_HOST = 8        # concurrent downloads per image host
+IMAGE_FETCH_TIMEOUT = 10        # seconds per request
+IMAGE_FETCH_RETRIES = 2         # retries on connection errors / 429 / 5xx
+IMAGE_FETCH_BACKOFF = 0.5       # seconds, doubled on every retry
+IMAGE_FETCH_BUDGET = 900        # seconds for the whole prefetch stage
+
+# Failing images: once IMAGE_HOST_FAILURE_THRESHOLD different images from one host
+# failed (timeouts, connection errors, 5xx) without any other response from it, its
+# remaining images fail straight away (placeholder in the PDF) for
+# IMAGE_HOST_COOLDOWN seconds, then one request checks whether it is back.
+# URLs that returned 404/410 are skipped for IMAGE_NEGATIVE_TTL seconds, ones that
+# timed out or kept failing for IMAGE_TRANSIENT_NEGATIVE_TTL (remembered across
+# runs in IMAGE_NEGATIVE_CACHE_FILE). Each run lists its failed images in
+# FAILED_IMAGES_REPORT next to the PDFs (and in the ZIP).
+IMAGE_HOST_FAILURE_THRESHOLD = 5
+IMAGE_HOST_COOLDOWN = 60
+IMAGE_NEGATIVE_TTL = 6 * 60 * 60
+IMAGE_TRANSIENT_NEGATIVE_TTL = 10 * 60
+IMAGE_NEGATIVE_CACHE_FILE = "image_failures.json"
+FAILED_IMAGES_REPORT = "failed_images.csv"
+
+IMAGE_HEALTH = ImageHealth(
+    failure_threshold=IMAGE_HOST_FAILURE_THRESHOLD,
+    cooldown=IMAGE_HOST_COOLDOWN,
+    negative_ttl=IMAGE_NEGATIVE_TTL,
+    transient_ttl=IMAGE_TRANSIENT_NEGATIVE_TTL,
+    path=IMAGE_NEGATIVE_CACHE_FILE,
+)
+
+# "async": downloads run as coroutines on one shared keep-alive httpx client (on the
+#          web server's event loop, or a background loop when run standalone), so
+#          hundreds can be in flight without a thread each.
+# "thread": blocking requests on a thread pool of IMAGE_FETCH_WORKERS.
+IMAGE_FETCH_ENGINE = "async"
+IMAGE_FETCH_CONCURRENCY = 256   # async engine: in-flight downloads across all jobs
+IMAGE_FETCH_MAX_BYTES = 25 * 1024**2  # larger images are abandoned mid-download
+IMAGE_FETCH_CPU_WORKERS = max(2, min(8, os.cpu_count() or 2))  # cache I/O + downscaling threads
+
+FETCH_ENGINE = AsyncFetchEngine(
+    max_concurrency=IMAGE_FETCH_CONCURRENCY,
+    per_host=IMAGE_FETCH_PER_HOST,
+    timeout=IMAGE_FETCH_TIMEOUT,
+    retries=IMAGE_FETCH_RETRIES,
+    backoff=IMAGE_FETCH_BACKOFF,
+    max_bytes=IMAGE_FETCH_MAX_BYTES,
+    worker_threads=IMAGE_FETCH_CPU_WORKERS,
+    health=IMAGE_HEALTH,
+)
+
+# PDF rendering: "thread" renders partners on a thread pool (ReportLab is pure
+# Python, so this is GIL bound); "process" renders them on a process pool that is
+# started on first use and kept for the life of the process (shared by every input
+# and every concurrent job). PDF_RENDER_START_METHOD: None for the platform default
+# (spawn on Windows/macOS), or "spawn", "fork", "forkserver".
+PDF_RENDER_MODE = "thread"
+PDF_RENDER_WORKERS = 5
+PDF_RENDER_START_METHOD = None
+
+# Large partners: a partner with more than PARTNER_SHARD_BATCHES batches is split
+# into shards of that many batches (a page or more each) rendered in parallel,
+# which spreads one big partner over all render workers and bounds the memory
+# of each doc.build.
+# "merge": shards are concatenated into the usual Report_<partner>.pdf (pypdf)
+# "parts": shards are delivered as Report_<partner>_part01.pdf, _part02.pdf, ...
+# "off":   every partner is rendered as one document
+PARTNER_SHARD_MODE = "merge"
+PARTNER_SHARD_BATCHES = 250
+
+# Ingestion: "full" loads the whole sheet with pandas; "stream" reads only the
+# columns SHEET_CONFIG references, in chunks, keeping memory bounded;
+# "auto" streams files of STREAMING_MIN_BYTES or more.
+INGEST_MODE = "auto"
+STREAMING_MIN_BYTES = 25 * 1024**2
+STREAMING_CHUNK_ROWS = 20000
+
+# Command-line runs cache parsed input sheets by file content (see sheet_cache.py),
+# so a file that was read before (e.g. by --convert-only) skips the .csv/.xlsx
+# parse. The web app doesn't use it: uploads are one-off and cleaned up after a TTL.
+# Bump SHEET_CACHE_VERSION whenever reading/parsing changes.
+SHEET_CACHE_ENABLED = True
+SHEET_CACHE_DIR = "sheet_cache"
+SHEET_CACHE_MAX_BYTES = 2 * 1024**3
+SHEET_CACHE_VERSION = 2
+
+SHEET_CACHE = None  # set by main()
+
+# Incremental re-runs: a partner whose batches (meta, stages, reasons, image URLs)
+# are unchanged since the last run reuses its stored PDF instead of re-rendering.
+# Bump REPORT_LAYOUT_VERSION whenever the PDF layout changes.
+INCREMENTAL_REPORTS = True
+REPORT_STORE_DIR = "report_store"
+REPORT_LAYOUT_VERSION = 1
+
+# Image preparation: photos are downscaled to the size they are shown at in the
+# PDF and re-encoded as JPEG. Raise IMAGE_DPI / IMAGE_JPEG_QUALITY for sharper
+# images, lower them for smaller PDFs. IMAGE_PREPARE = False embeds originals.
+IMAGE_PREPARE = True
+IMAGE_CELL_WIDTH = 3 * inch
+IMAGE_CELL_HEIGHT = 2.2 * inch
+IMAGE_DPI = 150
+IMAGE_JPEG_QUALITY = 75
+PREPARED_IMAGE_CACHE_DIR = "image_cache_prepared"
+
+PREPARED_IMAGE_CACHE = ImageCache(PREPARED_IMAGE_CACHE_DIR, disk_max_bytes=IMAGE_CACHE_MAX_BYTES // 4, memory_max_bytes=IMAGE_CACHE_MEMORY_BYTES)
+
+# Decoded images kept across partner reports (per process), so an image that
+# appears in many reports is decoded once.
+IMAGE_READER_CACHE_BYTES = 128 * 1024**2
+IMAGE_READERS = ImageReaderCache(IMAGE_READER_CACHE_BYTES)
+
+# ReportLab ASCII85-encodes embedded images by default. Without its C accelerator
+# that encoding is most of doc.build's time and makes every image 25% larger, so
+# images are written as plain binary streams (standard PDF) unless this is True.
+PDF_ASCII85_STREAMS = False
+rl_config.useA85 = int(PDF_ASCII85_STREAMS)
+
 SHEET_CONFIG = {
     'meta_map': {
         'partner': 'Partner Name',
@@ -46,128 +193,126 @@ SHEET_CONFIG = {
     ]
 }
 
+# Known sheet formats, auto-detected from the header row (see detect_sheet_format).
+# Add another layout with register_sheet_format(name, config) using the same
+# shape as SHEET_CONFIG. A file must match at least SCHEMA_MIN_MATCH of a
+# format's columns (and its partner column) to be detected as that format.
+SHEET_FORMATS = {'looker': SHEET_CONFIG}
+SCHEMA_MIN_MATCH = 0.5
+
 # ==========================================
 # 1. IMAGE DOWNLOADER
 # ==========================================
-def download_image(url):
-    """Downloads an image from a URL and returns it as a BytesIO object for ReportLab."""
+def make_image_fetcher():
+    if IMAGE_FETCH_ENGINE == "async":
+        return FETCH_ENGINE.session(cache=IMAGE_CACHE, budget_seconds=IMAGE_FETCH_BUDGET)
+    return ImageFetcher(
+        cache=IMAGE_CACHE,
+        max_workers=IMAGE_FETCH_WORKERS,
+        per_host=IMAGE_FETCH_PER_HOST,
+        timeout=IMAGE_FETCH_TIMEOUT,
+        retries=IMAGE_FETCH_RETRIES,
+        backoff=IMAGE_FETCH_BACKOFF,
+        budget_seconds=IMAGE_FETCH_BUDGET,
+        health=IMAGE_HEALTH,
+    )
+
+def prepared_size():
+    """Pixel box an embedded image needs at IMAGE_DPI."""
+    return (max(1, round(IMAGE_CELL_WIDTH / 72 * IMAGE_DPI)), max(1, round(IMAGE_CELL_HEIGHT / 72 * IMAGE_DPI)))
+
+def prepared_cache_key(url):
+    width_px, height_px = prepared_size()
+    return f"{url}#{width_px}x{height_px}q{IMAGE_JPEG_QUALITY}"
+
+def prepare_image(data, size=None, quality=None):
+    """Decodes image bytes once, applies EXIF rotation, shrinks to fit `size` (pixels)
+       and re-encodes as JPEG. Returns the new bytes, or None if the data is not an image."""
+    width_px, height_px = size or prepared_size()
+    quality = quality or IMAGE_JPEG_QUALITY
     try:
-        if not isinstance(url, str) or not url.startswith('http'):
-            return None
-        response = requests.get(url, timeout=10)
-        if response.status_code == 200:
-            img_data = BytesIO(response.content)
-            return img_data
+        img = Image.open(BytesIO(data))
+        # Let the JPEG decoder downscale by a power of two while decoding (much faster on big photos)
+        longest = max(width_px, height_px)
+        img.draft('RGB', (longest, longest))
+        img = ImageOps.exif_transpose(img)
+        if img.mode in ('RGBA', 'LA') or (img.mode == 'P' and 'transparency' in img.info):
+            img = img.convert('RGBA')
+            background = Image.new('RGB', img.size, (255, 255, 255))
+            background.paste(img, mask=img.getchannel('A'))
+            img = background
+        elif img.mode != 'RGB':
+            img = img.convert('RGB')
+        img.thumbnail((width_px, height_px), Image.LANCZOS)
+        out = BytesIO()
+        img.save(out, format='JPEG', quality=quality, optimize=True)
+        return out.getvalue()
     except Exception as e:
-        print(f"Error downloading image {url}: {e}")
-    return None
+        print(f"Could not prepare image ({len(data)} bytes): {e}")
+        return None
 
-# ==========================================
-# 2. PDF GENERATOR
-# ==========================================
-def create_partner_pdf(partner_name, batches, output_filename, progress_callback=None):
-    """Generates a PDF for a specific partner containing all their rejected batches.
-       Downloads all images in parallel first to speed up generation."""
-    
-    doc = SimpleDocTemplate(output_filename, pagesize=A4, rightMargin=30, leftMargin=30, topMargin=30, bottomMargin=30)
-    elements = []
-    styles = getSampleStyleSheet()
-    
-    # Custom Styles
-    style_header_text = ParagraphStyle('HeaderVal', parent=styles['Normal'], fontSize=9, leading=11)
-    style_header_lbl = ParagraphStyle('HeaderLbl', parent=styles['Normal'], fontSize=9, leading=11, fontName='Helvetica-Bold')
-    style_reason = ParagraphStyle('Reason', parent=styles['Normal'], textColor=colors.red, fontSize=10, leading=12)
-    style_stage = ParagraphStyle('Stage', parent=styles['Normal'], textColor=colors.white, backColor=colors.darkgrey, fontSize=8, alignment=1, spaceBefore=4)
-
-    # --- 1. PRE-DOWNLOAD IMAGES IN PARALLEL ---
-    # Collect all unique image URLs for this partner
-    all_image_urls = set()
+def prepare_downloaded_image(url, data):
+    """Fetcher transform: prepares freshly downloaded bytes and caches the result."""
+    prepared = prepare_image(data)
+    if prepared is not None:
+        PREPARED_IMAGE_CACHE.put(prepared_cache_key(url), prepared)
+    return prepared
+
+def collect_image_urls(batches):
+    """Unique http(s) image URLs referenced by a list of batches, in first-seen order."""
+    urls = {}
     for batch in batches:
         for item in batch['images']:
             if item['image'] and isinstance(item['image'], str) and item['image'].startswith('http'):
-                all_image_urls.add(item['image'])
-    
-    image_map = {}
-    if all_image_urls:
-        total_imgs = len(all_image_urls)
-        downloaded = 0
-        if progress_callback:
-            progress_callback(f"Downloading {total_imgs} validation images for {partner_name}...", percent=None)
-
-        # Use a ThreadPool to download images concurrently
-        with concurrent.futures.ThreadPoolExecutor(max_workers=10) as executor:
-            future_to_url = {executor.submit(download_image, url): url for url in all_image_urls}
-            for future in concurrent.futures.as_completed(future_to_url):
-                downloaded += 1
-                if progress_callback and downloaded % 5 == 0:
-                     progress_callback(f"Downloading images for {partner_name} ({downloaded}/{total_imgs})...", percent=None)
-                
-                url = future_to_url[future]
-                try:
-                    data = future.result()
-                    if data:
-                        image_map[url] = data
-                except Exception as e:
-                    print(f"Failed to download {url}: {e}")
-
-    def build_header(meta):
-        header_data = [
-            [Paragraph('Partner Name:', style_header_lbl), Paragraph(str(meta.get('partner', '')), style_header_text),
-             Paragraph('Inventory/Batch ID:', style_header_lbl), Paragraph(str(meta.get('inventoryId', '')), style_header_text)],
-            [Paragraph('Date / Time:', style_header_lbl), Paragraph(f"{meta.get('date', '')} {meta.get('time', '')}", style_header_text),
-             Paragraph('Kiln ID:', style_header_lbl), Paragraph(str(meta.get('kilnId', '')), style_header_text)],
-            [Paragraph('Artisan/Name:', style_header_lbl), Paragraph(str(meta.get('artisan', '')), style_header_text),
-             Paragraph('Slot/Facility:', style_header_lbl), Paragraph(str(meta.get('slot', '')), style_header_text)],
-        ]
-        t_header = Table(header_data, colWidths=[1.2*inch, 2.5*inch, 1.2*inch, 2.0*inch])
-        t_header.setStyle(TableStyle([
-            ('BACKGROUND', (0, 0), (-1, -1), colors.whitesmoke),
-            ('GRID', (0, 0), (-1, -1), 0.5, colors.grey),
-            ('VALIGN', (0, 0), (-1, -1), 'MIDDLE'),
-            ('PADDING', (0, 0), (-1, -1), 6),
-        ]))
-        return t_header
-
-    def build_image_cell(item):
-        img_url = item['image']
-        if img_url in image_map:
-            img_data = BytesIO(image_map[img_url].getvalue())
-            img_flowable = RLImage(img_data, width=3*inch, height=2.2*inch)
-            img_flowable.hAlign = 'CENTER'
-        elif not img_url:
-            img_flowable = Paragraph("[No Image Link]", styles['Normal'])
-        else:
-            img_flowable = Paragraph("[Image Download Failed]", styles['Normal'])
-
-        stage_para = Paragraph(f"STAGE: {item['stage']}", style_stage)
-        reason_text = item.get('reason', '')
-        reason_para = Paragraph(f"Reason: {reason_text}", style_reason) if reason_text else Spacer(1, 1)
-
-        cell_table = Table([[img_flowable], [stage_para], [reason_para]], colWidths=[3.1*inch])
-        cell_table.setStyle(TableStyle([
-            ('BOX', (0, 0), (-1, -1), 1, colors.lightgrey),
-            ('ALIGN', (0, 0), (-1, -1), 'CENTER'),
-            ('VALIGN', (0, 0), (-1, -1), 'TOP'),
-            ('BOTTOMPADDING', (0, 0), (-1, -1), 10),
-        ]))
-        return cell_table
-
-    def build_image_row(pair):
-        """Build a single 2-column row table from 1 or 2 rejection items."""
-        row_cells = [build_image_cell(item) for item in pair]
-        if len(row_cells) < 2:
-            row_cells.append(Spacer(1, 1))
-
-        t_row = Table([row_cells], colWidths=[3.4*inch, 3.4*inch])
-        t_row.setStyle(TableStyle([
-            ('VALIGN', (0, 0), (-1, -1), 'TOP'),
-            ('LEFTPADDING', (0, 0), (-1, -1), 5),
-            ('RIGHTPADDING', (0, 0), (-1, -1), 5),
-            ('TOPPADDING', (0, 0), (-1, -1), 10),
-        ]))
-        return t_row
-
-    # --- 2. BUILD PDF ---
+                urls[item['image']] = None
+    return list(urls)
+
+def build_header(meta, template):
+    lbl, val = template.header_lbl, template.header_text
+    header_data = [
+        [Paragraph('Partner Name:', lbl), Paragraph(str(meta.get('partner', '')), val),
+         Paragraph('Inventory/Batch ID:', lbl), Paragraph(str(meta.get('inventoryId', '')), val)],
+        [Paragraph('Date / Time:', lbl), Paragraph(f"{meta.get('date', '')} {meta.get('time', '')}", val),
+         Paragraph('Kiln ID:', lbl), Paragraph(str(meta.get('kilnId', '')), val)],
+        [Paragraph('Artisan/Name:', lbl), Paragraph(str(meta.get('artisan', '')), val),
+         Paragraph('Slot/Facility:', lbl), Paragraph(str(meta.get('slot', '')), val)],
+    ]
+    t_header = Table(header_data, colWidths=template.HEADER_COL_WIDTHS)
+    t_header.setStyle(template.header_table)
+    return t_header
+
+def build_image_cell(item, image_map, template):
+    img_url = item['image']
+    reader = IMAGE_READERS.get(img_url, image_map[img_url]) if img_url in image_map else None
+    if reader is not None:
+        img_flowable = SharedImage(reader, width=IMAGE_CELL_WIDTH, height=IMAGE_CELL_HEIGHT)
+    elif not img_url:
+        img_flowable = Paragraph("[No Image Link]", template.normal)
+    else:
+        img_flowable = Paragraph("[Image Download Failed]", template.normal)
+
+    stage_para = Paragraph(f"STAGE: {item['stage']}", template.stage)
+    reason_text = item.get('reason', '')
+    reason_para = Paragraph(f"Reason: {reason_text}", template.reason) if reason_text else Spacer(1, 1)
+
+    cell_table = Table([[img_flowable], [stage_para], [reason_para]], colWidths=template.CELL_COL_WIDTHS)
+    cell_table.setStyle(template.cell_table)
+    return cell_table
+
+def build_image_row(pair, image_map, template):
+    """Build a single 2-column row table from 1 or 2 rejection items."""
+    row_cells = [build_image_cell(item, image_map, template) for item in pair]
+    if len(row_cells) < 2:
+        row_cells.append(Spacer(1, 1))
+
+    t_row = Table([row_cells], colWidths=template.ROW_COL_WIDTHS)
+    t_row.setStyle(template.row_table)
+    return t_row
+
+def build_report_elements(batches, image_map):
+    """Flowables for one partner's report: a page per batch with its header and image rows."""
+    template = get_report_template()
+    elements = []
     first_page = True
 
     for batch in batches:
@@ -178,17 +323,26 @@ def create_partner_pdf(partner_name, batches, output_filename, progress_callback
             elements.append(PageBreak())
         first_page = False
 
-        elements.append(Paragraph("Rejection Report", styles['Heading2']))
-        elements.append(build_header(meta))
+        elements.append(Paragraph("Rejection Report", template.heading))
+        elements.append(build_header(meta, template))
         elements.append(Spacer(1, 0.2*inch))
 
         if not rejection_items:
-            elements.append(Paragraph("This batch has rejections marked but no images were found.", styles['Normal']))
+            elements.append(Paragraph("This batch has rejections marked but no images were found.", template.normal))
             continue
 
         for i in range(0, len(rejection_items), 2):
             pair = rejection_items[i:i+2]
-            elements.append(build_image_row(pair))
+            elements.append(build_image_row(pair, image_map, template))
+    return elements
+
+def create_partner_pdf(partner_name, batches, output_filename, image_map):
+    """Generates a PDF for a specific partner containing all their rejected batches.
+       image_map ({url: bytes or file path}) holds the partner's downloaded images."""
+    
+    doc = SimpleDocTemplate(output_filename, pagesize=A4, rightMargin=30, leftMargin=30, topMargin=30, bottomMargin=30)
+
+    elements = build_report_elements(batches, image_map)
             
     try:
         doc.build(elements)
@@ -200,7 +354,7 @@ def create_partner_pdf(partner_name, batches, output_filename, progress_callback
 
 
 # ==========================================
-# 4. MAIN LOGIC
+# 3. REJECTION EXTRACTION
 # ==========================================
 
 def normalize_name(name):
@@ -217,141 +371,886 @@ def safe_get(row, col_name, df_cols_map):
         return row.get(actual_col, '')
     return ''
 
-def process_data_and_generate_reports(file_path, progress_callback=None):
-    config = SHEET_CONFIG
-    
-    print(f"Reading data from {file_path}...")
-    if progress_callback: progress_callback("Reading data...")
+def resolve_column_plan(columns, config=None):
+    """Resolves every column referenced by the config to the actual sheet column, once.
+       Missing columns resolve to None (treated as empty, like safe_get)."""
+    config = config or SHEET_CONFIG
+    df_cols_map = {normalize_name(col): col for col in columns}
+
+    def lookup(col_name):
+        return df_cols_map.get(normalize_name(col_name)) or None
+
+    return {
+        'meta': {key: lookup(col_name) for key, col_name in config['meta_map'].items()},
+        'checks': [
+            (lookup(status_col), str(status_val).strip().lower(), stage_name, lookup(img_col), lookup(reason_col))
+            for status_col, status_val, stage_name, img_col, reason_col in config['checks']
+        ],
+    }
+
+_schema_lock = threading.Lock()
+_compiled_schemas = {}    # (header hash, format name) -> compiled schema
+_format_signatures = {}   # format name -> frozenset of normalized column names
+
+def register_sheet_format(name, config):
+    """Adds (or replaces) a sheet format for auto-detection."""
+    with _schema_lock:
+        SHEET_FORMATS[name] = config
+        _format_signatures.clear()
+        _compiled_schemas.clear()
+
+def header_hash(header):
+    return hashlib.sha1(json.dumps([str(col) for col in header]).encode('utf-8')).hexdigest()
+
+def _format_signature(name):
+    signature = _format_signatures.get(name)
+    if signature is None:
+        config = SHEET_FORMATS[name]
+        cols = list(config['meta_map'].values())
+        for status_col, _, _, img_col, reason_col in config['checks']:
+            cols.extend((status_col, img_col, reason_col))
+        signature = frozenset(normalize_name(col) for col in cols)
+        _format_signatures[name] = signature
+    return signature
+
+def detect_sheet_format(header):
+    """Name of the registered format whose columns best match the header, or None.
+       One normalization pass over the header plus a set intersection per format."""
+    normalized = {normalize_name(col) for col in header}
+    best_name, best_score = None, 0.0
+    for name, config in list(SHEET_FORMATS.items()):
+        if normalize_name(config['meta_map']['partner']) not in normalized:
+            continue
+        signature = _format_signature(name)
+        score = len(signature & normalized) / len(signature)
+        if score > best_score:
+            best_name, best_score = name, score
+    return best_name if best_score >= SCHEMA_MIN_MATCH else None
+
+def compile_sheet_schema(header, config=None):
+    """Compiles a format against a concrete header into column positions:
+       {'format', 'config', 'meta': {key: index}, 'checks': [(status_idx, expected,
+       stage, image_idx, reason_idx)], 'positions': [used indexes]}; missing columns
+       are None. With no config the format is detected from the header (falling back
+       to SHEET_CONFIG). Compiled schemas are cached by header hash."""
+    header = list(header)
+    if config is None:
+        name = detect_sheet_format(header) or 'looker'
+        config = SHEET_FORMATS.get(name, SHEET_CONFIG)
+    else:
+        name = next((n for n, c in SHEET_FORMATS.items() if c is config), None)
+
+    cache_key = (header_hash(header), name)
+    if name is not None:
+        with _schema_lock:
+            schema = _compiled_schemas.get(cache_key)
+        if schema is not None:
+            return schema
+
+    plan = resolve_column_plan(header, config)
+    index_of = {col: i for i, col in enumerate(header)}
+
+    def idx(col):
+        return None if col is None else index_of.get(col)
+
+    checks = [(idx(status_col), expected, stage_name, idx(img_col), idx(reason_col))
+              for status_col, expected, stage_name, img_col, reason_col in plan['checks']]
+    meta = {key: idx(col) for key, col in plan['meta'].items()}
+    used = set(meta.values())
+    for status_idx, _, _, img_idx, reason_idx in checks:
+        used.update((status_idx, img_idx, reason_idx))
+    used.discard(None)
+    schema = {'format': name, 'config': config, 'meta': meta, 'checks': checks, 'positions': sorted(used)}
+
+    if name is not None:
+        with _schema_lock:
+            _compiled_schemas[cache_key] = schema
+    return schema
+
+def extract_rejections(df, config=None):
+    """Columnar replacement for the old per-row loop.
+       Returns (partners, stats) where partners maps partner name -> list of
+       {'meta': {...}, 'images': [{'stage', 'image', 'reason'}, ...]} in sheet order.
+       Without a config the sheet format is detected from the header."""
+    plan = compile_sheet_schema(df.columns, config)
+    n_rows = len(df)
+    empty = np.full(n_rows, '', dtype=object)
+
+    raw_cache = {}
+    str_cache = {}
+
+    def raw(col):
+        # Raw cell values with blanks as '', same as df.fillna('')
+        if col is None:
+            return empty
+        if col not in raw_cache:
+            raw_cache[col] = df.iloc[:, col].astype(object).fillna('').to_numpy(dtype=object)
+        return raw_cache[col]
+
+    def stripped(col):
+        if col not in str_cache:
+            str_cache[col] = pd.Series(raw(col), dtype=object).astype(str).str.strip()
+        return str_cache[col]
 
+    partner_strs = stripped(plan['meta']['partner'])
+    valid = (partner_strs != '') & (partner_strs.str.lower() != 'nan')
+    valid = valid.to_numpy(dtype=bool)
+
+    # One boolean column per check: status matches the expected (rejected) value
+    check_masks = np.zeros((n_rows, len(plan['checks'])), dtype=bool)
+    for i, (status_col, expected, _, _, _) in enumerate(plan['checks']):
+        check_masks[:, i] = (stripped(status_col).str.lower() == expected).to_numpy(dtype=bool)
+
+    has_rejection = check_masks.any(axis=1) & valid
+    rejected_rows = np.flatnonzero(has_rejection)
+
+    partner_values = partner_strs.to_numpy(dtype=object)
+    # Every partner with a name gets an entry (possibly empty), in first-seen order
+    partners = {name: [] for name in pd.unique(partner_values[valid])}
+
+    meta_values = {key: stripped(col).to_numpy(dtype=object) for key, col in plan['meta'].items()}
+    check_values = [
+        (stage_name, raw(img_col), raw(reason_col))
+        for _, _, stage_name, img_col, reason_col in plan['checks']
+    ]
+
+    if len(rejected_rows):
+        groups = pd.Series(rejected_rows).groupby(partner_values[rejected_rows], sort=False).indices
+        for partner_name, positions in groups.items():
+            batch_list = partners[partner_name]
+            for row_idx in rejected_rows[positions]:
+                mask = check_masks[row_idx]
+                images = [
+                    {'stage': stage_name, 'image': img_vals[row_idx], 'reason': str(reason_vals[row_idx] or 'No Reason Provided')}
+                    for (stage_name, img_vals, reason_vals), hit in zip(check_values, mask) if hit
+                ]
+                batch_list.append({
+                    'meta': {key: vals[row_idx] for key, vals in meta_values.items()},
+                    'images': images,
+                })
+
+    stats = {
+        'rows': n_rows,
+        'errors': 0,
+        'no_rejections': int(valid.sum()) - len(rejected_rows),
+    }
+    return partners, stats
+
+
+def dedup_column_names(names):
+    """Mirrors pandas' header handling: blank -> 'Unnamed: i', repeats -> 'name.1', 'name.2'..."""
+    names = [f"Unnamed: {i}" if name is None or name == '' else name for i, name in enumerate(names)]
+    counts = defaultdict(int)
+    for i, col in enumerate(names):
+        cur_count = counts[col]
+        while cur_count > 0:
+            counts[col] = cur_count + 1
+            col = f"{col}.{cur_count}"
+            cur_count = counts[col]
+        names[i] = col
+        counts[col] = cur_count + 1
+    return names
+
+def read_sheet_header(file_path, filename=None):
+    """Header row of a .csv/.xlsx file (column names as iter_sheet_chunks sees them), or
+       None if the sheet is empty. filename gives the type when file_path has no extension."""
+    if (filename or file_path).lower().endswith('.csv'):
+        return list(pd.read_csv(file_path, nrows=0).columns)
+
+    from openpyxl import load_workbook
+    wb = load_workbook(file_path, read_only=True, data_only=True)
     try:
-        if file_path.endswith('.csv'):
-            df = pd.read_csv(file_path)
-        else:
-            df = pd.read_excel(file_path)
+        header_row = next(wb.worksheets[0].iter_rows(values_only=True), None)
+        return dedup_column_names(list(header_row)) if header_row is not None else None
+    finally:
+        wb.close()
+
+def referenced_positions(header, config=None):
+    """Positions of the header columns the config (or detected format) actually uses."""
+    return compile_sheet_schema(header, config)['positions']
+
+def _excel_cell(value):
+    # Same conversions pandas applies to openpyxl cells
+    if value is None:
+        return ''
+    if isinstance(value, float) and value.is_integer():
+        return int(value)
+    return value
+
+def read_sheet(file_path):
+    """The whole first sheet as one DataFrame. Cells are kept as written, exactly as
+       iter_sheet_chunks yields them, so a report doesn't depend on whether its input
+       was streamed (no whole-column type inference: '007' stays '007', and a numeric
+       column with blanks doesn't turn 11 into '11.0')."""
+    if file_path.endswith('.csv'):
+        return pd.read_csv(file_path, dtype=str, keep_default_na=False)
+    return pd.read_excel(file_path, dtype=object, keep_default_na=False)
+
+def iter_sheet_chunks(file_path, config=None, chunk_rows=None):
+    """Yields DataFrames of at most chunk_rows rows holding only the referenced columns.
+       CSVs are read with pandas chunksize, XLSX with openpyxl read-only row iteration.
+       Cells are kept as written (see read_sheet)."""
+    chunk_rows = chunk_rows or STREAMING_CHUNK_ROWS
+    if file_path.endswith('.csv'):
+        header = list(pd.read_csv(file_path, nrows=0).columns)
+        positions = referenced_positions(header, config)
+        if not positions:
+            return
+        names = [header[i] for i in positions]
+        for chunk in pd.read_csv(file_path, usecols=positions, dtype=str, keep_default_na=False, chunksize=chunk_rows):
+            chunk.columns = names
+            yield chunk
+        return
+
+    from openpyxl import load_workbook
+    wb = load_workbook(file_path, read_only=True, data_only=True)
+    try:
+        rows = wb.worksheets[0].iter_rows(values_only=True)
+        header_row = next(rows, None)
+        if header_row is None:
+            return
+        header = dedup_column_names(list(header_row))
+        positions = referenced_positions(header, config)
+        if not positions:
+            return
+        names = [header[i] for i in positions]
+        buffer = []
+        for row in rows:
+            buffer.append([_excel_cell(row[i]) if i < len(row) else '' for i in positions])
+            if len(buffer) >= chunk_rows:
+                yield pd.DataFrame(buffer, columns=names, dtype=object)
+                buffer = []
+        if buffer:
+            yield pd.DataFrame(buffer, columns=names, dtype=object)
+    finally:
+        wb.close()
+
+
+# ==========================================
+# 4. MAIN LOGIC
+# ==========================================
+
+def report_path_for(partner_name, output_dir=None):
+    safe_name = "".join([c if c.isalnum() else "_" for c in partner_name])
+    return os.path.join(output_dir or OUTPUT_DIR, f"Report_{safe_name}.pdf")
+
+def shard_path_for(partner_name, part, output_dir=None):
+    """File for one shard of a large partner: a numbered PDF in "parts" mode, a
+       temporary file next to the final report (not *.pdf) in "merge" mode."""
+    final = report_path_for(partner_name, output_dir)
+    if PARTNER_SHARD_MODE == "parts":
+        return f"{final[:-4]}_part{part:02d}.pdf"
+    return f"{final}.part{part:02d}"
+
+def shard_batches(p_batches):
+    """Splits a partner's batches into PARTNER_SHARD_BATCHES-sized shards ([p_batches] if not sharded)."""
+    if PARTNER_SHARD_MODE not in ("merge", "parts") or len(p_batches) <= PARTNER_SHARD_BATCHES:
+        return [p_batches]
+    return [p_batches[i:i + PARTNER_SHARD_BATCHES] for i in range(0, len(p_batches), PARTNER_SHARD_BATCHES)]
+
+def merge_pdfs(paths, output_filename):
+    """Concatenates PDFs into output_filename and deletes the inputs. Top-level for the process pool."""
+    start = time.perf_counter()
+    try:
+        if os.path.exists(output_filename):
+            os.remove(output_filename)
+        writer = PdfWriter()
+        for path in paths:
+            writer.append(path)
+        # Images repeated across shards are stored once in the merged file
+        writer.compress_identical_objects(remove_identicals=True, remove_orphans=True)
+        with open(output_filename, 'wb') as f:
+            writer.write(f)
+        print(f"Successfully merged {len(paths)} parts: {output_filename}")
+        result = output_filename
     except Exception as e:
-        return False, f"Failed to read file: {str(e)}", []
+        print(f"Failed to merge {output_filename}: {e}")
+        result = None
+    finally:
+        for path in paths:
+            if os.path.exists(path):
+                os.remove(path)
+    return result, time.perf_counter() - start
 
-    # Basic cleanup
-    df = df.fillna('')
-    
-    # Create a mapping of normalized column names to actual column names
-    df_cols_map = {normalize_name(col): col for col in df.columns}
-    
-    partners = {}
+def render_partner_report(p_name, p_batches, image_map, output_dir=None, output_filename=None):
+    """Renders one partner's report (to output_filename if given, e.g. a shard).
+       Top-level so it can run on a process pool."""
+    f_name = output_filename or report_path_for(p_name, output_dir)
+    try:
+        # Unlink first: an old report may be a hard link into REPORT_STORE_DIR,
+        # and writing through it would overwrite the stored copy
+        if os.path.exists(f_name):
+            os.remove(f_name)
+        return create_partner_pdf(p_name, p_batches, f_name, image_map=image_map)
+    except Exception as e:
+        print(f"Error generating PDF for {p_name}: {e}")
+        return None
+
+def timed_render_partner_report(p_name, p_batches, image_map, output_dir=None, output_filename=None):
+    """render_partner_report plus its duration, measured inside the worker: (path, seconds)."""
+    start = time.perf_counter()
+    path = render_partner_report(p_name, p_batches, image_map, output_dir, output_filename)
+    return path, time.perf_counter() - start
+
+def spill_image(url, data, target_dir):
+    """Writes one image to target_dir and returns its path."""
+    path = os.path.join(target_dir, hashlib.sha256(url.encode('utf-8')).hexdigest() + ".img")
+    with open(path, 'wb') as f:
+        f.write(data)
+    return path
+
+def request_image(fetcher, url):
+    """Future of the embeddable bytes for url (None if it failed). Already prepared
+       images resolve immediately from PREPARED_IMAGE_CACHE; the rest go on the fetch queue."""
+    if IMAGE_PREPARE:
+        cached = PREPARED_IMAGE_CACHE.get(prepared_cache_key(url))
+        if cached is not None:
+            future = concurrent.futures.Future()
+            future.set_result(cached)
+            return future
+        return fetcher.submit(url, transform=prepare_downloaded_image)
+    return fetcher.submit(url)
+
+_report_manifest = None
+_report_manifest_lock = threading.Lock()
+
+def get_report_manifest():
+    global _report_manifest
+    with _report_manifest_lock:
+        if _report_manifest is None:
+            _report_manifest = ReportManifest(REPORT_STORE_DIR)
+        return _report_manifest
+
+def render_settings_salt():
+    """Everything besides the batch data that changes how a PDF looks."""
+    return json.dumps([REPORT_LAYOUT_VERSION, IMAGE_PREPARE, IMAGE_DPI, IMAGE_JPEG_QUALITY,
+                       IMAGE_CELL_WIDTH, IMAGE_CELL_HEIGHT, PARTNER_SHARD_MODE == "parts"])
+
+def reuse_unchanged_reports(partners, manifest, output_dir=None):
+    """Copies stored PDFs for partners whose fingerprint matches the manifest.
+       Returns ({partner: reused path}, {partner: fingerprint} for every partner)."""
+    salt = render_settings_salt()
+    fingerprints = {p_name: manifest.fingerprint(p_batches, salt) for p_name, p_batches in partners.items()}
+    reused = {}
+    out_dir = output_dir or OUTPUT_DIR
+    if not os.path.exists(out_dir):
+        os.makedirs(out_dir)
+    for p_name, fingerprint in fingerprints.items():
+        target = report_path_for(p_name, output_dir)
+        if manifest.reuse(p_name, fingerprint, target):
+            reused[p_name] = target
+    if reused:
+        manifest.save()
+    return reused, fingerprints
+
+def record_rendered_reports(partners, rendered_files, fingerprints, image_futures, manifest, output_dir=None):
+    """Adds freshly rendered reports to the manifest. Reports with a failed image are
+       skipped so the next run retries them instead of reusing the placeholder."""
+    rendered = set(rendered_files)
+    for p_name, p_batches in partners.items():
+        path = report_path_for(p_name, output_dir)
+        if path not in rendered:
+            continue
+        try:
+            complete = all(image_futures[url].result() is not None for url in collect_image_urls(p_batches))
+        except Exception:
+            complete = False
+        if complete:
+            manifest.record(p_name, fingerprints[p_name], path)
+
+def write_failed_images_report(partners, failures, output_dir=None):
+    """Writes FAILED_IMAGES_REPORT: one line per failed image (partner, batch, stage, URL,
+       reason) so broken links can be fixed at the source. Returns the number of failed
+       URLs and the report path (None, and any old report removed, if nothing failed)."""
+    path = os.path.join(output_dir or OUTPUT_DIR, FAILED_IMAGES_REPORT)
+    rows = []
+    for p_name, p_batches in partners.items():
+        for batch in p_batches:
+            for item in batch['images']:
+                url = item['image']
+                if isinstance(url, str) and url in failures:
+                    rows.append([p_name, batch['meta'].get('inventoryId', ''), batch['meta'].get('date', ''),
+                                 item['stage'], url, failures[url]])
+    if not rows:
+        if os.path.exists(path):
+            os.remove(path)
+        return 0, None
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    with open(path, 'w', newline='', encoding='utf-8') as f:
+        writer = csv.writer(f)
+        writer.writerow(['Partner Name', 'Batch Kiln ID', 'Production Date', 'Stage', 'Image URL', 'Reason'])
+        writer.writerows(rows)
+    return len({row[4] for row in rows}), path
+
+def sheet_cache_salt(streaming, config=None):
+    """What a cached parse depends on besides the file: reader, versions and, when
+       streaming (only referenced columns are kept), the sheet format(s) in use."""
+    parts = [SHEET_CACHE_VERSION, pd.__version__, "stream" if streaming else "full"]
+    if streaming:
+        parts.append(config if config is not None else sorted(SHEET_FORMATS.items()))
+    return json.dumps(parts, default=str)
+
+def use_streaming(file_path):
+    return INGEST_MODE == "stream" or (INGEST_MODE == "auto" and os.path.getsize(file_path) >= STREAMING_MIN_BYTES)
+
+def read_sheet_frames(file_path, config=None, streaming=False):
+    """The input as DataFrames: one for the whole sheet, or referenced-column chunks when
+       streaming. Served from SHEET_CACHE when this exact file was read before."""
+    key = None
+    if SHEET_CACHE is not None:
+        key = SHEET_CACHE.key(file_path, sheet_cache_salt(streaming, config))
+        cached = SHEET_CACHE.load(key)
+        if cached is not None:
+            print(f"Using cached parse of {file_path}")
+            return cached
+
+    if streaming:
+        frames = iter_sheet_chunks(file_path, config)
+    else:
+        frames = iter([read_sheet(file_path)])
+    if key is not None:
+        frames = SHEET_CACHE.store(key, frames)
+    return frames
+
+def iter_rejection_chunks(file_path, config=None, progress_callback=None, timings=None):
+    """Yields (partners, stats) for each chunk of the input file: a single chunk when the
+       whole sheet is loaded, many when streaming (see INGEST_MODE).
+       Time spent reading and extracting is added to timings ('read', 'extract')."""
+    timings = timings or StageTimer()
+    streaming = use_streaming(file_path)
+    if streaming:
+        print("Streaming rows...")
+        rows = 0
+        with timings.stage('read'):
+            chunks = read_sheet_frames(file_path, config, streaming=True)
+        while True:
+            with timings.stage('read'):
+                chunk = next(chunks, None)
+            if chunk is None:
+                break
+            rows += len(chunk)
+            if progress_callback: progress_callback(f"Processing rows... ({rows} read)")
+            with timings.stage('extract'):
+                result = extract_rejections(chunk, config)
+            yield result
+        return
+
+    with timings.stage('read'):
+        frames = read_sheet_frames(file_path, config)
+        df = next(frames)
+        next(frames, None)  # completes the cache entry
     print("Processing rows...")
     if progress_callback: progress_callback(f"Processing {len(df)} rows...")
+    with timings.stage('extract'):
+        result = extract_rejections(df, config)
+    yield result
 
-    errors = 0
-    skipped_no_rejections = 0
-    
-    for index, row in df.iterrows():
-        try:
-            # Determine Partner Name
-            partner_col = config['meta_map']['partner']
-            partner_name = str(safe_get(row, partner_col, df_cols_map)).strip()
-            
-            if not partner_name or partner_name.lower() in ['nan', '']:
-                continue
-                
-            if partner_name not in partners:
-                partners[partner_name] = []
+def format_eta(eta_seconds):
+    if eta_seconds < 60:
+        return f"{int(eta_seconds)}s"
+    return f"{int(eta_seconds // 60)}m {int(eta_seconds % 60)}s"
 
-            rejected_images = []
-            row_has_rejection_mark = False
-            
-            # Check for rejections based on config
-            for status_col, status_val, stage_name, img_col, reason_col in config['checks']:
-                actual_status = str(safe_get(row, status_col, df_cols_map)).strip().lower()
-                expected_status = str(status_val).strip().lower()
-                
-                # Check status (Case Insensitive)
-                if actual_status == expected_status:
-                    row_has_rejection_mark = True
-                    img_url = safe_get(row, img_col, df_cols_map)
-                    reason = str(safe_get(row, reason_col, df_cols_map) or 'No Reason Provided')
-                    
-                    # Store rejection (even if image is empty, we'll handle it in PDF)
-                    rejected_images.append({'stage': stage_name, 'image': img_url, 'reason': reason})
-
-            if row_has_rejection_mark:
-                # Extract Meta Data
-                batch_meta = {}
-                for key, col_name in config['meta_map'].items():
-                    val = safe_get(row, col_name, df_cols_map)
-                    batch_meta[key] = str(val).strip()
-                
-                partners[partner_name].append({'meta': batch_meta, 'images': rejected_images})
-            else:
-                skipped_no_rejections += 1
-                
-        except Exception as row_error:
-            errors += 1
-            print(f"Error processing row {index}: {row_error}")
-            continue
+_render_pool = None
+_render_pool_lock = threading.Lock()
 
-    generated_files = []
-    print(f"Found {len(partners)} partners with rejections. (Total Rows: {len(df)}, Errors: {errors}, No Rejections: {skipped_no_rejections})")
-    if progress_callback: progress_callback(f"Found {len(partners)} partners. Generating PDFs...", percent=5)
+def get_render_pool():
+    """The process pool for PDF_RENDER_MODE = "process", started on first use."""
+    global _render_pool
+    with _render_pool_lock:
+        if _render_pool is None:
+            context = multiprocessing.get_context(PDF_RENDER_START_METHOD)
+            _render_pool = concurrent.futures.ProcessPoolExecutor(max_workers=PDF_RENDER_WORKERS, mp_context=context)
+        return _render_pool
 
-    if not os.path.exists(OUTPUT_DIR):
-        os.makedirs(OUTPUT_DIR)
+def discard_render_pool(pool=None):
+    """Shuts the render pool down (only if it is still `pool`, when given); the next
+       render starts a new one. Used at exit and after a worker crash broke the pool."""
+    global _render_pool
+    with _render_pool_lock:
+        if _render_pool is None or (pool is not None and _render_pool is not pool):
+            return
+        pool, _render_pool = _render_pool, None
+    pool.shutdown(wait=True, cancel_futures=True)
 
+def render_reports(partners, image_futures, progress_callback=None, report_callback=None, output_dir=None,
+                   event_callback=None, timings=None):
+    """Consumer side of the pipeline: each partner (or shard of a large partner, see
+       PARTNER_SHARD_MODE) is handed to the render pool as soon as all of its image
+       futures have resolved, while other downloads continue.
+       report_callback(path) is called (on this thread) as each PDF finishes.
+       event_callback(event, data) receives structured 'images' and 'partner' events.
+       timings gets the summed render time ('render') and the end of 'image_fetch'."""
+    timings = timings or StageTimer()
     total_partners = len(partners)
+    if not total_partners:
+        return []
+    output_dir = output_dir or OUTPUT_DIR
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+
+    spill_dir = None
+    spilled = {}
+    lock = threading.Lock()
+    if PDF_RENDER_MODE == "process":
+        # Workers read images from disk; only partner batches and paths are pickled
+        spill_dir = tempfile.mkdtemp(prefix="report_images_")
+        executor = get_render_pool()
+    else:
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=PDF_RENDER_WORKERS)
+
+    done_queue = queue.Queue()
+    # Render jobs: (partner, part) -> batches. part is None for a partner rendered whole.
+    jobs = {}
+    shards_left = {}
+    shard_files = {}
+    for p_name, p_batches in partners.items():
+        shards = shard_batches(p_batches)
+        if len(shards) == 1:
+            jobs[(p_name, None)] = p_batches
+        else:
+            print(f"Splitting {p_name} ({len(p_batches)} batches) into {len(shards)} shards.")
+            for part, shard in enumerate(shards, start=1):
+                jobs[(p_name, part)] = shard
+            shards_left[p_name] = len(shards)
+            shard_files[p_name] = [None] * len(shards)
+    job_urls = {job: collect_image_urls(batches) for job, batches in jobs.items()}
+    waiting = {job: len(urls) for job, urls in job_urls.items()}
+    images_done = [0]
+
+    def job_images(job):
+        images = {}
+        for url in job_urls[job]:
+            try:
+                data = image_futures[url].result()
+            except Exception as e:
+                print(f"Failed to download {url}: {e}")
+                data = None
+            if data is None:
+                continue
+            if spill_dir is None:
+                images[url] = data
+            else:
+                with lock:
+                    if url not in spilled:
+                        spilled[url] = spill_image(url, data, spill_dir)
+                    images[url] = spilled[url]
+        return images
+
+    def failed(job, error):
+        future = concurrent.futures.Future()
+        future.set_exception(error)
+        RENDER_QUEUE.inc()
+        done_queue.put((job, future))
+
+    submitted = []
+
+    def submit(job, fn, *args):
+        try:
+            future = executor.submit(fn, *args)
+        except Exception as e:
+            failed(job, e)
+            return
+        submitted.append(future)
+        RENDER_QUEUE.inc()
+        future.add_done_callback(lambda f: done_queue.put((job, f)))
+
+    def start_render(job):
+        # Usually runs in an image future's done-callback, which swallows exceptions:
+        # a job that can't be started is reported as failed so the loop below ends.
+        p_name, part = job
+        try:
+            output_filename = shard_path_for(p_name, part, output_dir) if part else None
+            images = job_images(job)
+        except Exception as e:
+            failed(job, e)
+            return
+        submit(job, timed_render_partner_report, p_name, jobs[job], images, output_dir, output_filename)
+
+    def image_resolved(job):
+        with lock:
+            waiting[job] -= 1
+            ready = waiting[job] == 0
+        if ready:
+            start_render(job)
+
+    def count_image(_future):
+        with lock:
+            images_done[0] += 1
+            done = images_done[0]
+        if done == total_images:
+            timings.stop('image_fetch')
+        if event_callback:
+            event_callback("images", {"done": done, "total": total_images})
+
+    generated_files = []
     completed_count = 0
+    completed_jobs = 0
+    total_jobs = len(jobs)
+    total_images = len(image_futures)
     start_time = time.time()
+
+    def report_progress():
+        image_frac = images_done[0] / total_images if total_images else 1
+        percent = 5 + int(image_frac * 25) + int((completed_jobs / total_jobs) * 65)  # 5% to 95%
+        if completed_jobs == 0:
+            msg = f"Downloading validation images ({images_done[0]}/{total_images})..."
+            if progress_callback: progress_callback(msg, percent=percent)
+            return
+        elapsed = time.time() - start_time
+        eta_str = format_eta((total_jobs - completed_jobs) * (elapsed / completed_jobs))
+        msg = f"Generated {completed_count}/{total_partners} reports"
+        if images_done[0] < total_images:
+            msg += f" (images {images_done[0]}/{total_images})"
+        print(f"{msg}... ETA: {eta_str}")
+        if progress_callback:
+            progress_callback(msg, percent=percent, eta=eta_str)
+
+    def finish_partner(p_name, results):
+        nonlocal completed_count
+        completed_count += 1
+        for result in results:
+            generated_files.append(result)
+            if report_callback:
+                report_callback(result)
+        if event_callback:
+            event_callback("partner", {"partner": p_name, "ok": bool(results),
+                                       "completed": completed_count, "total": total_partners})
+
+    def shard_done(p_name, part, result):
+        """Collects a finished shard; once all of a partner's shards are in, the partner
+           is either merged (on the pool) or finished with its numbered parts."""
+        shard_files[p_name][part - 1] = result
+        shards_left[p_name] -= 1
+        if shards_left[p_name]:
+            return
+        files = shard_files[p_name]
+        if PARTNER_SHARD_MODE == "parts":
+            finish_partner(p_name, files if all(files) else [])
+        elif all(files):
+            submit((p_name, "merge"), merge_pdfs, files, report_path_for(p_name, output_dir))
+        else:
+            print(f"Error generating PDF for {p_name}: {files.count(None)} shard(s) failed")
+            for path in files:
+                if path and os.path.exists(path):
+                    os.remove(path)
+            finish_partner(p_name, [])
+
+    try:
+        for future in image_futures.values():
+            future.add_done_callback(count_image)
+        for job, urls in job_urls.items():
+            if not urls:
+                start_render(job)
+            for url in urls:
+                image_futures[url].add_done_callback(lambda _f, j=job: image_resolved(j))
+
+        while completed_count < total_partners:
+            try:
+                (p_name, part), future = done_queue.get(timeout=1)
+            except queue.Empty:
+                report_progress()
+                continue
+            RENDER_QUEUE.dec()
+            try:
+                result, seconds = future.result()
+                timings.add('merge' if part == "merge" else 'render', seconds)
+                if part != "merge":
+                    PARTNER_RENDER_SECONDS.observe(seconds)
+            except Exception as e:
+                # A crashed worker process surfaces here (BrokenProcessPool)
+                print(f"Error generating PDF for {p_name}: {e}")
+                result = None
+            if part is None or part == "merge":
+                finish_partner(p_name, [result] if result else [])
+            else:
+                completed_jobs += 1
+                shard_done(p_name, part, result)
+            if part is None:
+                completed_jobs += 1
+            report_progress()
+    finally:
+        if spill_dir is None:
+            executor.shutdown(wait=True)
+        else:
+            # The pool outlives this call: drop what's left of this run (after an error)
+            # and let running renders finish before their images are removed
+            for future in list(submitted):
+                future.cancel()
+            concurrent.futures.wait(list(submitted))
+            if any(not f.cancelled() and isinstance(f.exception(), concurrent.futures.BrokenExecutor)
+                   for f in submitted):
+                discard_render_pool(executor)
+            shutil.rmtree(spill_dir, ignore_errors=True)
+
+    return generated_files
+
+def process_data_and_generate_reports(file_path, progress_callback=None, report_callback=None, output_dir=None,
+                                      event_callback=None, timings=None):
+    """Runs the pipeline: rows -> rejection records -> image fetch queue -> per-partner renderers.
+       Image downloads start while rows are still being read, and each partner's PDF is
+       rendered as soon as its own images are ready. report_callback(path) is called as
+       each PDF is written (e.g. to add it to the ZIP straight away). PDFs go to output_dir
+       (default OUTPUT_DIR). event_callback(event, data) gets per-partner completion
+       and image download count events. timings (a StageTimer) collects per-stage durations."""
+    timings = timings or StageTimer()
+    pipeline_start = time.perf_counter()
+    config = None  # sheet format is detected from the header row
     
-    # Helper for parallel execution
-    def process_one_partner(item):
-        p_name, p_batches = item
-        safe_name = "".join([c if c.isalnum() else "_" for c in p_name])
-        f_name = os.path.join(OUTPUT_DIR, f"Report_{safe_name}.pdf")
+    print(f"Reading data from {file_path}...")
+    if progress_callback: progress_callback("Reading data...")
+
+    partners = {}
+    stats = {'rows': 0, 'errors': 0, 'no_rejections': 0}
+    image_futures = {}
+    fetcher = make_image_fetcher()
+    try:
         try:
-            # Only pass progress callback if we have very few partners, otherwise it's too noisy/flickering
-            # or pass a lambda that doesn't overwrite percent
-            cb = progress_callback if len(partners) < 3 else None
-            res_path = create_partner_pdf(p_name, p_batches, f_name, progress_callback=cb)
-            return res_path
+            for chunk_partners, chunk_stats in iter_rejection_chunks(file_path, config, progress_callback, timings):
+                for name, batches in chunk_partners.items():
+                    partners.setdefault(name, []).extend(batches)
+                    for url in collect_image_urls(batches):
+                        if url not in image_futures:
+                            timings.start('image_fetch')
+                            image_futures[url] = request_image(fetcher, url)
+                for key in stats:
+                    stats[key] += chunk_stats[key]
         except Exception as e:
-            print(f"Error generating PDF for {p_name}: {e}")
-            return None
-
-    # Use ThreadPoolExecutor for parallel PDF generation
-    # Adjust max_workers as needed (5-10 implies 5-10 concurrent PDF generations)
-    with concurrent.futures.ThreadPoolExecutor(max_workers=5) as executor:
-        futures = {executor.submit(process_one_partner, item): item for item in partners.items()}
-        
-        for future in concurrent.futures.as_completed(futures):
-            completed_count += 1
-            result = future.result()
-            if result:
-                generated_files.append(result)
-            
-            # Progress Logic
-            percent = 5 + int((completed_count / total_partners) * 90) # 5% to 95%
-            
-            # ETA Logic
-            elapsed = time.time() - start_time
-            avg_time_per_item = elapsed / completed_count
-            remaining = total_partners - completed_count
-            eta_seconds = remaining * avg_time_per_item
-            
-            # Format ETA
-            if eta_seconds < 60:
-                eta_str = f"{int(eta_seconds)}s"
-            else:
-                eta_str = f"{int(eta_seconds // 60)}m {int(eta_seconds % 60)}s"
+            return False, f"Failed to read file: {str(e)}", []
+
+        errors = stats['errors']
+        skipped_no_rejections = stats['no_rejections']
+        print(f"Found {len(partners)} partners with rejections. (Total Rows: {stats['rows']}, Errors: {errors}, No Rejections: {skipped_no_rejections})")
+        if progress_callback: progress_callback(f"Found {len(partners)} partners. Generating PDFs...", percent=5)
+
+        reused, fingerprints, manifest = {}, {}, None
+        if INCREMENTAL_REPORTS:
+            manifest = get_report_manifest()
+            reused, fingerprints = reuse_unchanged_reports(partners, manifest, output_dir)
+        to_render = {p_name: p_batches for p_name, p_batches in partners.items() if p_name not in reused}
+        if reused:
+            # Downloads only reused partners needed can be dropped
+            needed_urls = set()
+            for p_batches in to_render.values():
+                needed_urls.update(collect_image_urls(p_batches))
+            for url in list(image_futures):
+                if url not in needed_urls:
+                    image_futures.pop(url).cancel()
+            for p_name, path in reused.items():
+                if report_callback:
+                    report_callback(path)
+                if event_callback:
+                    event_callback("partner", {"partner": p_name, "ok": True, "reused": True})
+        print(f"Reusing {len(reused)} unchanged reports, rendering {len(to_render)}.")
 
-            msg = f"Generated {completed_count}/{total_partners} reports"
-            print(f"{msg}... ETA: {eta_str}")
-            if progress_callback: 
-                progress_callback(msg, percent=percent, eta=eta_str)
+        rendered_files = render_reports(to_render, image_futures, progress_callback, report_callback, output_dir,
+                                        event_callback, timings)
+        if manifest is not None:
+            record_rendered_reports(to_render, rendered_files, fingerprints, image_futures, manifest, output_dir)
+        generated_files = list(reused.values()) + rendered_files
+
+        failed_images, failed_report = write_failed_images_report(to_render, fetcher.failures, output_dir)
+        if failed_report:
+            print(f"{failed_images} image(s) could not be downloaded, listed in {failed_report}")
+            if report_callback:
+                report_callback(failed_report)
+    finally:
+        fetcher.close(cancel_pending=True)
+        IMAGE_HEALTH.save()
+        timings.stop('image_fetch')
+        timings.add('total', time.perf_counter() - pipeline_start)
+        timings.observe(STAGE_SECONDS)
+
+    print(f"Stage timings: {timings.snapshot()}")
+    print(f"Image cache: {IMAGE_CACHE.stats()}")
+    print(f"Prepared image cache: {PREPARED_IMAGE_CACHE.stats()}")
 
     if generated_files:
-        return True, "Reports generated successfully.", generated_files
+        failed_note = f" {failed_images} image(s) could not be downloaded (see {FAILED_IMAGES_REPORT})." if failed_images else ""
+        if INCREMENTAL_REPORTS:
+            return True, f"Reports generated successfully ({len(reused)} reused, {len(rendered_files)} rebuilt).{failed_note}", generated_files
+        return True, f"Reports generated successfully.{failed_note}", generated_files
     else:
         if errors > 0:
             return True, f"Processed with {errors} row errors. No rejections found.", []
         return True, "No rejections found in the data. No reports generated.", []
 
+# ==========================================
+# 5. COMMAND LINE
+# ==========================================
+def expand_inputs(paths):
+    """Input files for the given files, directories (their .xlsx/.csv files) and glob patterns."""
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            matches = sorted(glob.glob(os.path.join(path, '*.xlsx')) + glob.glob(os.path.join(path, '*.csv')))
+        else:
+            matches = sorted(glob.glob(path)) or [path]
+        for match in matches:
+            # Skip Excel's lock files for open workbooks
+            if not os.path.basename(match).startswith('~$') and match not in files:
+                files.append(match)
+    return files
+
+def cli_output_dirs(files, output_dir):
+    """One folder per input (named after the file) when there are several inputs."""
+    if len(files) == 1:
+        return {files[0]: output_dir}
+    dirs, used = {}, set()
+    for file_path in files:
+        name = os.path.splitext(os.path.basename(file_path))[0]
+        candidate, n = name, 2
+        while candidate in used:
+            candidate, n = f"{name}_{n}", n + 1
+        used.add(candidate)
+        dirs[file_path] = os.path.join(output_dir, candidate)
+    return dirs
+
+def main(argv=None):
+    global SHEET_CACHE
+    parser = argparse.ArgumentParser(
+        description="Generate partner rejection reports from .xlsx/.csv files without the web server.")
+    parser.add_argument('inputs', nargs='+', help="input files, directories or glob patterns")
+    parser.add_argument('-o', '--output-dir', default=OUTPUT_DIR,
+                        help=f"where reports are written, one subfolder per input when there are several (default: {OUTPUT_DIR})")
+    parser.add_argument('--convert-only', action='store_true',
+                        help="only parse the inputs into the sheet cache, so later runs skip parsing")
+    parser.add_argument('--no-sheet-cache', action='store_true', help="always parse inputs, don't read or write the sheet cache")
+    args = parser.parse_args(argv)
+
+    if SHEET_CACHE_ENABLED and not args.no_sheet_cache:
+        SHEET_CACHE = SheetCache(SHEET_CACHE_DIR, max_bytes=SHEET_CACHE_MAX_BYTES)
+    files = expand_inputs(args.inputs)
+    missing = [f for f in files if not os.path.isfile(f)]
+    if missing:
+        parser.error(f"no such file: {', '.join(missing)}")
+    if not files:
+        parser.error("no .xlsx/.csv inputs found")
+
+    failed = 0
+    run_start = time.perf_counter()
+    output_dirs = cli_output_dirs(files, args.output_dir)
+    for n, file_path in enumerate(files, 1):
+        print(f"[{n}/{len(files)}] {file_path}")
+        start = time.perf_counter()
+        try:
+            if args.convert_only:
+                rows = sum(len(frame) for frame in read_sheet_frames(file_path, streaming=use_streaming(file_path)))
+                success, message, reports = True, f"{rows} rows cached.", []
+            else:
+                success, message, reports = process_data_and_generate_reports(file_path, output_dir=output_dirs[file_path])
+        except Exception as e:
+            traceback.print_exc()
+            success, message, reports = False, str(e), []
+        failed += not success
+        location = "" if args.convert_only else f" -> {output_dirs[file_path]}"
+        print(f"[{n}/{len(files)}] {'OK' if success else 'FAILED'}: {message} "
+              f"({len(reports)} reports, {time.perf_counter() - start:.1f}s){location}")
+
+    discard_render_pool()
+    print(f"Processed {len(files)} file(s) in {time.perf_counter() - run_start:.1f}s, {failed} failed.")
+    if SHEET_CACHE is not None:
+        print(f"Sheet cache: {SHEET_CACHE.stats()}")
+    return 1 if failed else 0
+
 if __name__ == "__main__":
-    pass
\ No newline at end of file
+    sys.exit(main())
\ No newline at end of file
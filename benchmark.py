@@ -0,0 +1,426 @@
+import argparse
+import concurrent.futures
+import http.server
+import json
+import os
+import random
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+from io import BytesIO
+
+import pandas as pd
+from PIL import Image
+from reportlab import rl_config
+from reportlab.lib import colors
+from reportlab.lib.pagesizes import A4
+from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
+from reportlab.lib.units import inch
+from reportlab.platypus import SimpleDocTemplate, Table, TableStyle, Paragraph, Image as RLImage, Spacer, PageBreak
+
+import automation
+from automation import SHEET_CONFIG, extract_rejections, safe_get, normalize_name
+from image_cache import ImageCache
+from image_health import ImageHealth
+from zip_stream import stream_zip
+
+# ==========================================
+# SYNTHETIC DATA
+# ==========================================
+def make_synthetic_sheet(rows, partners=50, rejection_rate=0.2, seed=0, image_base_url=None, image_pool=None):
+    """Builds a Looker-style DataFrame with the columns referenced by SHEET_CONFIG.
+       rejection_rate is roughly the fraction of rows with at least one rejection.
+       With image_pool=N, image URLs are drawn from N images under image_base_url,
+       so the same photo is reused across rows and partners."""
+    rng = random.Random(seed)
+    image_base_url = image_base_url or "http://images.local"
+    partner_names = [f"Partner {i}" for i in range(partners)]
+    data = {col_name: [] for col_name in SHEET_CONFIG['meta_map'].values()}
+    for status_col, _, _, img_col, reason_col in SHEET_CONFIG['checks']:
+        data[status_col] = []
+        data[img_col] = []
+        data[reason_col] = []
+
+    for i in range(rows):
+        meta = SHEET_CONFIG['meta_map']
+        data[meta['partner']].append(rng.choice(partner_names))
+        data[meta['inventoryId']].append(f"BATCH-{i}")
+        data[meta['date']].append("2024-01-01")
+        data[meta['time']].append("10:00")
+        data[meta['kilnId']].append(f"K-{i % 300}")
+        data[meta['artisan']].append(f"Artisan {i % 800}")
+        data[meta['slot']].append(f"Facility {i % 40}")
+        for n, (status_col, status_val, _, img_col, reason_col) in enumerate(SHEET_CONFIG['checks']):
+            rejected = rng.random() < rejection_rate / len(SHEET_CONFIG['checks'])
+            ok_val = 'Yes' if status_val == 'No' else 'Approved'
+            data[status_col].append(f" {status_val.upper()} " if rejected else ok_val)
+            if image_pool:
+                data[img_col].append(f"{image_base_url}/img/{rng.randrange(image_pool)}.jpg")
+            else:
+                data[img_col].append(f"{image_base_url}/img/{i}-{n}.jpg")
+            data[reason_col].append("Blurry photo" if rejected and rng.random() < 0.7 else None)
+
+    return pd.DataFrame(data)
+
+# ==========================================
+# LOCAL IMAGE SERVER
+# ==========================================
+class ImageServer:
+    """Stand-in image host on 127.0.0.1 serving /img/<n>.jpg.
+       latency (seconds) is added to every response; failure_rate is the share of
+       requests answered with HTTP 500, so retries and placeholders get exercised."""
+
+    def __init__(self, image_size=(1600, 1200), latency=0.0, failure_rate=0.0, seed=0):
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.requests = 0
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+        buf = BytesIO()
+        Image.effect_noise(image_size, 64).convert('RGB').save(buf, format='JPEG', quality=90)
+        self.image_bytes = buf.getvalue()
+        server = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                with server._lock:
+                    server.requests += 1
+                    fail = server._rng.random() < server.failure_rate
+                if server.latency:
+                    time.sleep(server.latency)
+                if fail or not self.path.startswith('/img/'):
+                    self.send_response(500 if fail else 404)
+                    self.send_header('Content-Length', '0')
+                    self.end_headers()
+                    return
+                self.send_response(200)
+                self.send_header('Content-Type', 'image/jpeg')
+                self.send_header('Content-Length', str(len(server.image_bytes)))
+                self.end_headers()
+                self.wfile.write(server.image_bytes)
+
+            def log_message(self, *args):
+                pass
+
+        class Server(http.server.ThreadingHTTPServer):
+            request_queue_size = 1024  # the default backlog of 5 throttles concurrent fetchers
+
+        self._httpd = Server(('127.0.0.1', 0), Handler)
+        self._httpd.daemon_threads = True
+        self.base_url = f"http://127.0.0.1:{self._httpd.server_address[1]}"
+
+    def __enter__(self):
+        threading.Thread(target=self._httpd.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *exc):
+        self._httpd.shutdown()
+        self._httpd.server_close()
+
+# ==========================================
+# REFERENCE (pre-vectorization) EXTRACTION
+# ==========================================
+def legacy_extract_rejections(df, config=None):
+    """The original df.iterrows() loop, kept only to measure against."""
+    config = config or SHEET_CONFIG
+    df = df.fillna('')
+    df_cols_map = {normalize_name(col): col for col in df.columns}
+    partners = {}
+    for _, row in df.iterrows():
+        partner_name = str(safe_get(row, config['meta_map']['partner'], df_cols_map)).strip()
+        if not partner_name or partner_name.lower() in ['nan', '']:
+            continue
+        if partner_name not in partners:
+            partners[partner_name] = []
+        rejected_images = []
+        for status_col, status_val, stage_name, img_col, reason_col in config['checks']:
+            actual_status = str(safe_get(row, status_col, df_cols_map)).strip().lower()
+            if actual_status == str(status_val).strip().lower():
+                img_url = safe_get(row, img_col, df_cols_map)
+                reason = str(safe_get(row, reason_col, df_cols_map) or 'No Reason Provided')
+                rejected_images.append({'stage': stage_name, 'image': img_url, 'reason': reason})
+        if rejected_images:
+            batch_meta = {key: str(safe_get(row, col_name, df_cols_map)).strip()
+                          for key, col_name in config['meta_map'].items()}
+            partners[partner_name].append({'meta': batch_meta, 'images': rejected_images})
+    return partners
+
+# ==========================================
+# REFERENCE (per-report styles) FLOWABLES
+# ==========================================
+def legacy_build_report_elements(batches, image_map):
+    """The original create_partner_pdf flowable code: styles per report, a new
+       TableStyle per header/cell/row and a new image reader per cell. Kept only to measure against."""
+    styles = getSampleStyleSheet()
+    style_header_text = ParagraphStyle('HeaderVal', parent=styles['Normal'], fontSize=9, leading=11)
+    style_header_lbl = ParagraphStyle('HeaderLbl', parent=styles['Normal'], fontSize=9, leading=11, fontName='Helvetica-Bold')
+    style_reason = ParagraphStyle('Reason', parent=styles['Normal'], textColor=colors.red, fontSize=10, leading=12)
+    style_stage = ParagraphStyle('Stage', parent=styles['Normal'], textColor=colors.white, backColor=colors.darkgrey, fontSize=8, alignment=1, spaceBefore=4)
+
+    def build_header(meta):
+        header_data = [
+            [Paragraph('Partner Name:', style_header_lbl), Paragraph(str(meta.get('partner', '')), style_header_text),
+             Paragraph('Inventory/Batch ID:', style_header_lbl), Paragraph(str(meta.get('inventoryId', '')), style_header_text)],
+            [Paragraph('Date / Time:', style_header_lbl), Paragraph(f"{meta.get('date', '')} {meta.get('time', '')}", style_header_text),
+             Paragraph('Kiln ID:', style_header_lbl), Paragraph(str(meta.get('kilnId', '')), style_header_text)],
+            [Paragraph('Artisan/Name:', style_header_lbl), Paragraph(str(meta.get('artisan', '')), style_header_text),
+             Paragraph('Slot/Facility:', style_header_lbl), Paragraph(str(meta.get('slot', '')), style_header_text)],
+        ]
+        t_header = Table(header_data, colWidths=[1.2*inch, 2.5*inch, 1.2*inch, 2.0*inch])
+        t_header.setStyle(TableStyle([
+            ('BACKGROUND', (0, 0), (-1, -1), colors.whitesmoke),
+            ('GRID', (0, 0), (-1, -1), 0.5, colors.grey),
+            ('VALIGN', (0, 0), (-1, -1), 'MIDDLE'),
+            ('PADDING', (0, 0), (-1, -1), 6),
+        ]))
+        return t_header
+
+    def build_image_cell(item):
+        img_url = item['image']
+        if img_url in image_map:
+            img_flowable = RLImage(BytesIO(image_map[img_url]), width=automation.IMAGE_CELL_WIDTH, height=automation.IMAGE_CELL_HEIGHT)
+            img_flowable.hAlign = 'CENTER'
+        elif not img_url:
+            img_flowable = Paragraph("[No Image Link]", styles['Normal'])
+        else:
+            img_flowable = Paragraph("[Image Download Failed]", styles['Normal'])
+        stage_para = Paragraph(f"STAGE: {item['stage']}", style_stage)
+        reason_text = item.get('reason', '')
+        reason_para = Paragraph(f"Reason: {reason_text}", style_reason) if reason_text else Spacer(1, 1)
+        cell_table = Table([[img_flowable], [stage_para], [reason_para]], colWidths=[3.1*inch])
+        cell_table.setStyle(TableStyle([
+            ('BOX', (0, 0), (-1, -1), 1, colors.lightgrey),
+            ('ALIGN', (0, 0), (-1, -1), 'CENTER'),
+            ('VALIGN', (0, 0), (-1, -1), 'TOP'),
+            ('BOTTOMPADDING', (0, 0), (-1, -1), 10),
+        ]))
+        return cell_table
+
+    def build_image_row(pair):
+        row_cells = [build_image_cell(item) for item in pair]
+        if len(row_cells) < 2:
+            row_cells.append(Spacer(1, 1))
+        t_row = Table([row_cells], colWidths=[3.4*inch, 3.4*inch])
+        t_row.setStyle(TableStyle([
+            ('VALIGN', (0, 0), (-1, -1), 'TOP'),
+            ('LEFTPADDING', (0, 0), (-1, -1), 5),
+            ('RIGHTPADDING', (0, 0), (-1, -1), 5),
+            ('TOPPADDING', (0, 0), (-1, -1), 10),
+        ]))
+        return t_row
+
+    elements = []
+    for n, batch in enumerate(batches):
+        if n:
+            elements.append(PageBreak())
+        elements.append(Paragraph("Rejection Report", styles['Heading2']))
+        elements.append(build_header(batch['meta']))
+        elements.append(Spacer(1, 0.2*inch))
+        for i in range(0, len(batch['images']), 2):
+            elements.append(build_image_row(batch['images'][i:i+2]))
+    return elements
+
+# ==========================================
+# BENCHMARKS
+# ==========================================
+def bench_extraction(row_counts):
+    print(f"{'rows':>10} {'iterrows (s)':>14} {'columnar (s)':>14} {'speedup':>9}")
+    for rows in row_counts:
+        df = make_synthetic_sheet(rows)
+
+        start = time.perf_counter()
+        expected = legacy_extract_rejections(df)
+        legacy_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        partners, _ = extract_rejections(df)
+        columnar_time = time.perf_counter() - start
+
+        if partners != expected:
+            raise AssertionError(f"Columnar extraction differs from iterrows output at {rows} rows")
+        print(f"{rows:>10} {legacy_time:>14.3f} {columnar_time:>14.3f} {legacy_time / columnar_time:>8.1f}x")
+
+
+def bench_flowables(rows, partners, image_pool, seed=0):
+    """Per-batch cost of building flowables and running doc.build: per-report styles,
+       image readers and ASCII85 image streams (legacy) vs the shared template,
+       image reader cache and binary streams."""
+    df = make_synthetic_sheet(rows, partners, rejection_rate=0.5, seed=seed, image_pool=image_pool)
+    partners_map, _ = extract_rejections(df)
+    image_map = {}
+    for url in sorted({u for b in partners_map.values() for u in automation.collect_image_urls(b)}):
+        buf = BytesIO()
+        Image.effect_noise(automation.prepared_size(), 64).convert('RGB').save(buf, format='JPEG', quality=automation.IMAGE_JPEG_QUALITY)
+        image_map[url] = buf.getvalue()
+    total_batches = sum(len(b) for b in partners_map.values())
+
+    def run(build):
+        build_seconds = doc_seconds = 0.0
+        for p_batches in partners_map.values():
+            start = time.perf_counter()
+            elements = build(p_batches, image_map)
+            build_seconds += time.perf_counter() - start
+            start = time.perf_counter()
+            SimpleDocTemplate(BytesIO(), pagesize=A4, rightMargin=30, leftMargin=30, topMargin=30, bottomMargin=30).build(elements)
+            doc_seconds += time.perf_counter() - start
+        return build_seconds, doc_seconds
+
+    automation.IMAGE_READERS.clear()
+    rl_config.useA85 = 1  # ReportLab's default, as before PDF_ASCII85_STREAMS
+    try:
+        results = {'legacy': run(legacy_build_report_elements)}
+    finally:
+        rl_config.useA85 = int(automation.PDF_ASCII85_STREAMS)
+    results['template'] = run(automation.build_report_elements)
+    print(f"{total_batches} batches, {len(partners_map)} partners, {len(image_map)} distinct images")
+    print(f"{'':>10} {'flowables ms/batch':>19} {'doc.build ms/batch':>19} {'total ms/batch':>15}")
+    for name, (build_seconds, doc_seconds) in results.items():
+        print(f"{name:>10} {build_seconds / total_batches * 1000:>19.3f} {doc_seconds / total_batches * 1000:>19.3f}"
+              f" {(build_seconds + doc_seconds) / total_batches * 1000:>15.3f}")
+
+
+def git_version():
+    try:
+        return subprocess.run(['git', 'describe', '--always', '--dirty'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+def isolate_caches(work_dir):
+    """Points automation at empty caches/stores under work_dir so runs are cold and repeatable."""
+    automation.IMAGE_CACHE = ImageCache(os.path.join(work_dir, "image_cache"))
+    automation.PREPARED_IMAGE_CACHE = ImageCache(os.path.join(work_dir, "image_cache_prepared"))
+    automation.SHEET_CACHE = None
+    automation.IMAGE_HEALTH = ImageHealth(path=os.path.join(work_dir, "image_failures.json"))
+    automation.FETCH_ENGINE.health = automation.IMAGE_HEALTH
+    automation.INCREMENTAL_REPORTS = False
+
+def fetch_all_images(partners_map):
+    """Requests every image the way the pipeline does and waits for all of them.
+       Returns {url: resolved future}."""
+    fetcher = automation.make_image_fetcher()
+    try:
+        image_futures = {}
+        for p_batches in partners_map.values():
+            for url in automation.collect_image_urls(p_batches):
+                if url not in image_futures:
+                    image_futures[url] = automation.request_image(fetcher, url)
+        concurrent.futures.wait(image_futures.values())
+        return image_futures
+    finally:
+        fetcher.close()
+
+def timed(stages, name, fn, *args, **kwargs):
+    start = time.perf_counter()
+    result = fn(*args, **kwargs)
+    stages[name] = round(time.perf_counter() - start, 4)
+    return result
+
+def bench_pipeline(rows, partners, rejection_rate, image_pool, latency, failure_rate, file_format, seed=0):
+    """Times each stage separately (read, extraction, image fetch, render, zip), then the
+       whole pipeline end to end, against the local image server. Returns a result dict."""
+    work_dir = tempfile.mkdtemp(prefix="biochar_bench_")
+    stages = {}
+    counts = {}
+    try:
+        with ImageServer(latency=latency, failure_rate=failure_rate, seed=seed) as server:
+            df = make_synthetic_sheet(rows, partners, rejection_rate, seed, server.base_url, image_pool)
+            input_path = os.path.join(work_dir, f"input.{file_format}")
+            if file_format == 'csv':
+                df.to_csv(input_path, index=False)
+            else:
+                df.to_excel(input_path, index=False)
+            counts['input_bytes'] = os.path.getsize(input_path)
+            del df
+
+            # --- Staged run ---
+            isolate_caches(os.path.join(work_dir, "staged"))
+            df = timed(stages, 'read', automation.read_sheet, input_path)
+            partners_map, _ = timed(stages, 'extraction', extract_rejections, df)
+            counts['partners'] = len(partners_map)
+            counts['batches'] = sum(len(b) for b in partners_map.values())
+            counts['rejections'] = sum(len(batch['images']) for b in partners_map.values() for batch in b)
+
+            image_futures = timed(stages, 'image_fetch', fetch_all_images, partners_map)
+            counts['unique_images'] = len(image_futures)
+            counts['images_fetched'] = sum(1 for f in image_futures.values() if f.result() is not None)
+            counts['image_requests'] = server.requests
+
+            # The pipeline's renderer, started with every image already resolved
+            out_dir = os.path.join(work_dir, "staged", "reports")
+            files = timed(stages, 'render', automation.render_reports, partners_map, image_futures, output_dir=out_dir)
+            counts['pdf_bytes'] = sum(os.path.getsize(f) for f in files)
+
+            def zip_all():
+                return sum(len(chunk) for chunk in stream_zip(iter(files)))
+            counts['zip_bytes'] = timed(stages, 'zip', zip_all)
+
+            # --- End to end (pipelined) run, cold caches ---
+            isolate_caches(os.path.join(work_dir, "e2e"))
+            e2e_dir = os.path.join(work_dir, "e2e", "reports")
+            first_report = []
+            start = time.perf_counter()
+
+            def on_report(path):
+                if not first_report:
+                    first_report.append(round(time.perf_counter() - start, 4))
+
+            timed(stages, 'end_to_end', automation.process_data_and_generate_reports, input_path,
+                  report_callback=on_report, output_dir=e2e_dir)
+            stages['time_to_first_report'] = first_report[0] if first_report else None
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    return {
+        'version': git_version(),
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'params': {
+            'rows': rows, 'partners': partners, 'rejection_rate': rejection_rate, 'image_pool': image_pool,
+            'latency': latency, 'failure_rate': failure_rate, 'format': file_format, 'seed': seed,
+            'render_mode': automation.PDF_RENDER_MODE, 'render_workers': automation.PDF_RENDER_WORKERS,
+        },
+        'stages': stages,
+        'counts': counts,
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmarks for the rejection report pipeline.")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    p_extract = sub.add_parser("extraction", help="iterrows vs columnar rejection extraction")
+    p_extract.add_argument("--rows", type=int, nargs="+", default=[1000, 10000, 100000],
+                           help="Row counts to benchmark extraction at.")
+
+    p_flow = sub.add_parser("flowables", help="Per-batch flowable + doc.build cost, legacy vs shared template")
+    p_flow.add_argument("--rows", type=int, default=2000)
+    p_flow.add_argument("--partners", type=int, default=20)
+    p_flow.add_argument("--image-pool", type=int, default=200, help="Number of distinct images.")
+
+    p_pipe = sub.add_parser("pipeline", help="Per-stage timings against a local image server")
+    p_pipe.add_argument("--rows", type=int, default=2000)
+    p_pipe.add_argument("--partners", type=int, default=20)
+    p_pipe.add_argument("--rejection-rate", type=float, default=0.2)
+    p_pipe.add_argument("--image-pool", type=int, default=500,
+                        help="Number of distinct images; lower means more reuse (0 = every URL unique).")
+    p_pipe.add_argument("--latency", type=float, default=0.05, help="Seconds added to every image response.")
+    p_pipe.add_argument("--failure-rate", type=float, default=0.0, help="Share of image requests that fail.")
+    p_pipe.add_argument("--format", choices=["csv", "xlsx"], default="csv")
+    p_pipe.add_argument("--seed", type=int, default=0)
+    p_pipe.add_argument("--json", help="Write the result to this file (JSON).")
+
+    args = parser.parse_args()
+    if args.command == "extraction":
+        bench_extraction(args.rows)
+    elif args.command == "flowables":
+        bench_flowables(args.rows, args.partners, args.image_pool)
+    else:
+        result = bench_pipeline(args.rows, args.partners, args.rejection_rate, args.image_pool or None,
+                                args.latency, args.failure_rate, args.format, args.seed)
+        output = json.dumps(result, indent=2)
+        print(output)
+        if args.json:
+            with open(args.json, 'w', encoding='utf-8') as f:
+                f.write(output)
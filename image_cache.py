@@ -0,0 +1,177 @@
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+
+
+def url_key(url):
+    """Content-addressed key for a URL (sha256 hex digest)."""
+    return hashlib.sha256(url.encode('utf-8')).hexdigest()
+
+
+class ImageCache:
+    """Two-tier image cache keyed by URL hash.
+
+       Memory tier: an in-process LRU bounded by memory_max_bytes.
+       Disk tier: one file per URL under cache_dir, bounded by disk_max_bytes,
+       evicted least-recently-used first (recency tracked via file mtime so it
+       survives restarts). Safe to share between threads."""
+
+    def __init__(self, cache_dir, disk_max_bytes=2 * 1024**3, memory_max_bytes=256 * 1024**2):
+        self.cache_dir = cache_dir
+        self.disk_max_bytes = disk_max_bytes
+        self.memory_max_bytes = memory_max_bytes
+        self._lock = threading.Lock()
+        self._memory = OrderedDict()
+        self._memory_bytes = 0
+        self._disk = OrderedDict()  # key -> size, oldest first
+        self._disk_bytes = 0
+        self._counters = {
+            'memory_hits': 0,
+            'disk_hits': 0,
+            'misses': 0,
+            'bytes_served': 0,
+            'bytes_downloaded': 0,
+            'download_seconds': 0.0,
+            'downloads': 0,
+            'evictions': 0,
+        }
+        os.makedirs(cache_dir, exist_ok=True)
+        self._load_index()
+
+    # --- Disk index ---
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key[:2], key)
+
+    def _load_index(self):
+        entries = []
+        for root, _, files in os.walk(self.cache_dir):
+            for name in files:
+                if name.endswith('.tmp'):
+                    continue
+                try:
+                    st = os.stat(os.path.join(root, name))
+                except OSError:
+                    continue
+                entries.append((st.st_mtime, name, st.st_size))
+        for _, key, size in sorted(entries):
+            self._disk[key] = size
+            self._disk_bytes += size
+
+    def _evict_disk(self):
+        while self._disk_bytes > self.disk_max_bytes and self._disk:
+            key, size = self._disk.popitem(last=False)
+            self._disk_bytes -= size
+            self._counters['evictions'] += 1
+            try:
+                os.remove(self._path(key))
+            except OSError:
+                pass
+
+    # --- Memory tier ---
+    def _remember(self, key, data):
+        if len(data) > self.memory_max_bytes:
+            return
+        if key in self._memory:
+            self._memory_bytes -= len(self._memory.pop(key))
+        self._memory[key] = data
+        self._memory_bytes += len(data)
+        while self._memory_bytes > self.memory_max_bytes:
+            _, old = self._memory.popitem(last=False)
+            self._memory_bytes -= len(old)
+
+    # --- Public API ---
+    def get(self, url):
+        """Returns cached bytes for url, or None on a miss."""
+        key = url_key(url)
+        with self._lock:
+            data = self._memory.get(key)
+            if data is not None:
+                self._memory.move_to_end(key)
+                self._counters['memory_hits'] += 1
+                self._counters['bytes_served'] += len(data)
+                return data
+            on_disk = key in self._disk
+
+        if on_disk:
+            path = self._path(key)
+            try:
+                with open(path, 'rb') as f:
+                    data = f.read()
+                os.utime(path)
+            except OSError:
+                data = None
+            with self._lock:
+                if data is not None:
+                    if key in self._disk:
+                        self._disk.move_to_end(key)
+                    self._remember(key, data)
+                    self._counters['disk_hits'] += 1
+                    self._counters['bytes_served'] += len(data)
+                    return data
+                if key in self._disk:
+                    self._disk_bytes -= self._disk.pop(key)
+
+        with self._lock:
+            self._counters['misses'] += 1
+        return None
+
+    def put(self, url, data):
+        """Stores bytes for url in both tiers."""
+        key = url_key(url)
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        try:
+            with open(tmp_path, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            print(f"Image cache write failed for {url}: {e}")
+            with self._lock:
+                self._remember(key, data)
+            return
+
+        with self._lock:
+            if key in self._disk:
+                self._disk_bytes -= self._disk.pop(key)
+            self._disk[key] = len(data)
+            self._disk_bytes += len(data)
+            self._remember(key, data)
+            self._evict_disk()
+
+    def record_download(self, num_bytes, seconds):
+        """Records a network fetch so stats can estimate the time hits saved."""
+        with self._lock:
+            self._counters['bytes_downloaded'] += num_bytes
+            self._counters['download_seconds'] += seconds
+            self._counters['downloads'] += 1
+
+    def stats(self):
+        with self._lock:
+            c = dict(self._counters)
+            c['memory_entries'] = len(self._memory)
+            c['memory_bytes'] = self._memory_bytes
+            c['disk_entries'] = len(self._disk)
+            c['disk_bytes'] = self._disk_bytes
+        hits = c['memory_hits'] + c['disk_hits']
+        lookups = hits + c['misses']
+        c['hits'] = hits
+        c['hit_rate'] = round(hits / lookups, 4) if lookups else 0.0
+        avg_download = c['download_seconds'] / c['downloads'] if c['downloads'] else 0.0
+        c['estimated_seconds_saved'] = round(hits * avg_download, 2)
+        c['download_seconds'] = round(c['download_seconds'], 2)
+        return c
+
+    def clear(self):
+        with self._lock:
+            keys = list(self._disk)
+            self._disk.clear()
+            self._disk_bytes = 0
+            self._memory.clear()
+            self._memory_bytes = 0
+        for key in keys:
+            try:
+                os.remove(self._path(key))
+            except OSError:
+                pass
@@ -0,0 +1,236 @@
+import concurrent.futures
+import threading
+import time
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from metrics import IMAGE_BYTES, IMAGE_FETCH_QUEUE, IMAGE_FETCH_RETRIES, IMAGE_FETCH_SECONDS
+
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+# Responses that mean the URL itself is dead (negative-cached by ImageHealth)
+PERMANENT_STATUSES = {404, 410}
+
+
+class DownloadAttempts:
+    """Outcome handling for one URL's download attempts, shared by both fetch engines
+       (which only differ in how they do the I/O): decides whether a failure is
+       retried, reports outcomes to the optional ImageHealth and the metrics, and
+       records the reason in `failures` ({url: reason}) when the URL is given up.
+       With an ImageHealth, URLs that are known to fail or whose host's circuit is
+       open are given up straight away (see host_ready)."""
+
+    def __init__(self, url, retries, backoff, health=None, failures=None):
+        self.url = url
+        self.retries = retries
+        self.backoff = backoff
+        self.health = health
+        self.failures = failures if failures is not None else {}
+        self.attempt = 0
+        self.reason = "failed"
+        self.started = time.perf_counter()
+        self.host_failed = False
+
+    def blocked(self):
+        """True (and the URL given up) if it should not be requested at all."""
+        reason = self.health.check(self.url) if self.health is not None else None
+        if reason is None:
+            return False
+        self.failures[self.url] = reason
+        return True
+
+    def host_ready(self):
+        """0 if the URL may be requested now, None to give up (its host's circuit
+           is open), or seconds to wait for the probe of a host this URL is
+           already being retried against."""
+        if self.health is None:
+            return 0
+        wait = self.health.admit(self.url, in_flight=self.attempt > 0)
+        if wait is None:
+            if self.host_failed:
+                # It failed itself (e.g. timed out): don't request it again next run either
+                self.health.record_url_failure(self.url, self.reason, permanent=False)
+            self.reason = "host unavailable (circuit open)"
+        return wait
+
+    def responded(self, status):
+        """The host answered with `status` (before the body is read): anything
+           but a 5xx shows it is up."""
+        if self.health is None:
+            return
+        if status >= 500:
+            self.host_failed = True
+            self.health.record_host_failure(self.url)
+        else:
+            self.health.record_success(self.url)
+
+    def succeeded(self, size):
+        IMAGE_FETCH_SECONDS.observe(time.perf_counter() - self.started, outcome="ok")
+        IMAGE_BYTES.observe(size)
+
+    def http_error(self, status):
+        """Non-200 response. Returns True if it should be retried."""
+        self.reason = f"HTTP {status}"
+        retry = status in RETRY_STATUSES
+        if not retry:
+            print(f"Error downloading image {self.url}: HTTP {status}")
+        return self._retry(retry, negative=status in PERMANENT_STATUSES or status >= 500,
+                           permanent=status in PERMANENT_STATUSES)
+
+    def request_error(self, error, timed_out):
+        """Connection error or timeout. Returns True if it should be retried."""
+        self.reason = "timed out" if timed_out else type(error).__name__
+        self.host_failed = True
+        if self.health is not None:
+            self.health.record_host_failure(self.url)
+        print(f"Error downloading image {self.url} (attempt {self.attempt + 1}): {error!r}")
+        return self._retry(True, negative=True, permanent=False)
+
+    def rejected(self, reason):
+        """The response was unusable (e.g. too large); never retried."""
+        self.reason = reason
+        print(f"Error downloading image {self.url}: {reason}")
+
+    def _retry(self, retry, negative, permanent):
+        if retry and self.attempt < self.retries:
+            IMAGE_FETCH_RETRIES.inc()
+            return True
+        if negative and self.health is not None:
+            self.health.record_url_failure(self.url, self.reason, permanent=permanent)
+        return False
+
+    def next_attempt(self):
+        """Backoff in seconds before the next attempt."""
+        delay = self.backoff * (2 ** self.attempt)
+        self.attempt += 1
+        return delay
+
+    def give_up(self, reason=None):
+        self.failures[self.url] = reason or self.reason
+        IMAGE_FETCH_SECONDS.observe(time.perf_counter() - self.started, outcome="error")
+
+
+class ImageFetcher:
+    """Fetches many image URLs through one connection-pooled requests.Session.
+
+       - max_workers bounds the total number of in-flight requests.
+       - per_host bounds in-flight requests to any single host.
+       - Failed requests (connection errors, timeouts, 429/5xx) are retried
+         with exponential backoff.
+       - budget_seconds is a global deadline starting with the first submit();
+         URLs not fetched by then are reported as failed instead of stalling the job.
+       Successful downloads are read from / written to the optional ImageCache.
+       Outcomes are handled by DownloadAttempts (retries, health, `failures`)."""
+
+    def __init__(self, cache=None, max_workers=32, per_host=8, timeout=10,
+                 retries=2, backoff=0.5, budget_seconds=900, health=None):
+        self.cache = cache
+        self.health = health
+        self.failures = {}
+        self.max_workers = max_workers
+        self.per_host = per_host
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.budget_seconds = budget_seconds
+        self._host_slots = {}
+        self._host_lock = threading.Lock()
+        self._submit_lock = threading.Lock()
+        self._executor = None
+        self._deadline = None
+        self._submitted = {}
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=max_workers, pool_maxsize=max_workers, max_retries=0)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def _slot(self, url):
+        host = urlsplit(url).netloc.lower()
+        with self._host_lock:
+            if host not in self._host_slots:
+                self._host_slots[host] = threading.BoundedSemaphore(self.per_host)
+            return self._host_slots[host]
+
+    def fetch(self, url, deadline=None):
+        """Returns the image bytes for url, or None if it could not be fetched."""
+        if not isinstance(url, str) or not url.startswith('http'):
+            return None
+        if self.cache is not None:
+            cached = self.cache.get(url)
+            if cached is not None:
+                return cached
+        attempts = DownloadAttempts(url, self.retries, self.backoff, self.health, self.failures)
+        if attempts.blocked():
+            return None
+
+        while True:
+            remaining = self.timeout if deadline is None else deadline - time.time()
+            if remaining <= 0:
+                print(f"Image fetch budget exhausted, skipping {url}")
+                attempts.give_up("skipped (fetch budget exhausted)")
+                return None
+            wait = attempts.host_ready()
+            if wait is None:
+                break
+            if wait:
+                time.sleep(min(wait, remaining))
+                continue
+            started = time.time()
+            try:
+                with self._slot(url):
+                    # Another request may have tripped the breaker while this one waited
+                    wait = attempts.host_ready()
+                    if wait is None:
+                        break
+                    if wait:
+                        continue
+                    with self.session.get(url, timeout=min(self.timeout, remaining), stream=True) as response:
+                        attempts.responded(response.status_code)
+                        content = response.content if response.status_code == 200 else None
+                if content is not None:
+                    if self.cache is not None:
+                        self.cache.record_download(len(content), time.time() - started)
+                        self.cache.put(url, content)
+                    attempts.succeeded(len(content))
+                    return content
+                retry = attempts.http_error(response.status_code)
+            except requests.RequestException as e:
+                retry = attempts.request_error(e, timed_out=isinstance(e, requests.Timeout))
+            if not retry:
+                break
+            time.sleep(attempts.next_attempt())
+        attempts.give_up()
+        return None
+
+    def _fetch_and_transform(self, url, deadline, transform):
+        data = self.fetch(url, deadline)
+        if data is not None and transform is not None:
+            data = transform(url, data)
+            if data is None:
+                self.failures[url] = "not a readable image"
+        return data
+
+    def submit(self, url, transform=None):
+        """Schedules url on the fetcher's shared worker pool and returns a Future of its
+           bytes (or None). Each URL is scheduled only once; repeated calls return the
+           same Future. The budget deadline starts with the first submit."""
+        with self._submit_lock:
+            future = self._submitted.get(url)
+            if future is None:
+                if self._executor is None:
+                    self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.max_workers)
+                    self._deadline = time.time() + self.budget_seconds if self.budget_seconds else None
+                future = self._executor.submit(self._fetch_and_transform, url, self._deadline, transform)
+                IMAGE_FETCH_QUEUE.inc()
+                future.add_done_callback(lambda _f: IMAGE_FETCH_QUEUE.dec())
+                self._submitted[url] = future
+            return future
+
+    def close(self, cancel_pending=False):
+        with self._submit_lock:
+            executor, self._executor = self._executor, None
+            self._submitted = {}
+        if executor is not None:
+            executor.shutdown(wait=True, cancel_futures=cancel_pending)
+        self.session.close()
@@ -0,0 +1,164 @@
+import json
+import os
+import threading
+import time
+from urllib.parse import urlsplit
+
+from metrics import IMAGE_FETCH_FAST_FAILS
+
+
+def url_host(url):
+    return urlsplit(url).netloc.lower()
+
+
+class ImageHealth:
+    """Tracks failing image hosts and URLs so downloads that will fail anyway
+       fail quickly instead of each waiting for its own timeouts.
+
+       - Circuit breaker per host: once failure_threshold different URLs failed
+         (connection errors, timeouts, 5xx) with no other response from the host
+         in between, its requests fail straight away for cooldown seconds, then a
+         single request probes it. Any response other than a 5xx closes the
+         circuit; a failed probe opens it for another cooldown.
+       - Negative cache per URL: URLs that returned 404/410 are skipped for
+         negative_ttl seconds, URLs that kept failing (timeouts, connection
+         errors) for transient_ttl seconds. Entries are kept in `path` (JSON),
+         so reruns skip known dead links too.
+       Shared by every job and both fetch engines; safe to use from any thread.
+       `clock` is the time source (time.time)."""
+
+    # While another request probes a host, waiting requests check back this often
+    PROBE_POLL_SECONDS = 0.5
+
+    def __init__(self, failure_threshold=5, cooldown=60, negative_ttl=6 * 60 * 60, transient_ttl=10 * 60,
+                 path=None, clock=time.time):
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.negative_ttl = negative_ttl
+        self.transient_ttl = transient_ttl
+        self.path = path
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._save_lock = threading.Lock()  # one writer of `path` at a time
+        # host -> {'failed_urls', 'open_until', 'probe_url', 'probe_started'}
+        self._hosts = {}
+        self._negative = {}  # url -> (expires_at, reason)
+        self._dirty = False
+        self._load()
+
+    # --- Negative cache persistence ---
+    def _load(self):
+        if not self.path:
+            return
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                entries = json.load(f)
+        except (OSError, ValueError):
+            return
+        now = self._clock()
+        self._negative = {url: (expires_at, reason) for url, (expires_at, reason) in entries.items() if expires_at > now}
+
+    def save(self):
+        """Writes the negative cache to `path` if it changed (expired entries are dropped).
+           A failed write is logged and retried on the next save, never raised."""
+        if not self.path:
+            return
+        with self._save_lock:
+            with self._lock:
+                if not self._dirty:
+                    return
+                now = self._clock()
+                entries = {url: entry for url, entry in self._negative.items() if entry[0] > now}
+                self._negative = dict(entries)
+                self._dirty = False
+            tmp_path = f"{self.path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            try:
+                with open(tmp_path, 'w', encoding='utf-8') as f:
+                    json.dump(entries, f)
+                os.replace(tmp_path, self.path)
+            except OSError as e:
+                print(f"Could not save the image failure cache to {self.path}: {e}")
+                with self._lock:
+                    self._dirty = True
+                try:
+                    os.remove(tmp_path)
+                except OSError:
+                    pass
+
+    # --- Checks ---
+    def check(self, url):
+        """Reason url should not be requested at all (a known failure), or None."""
+        now = self._clock()
+        with self._lock:
+            entry = self._negative.get(url)
+            if entry is None:
+                return None
+            if entry[0] > now:
+                IMAGE_FETCH_FAST_FAILS.inc(reason="negative_cache")
+                return f"known failure: {entry[1]}"
+            del self._negative[url]
+            self._dirty = True
+        return None
+
+    def admit(self, url, in_flight=False):
+        """Whether a request to url may go now: 0 if it may (the circuit is closed,
+           or this request becomes the probe), None if it should fail straight away
+           (the circuit is open), or the seconds to wait before asking again, for
+           requests already in flight (retrying) while another request probes."""
+        now = self._clock()
+        with self._lock:
+            state = self._hosts.get(url_host(url))
+            if state is None or state['open_until'] is None:
+                return 0
+            if now >= state['open_until']:
+                # Cooldown over: let one request through to probe the host
+                probe_url = state['probe_url']
+                if probe_url == url or probe_url is None or now - state['probe_started'] > self.cooldown:
+                    state['probe_url'], state['probe_started'] = url, now
+                    return 0
+                if in_flight:
+                    return self.PROBE_POLL_SECONDS
+            IMAGE_FETCH_FAST_FAILS.inc(reason="circuit_open")
+            return None
+
+    # --- Outcomes ---
+    def record_success(self, url):
+        """url's host answered (anything but a 5xx): it is up, close its circuit."""
+        with self._lock:
+            state = self._hosts.get(url_host(url))
+            if state is not None:
+                state.update(failed_urls=set(), open_until=None, probe_url=None, probe_started=None)
+
+    def record_host_failure(self, url):
+        """A request to url's host failed (connection error, timeout, 5xx)."""
+        host = url_host(url)
+        now = self._clock()
+        with self._lock:
+            state = self._hosts.setdefault(host, {'failed_urls': set(), 'open_until': None, 'probe_url': None,
+                                                  'probe_started': None})
+            if state['open_until'] is not None:
+                if state['probe_url'] != url:
+                    return  # a request from before the circuit opened
+            else:
+                state['failed_urls'].add(url)
+                if len(state['failed_urls']) < self.failure_threshold:
+                    return
+            print(f"Image host {host} is failing, skipping its images for {self.cooldown}s")
+            state.update(open_until=now + self.cooldown, probe_url=None, probe_started=None)
+
+    def record_url_failure(self, url, reason, permanent):
+        """url failed for good in this attempt: permanent (404/410) or after all retries."""
+        ttl = self.negative_ttl if permanent else self.transient_ttl
+        if not ttl:
+            return
+        with self._lock:
+            self._negative[url] = (self._clock() + ttl, reason)
+            self._dirty = True
+
+    def stats(self):
+        now = self._clock()
+        with self._lock:
+            open_hosts = sorted(host for host, state in self._hosts.items()
+                                if state['open_until'] is not None and now < state['open_until'])
+            negative = sum(1 for expires_at, _ in self._negative.values() if expires_at > now)
+        return {'open_hosts': open_hosts, 'negative_entries': negative}
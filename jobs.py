@@ -0,0 +1,162 @@
+import json
+import sqlite3
+import threading
+import time
+from collections import deque
+
+FINISHED_STATUSES = ("complete", "error")
+
+
+class TaskStore:
+    """Task state persisted in a local SQLite file.
+
+       Reads are served from an in-memory copy; every update is written through,
+       so state survives a restart. The stored value is the same dict the UI polls
+       from /status (status, message, percent, eta, download_url, ...)."""
+
+    def __init__(self, db_path):
+        self._lock = threading.Lock()
+        self._cache = {}
+        self._conn = sqlite3.connect(db_path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS tasks ("
+            " task_id TEXT PRIMARY KEY,"
+            " status TEXT NOT NULL,"
+            " data TEXT NOT NULL,"
+            " file_path TEXT,"
+            " created_at REAL NOT NULL,"
+            " updated_at REAL NOT NULL,"
+            " finished_at REAL)"
+        )
+        self._conn.commit()
+
+    def create(self, task_id, file_path, data):
+        now = time.time()
+        with self._lock:
+            self._cache[task_id] = dict(data)
+            self._conn.execute(
+                "INSERT OR REPLACE INTO tasks (task_id, status, data, file_path, created_at, updated_at) VALUES (?, ?, ?, ?, ?, ?)",
+                (task_id, data.get("status", "queued"), json.dumps(data), file_path, now, now),
+            )
+            self._conn.commit()
+
+    def set(self, task_id, data):
+        """Replaces the task's state (same semantics as the old task_progress[task_id] = data)."""
+        now = time.time()
+        status = data.get("status", "processing")
+        finished_at = now if status in FINISHED_STATUSES else None
+        with self._lock:
+            self._cache[task_id] = dict(data)
+            self._conn.execute(
+                "UPDATE tasks SET status = ?, data = ?, updated_at = ?, finished_at = ? WHERE task_id = ?",
+                (status, json.dumps(data), now, finished_at, task_id),
+            )
+            self._conn.commit()
+
+    def get(self, task_id):
+        with self._lock:
+            data = self._cache.get(task_id)
+            if data is not None:
+                return dict(data)
+            row = self._conn.execute("SELECT data FROM tasks WHERE task_id = ?", (task_id,)).fetchone()
+        if row is None:
+            return None
+        data = json.loads(row[0])
+        with self._lock:
+            self._cache[task_id] = data
+        return dict(data)
+
+    def unfinished(self):
+        """[(task_id, status, file_path)] for tasks that were queued or running, oldest first."""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT task_id, status, file_path FROM tasks WHERE status NOT IN (?, ?) ORDER BY created_at",
+                FINISHED_STATUSES,
+            ).fetchall()
+        return rows
+
+    def expired(self, ttl_seconds):
+        """Task ids that finished more than ttl_seconds ago."""
+        cutoff = time.time() - ttl_seconds
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT task_id FROM tasks WHERE finished_at IS NOT NULL AND finished_at < ?", (cutoff,)
+            ).fetchall()
+        return [row[0] for row in rows]
+
+    def delete(self, task_id):
+        with self._lock:
+            self._cache.pop(task_id, None)
+            self._conn.execute("DELETE FROM tasks WHERE task_id = ?", (task_id,))
+            self._conn.commit()
+
+
+class JobScheduler:
+    """FIFO job queue run by a fixed number of worker threads, so only
+       max_concurrent jobs process at once no matter how many are uploaded.
+
+       on_dequeue(waiting_ids), if given, is called whenever a job leaves the queue
+       with the ids still waiting, in order. It runs with the queue locked (so the
+       positions it sees can't be overtaken by a later dequeue) and must be quick
+       and not call back into the scheduler."""
+
+    def __init__(self, max_concurrent=1, on_dequeue=None):
+        self.max_concurrent = max_concurrent
+        self.on_dequeue = on_dequeue
+        self._queue = deque()
+        self._cond = threading.Condition()
+        self._running = set()
+        self._workers = []
+
+    def start(self):
+        with self._cond:
+            if self._workers:
+                return
+            for i in range(self.max_concurrent):
+                worker = threading.Thread(target=self._work, name=f"job-worker-{i}", daemon=True)
+                worker.start()
+                self._workers.append(worker)
+
+    def submit(self, job_id, fn, *args):
+        with self._cond:
+            self._queue.append((job_id, fn, args))
+            self._cond.notify()
+
+    def queue_position(self, job_id):
+        """1-based position among waiting jobs, 0 if running, None if unknown/finished."""
+        with self._cond:
+            if job_id in self._running:
+                return 0
+            for position, (queued_id, _, _) in enumerate(self._queue, start=1):
+                if queued_id == job_id:
+                    return position
+        return None
+
+    def queued_count(self):
+        with self._cond:
+            return len(self._queue)
+
+    def running_count(self):
+        with self._cond:
+            return len(self._running)
+
+    def _work(self):
+        while True:
+            with self._cond:
+                while not self._queue:
+                    self._cond.wait()
+                job_id, fn, args = self._queue.popleft()
+                self._running.add(job_id)
+                if self.on_dequeue:
+                    try:
+                        self.on_dequeue([queued_id for queued_id, _, _ in self._queue])
+                    except Exception as e:
+                        print(f"Queue update after {job_id} failed: {e}")
+            try:
+                fn(*args)
+            except Exception as e:
+                print(f"Job {job_id} failed: {e}")
+            finally:
+                with self._cond:
+                    self._running.discard(job_id)
@@ -0,0 +1,239 @@
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+
+TIME_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+BYTES_BUCKETS = (4 * 1024, 16 * 1024, 64 * 1024, 256 * 1024, 1024**2, 4 * 1024**2, 16 * 1024**2)
+
+
+def _format_labels(names, values, extra=None):
+    pairs = list(zip(names, values))
+    if extra:
+        pairs.append(extra)
+    if not pairs:
+        return ""
+    body = ",".join(f'{name}="{str(value)}"'.replace("\n", " ") for name, value in pairs)
+    return "{" + body + "}"
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, registry, name, help_text, labels=()):
+        self._registry = registry
+        self.name = name
+        self.help = help_text
+        self.labels = tuple(labels)
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def _key(self, labels):
+        return tuple(labels.get(name, "") for name in self.labels)
+
+    def samples(self):
+        """[(suffix, label names, label values, extra label, value)] in exposition order."""
+        with self._lock:
+            return [("", self.labels, key, None, value) for key, value in sorted(self._values.items())]
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        if not self._registry.enabled:
+            return
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(_Metric):
+    kind = "gauge"
+
+    def set(self, value, **labels):
+        if not self._registry.enabled:
+            return
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+    def inc(self, amount=1, **labels):
+        if not self._registry.enabled:
+            return
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, registry, name, help_text, labels=(), buckets=TIME_BUCKETS):
+        super().__init__(registry, name, help_text, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        if not self._registry.enabled:
+            return
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                # per-bucket counts (last slot is +Inf), sum
+                state = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0]
+            state[0][index] += 1
+            state[1] += value
+
+    def samples(self):
+        with self._lock:
+            items = [(key, list(counts), total) for key, (counts, total) in sorted(self._values.items())]
+        out = []
+        for key, counts, total in items:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                out.append(("_bucket", self.labels, key, ("le", _format_value(bound)), cumulative))
+            out.append(("_sum", self.labels, key, None, round(total, 6)))
+            out.append(("_count", self.labels, key, None, cumulative))
+        return out
+
+
+class _CallbackGauge(_Metric):
+    """Gauge whose value is read at scrape time from fn() -> number or {label value(s): number}."""
+    kind = "gauge"
+
+    def __init__(self, registry, name, help_text, fn, labels=()):
+        super().__init__(registry, name, help_text, labels)
+        self._fn = fn
+
+    def samples(self):
+        value = self._fn()
+        if not isinstance(value, dict):
+            return [("", (), (), None, value)]
+        return [("", self.labels, key if isinstance(key, tuple) else (key,), None, v)
+                for key, v in sorted(value.items())]
+
+
+class MetricsRegistry:
+    """Process-wide set of counters, gauges and histograms, rendered in the
+       Prometheus text format. While `enabled` is False every update returns
+       straight away, so instrumented code costs one attribute check."""
+
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self._lock = threading.Lock()
+        self._metrics = {}
+
+    def _register(self, metric):
+        with self._lock:
+            return self._metrics.setdefault(metric.name, metric)
+
+    def counter(self, name, help_text, labels=()):
+        return self._register(Counter(self, name, help_text, labels))
+
+    def gauge(self, name, help_text, labels=()):
+        return self._register(Gauge(self, name, help_text, labels))
+
+    def histogram(self, name, help_text, labels=(), buckets=TIME_BUCKETS):
+        return self._register(Histogram(self, name, help_text, labels, buckets))
+
+    def gauge_callback(self, name, help_text, fn, labels=()):
+        return self._register(_CallbackGauge(self, name, help_text, fn, labels))
+
+    def render(self):
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines = []
+        for metric in metrics:
+            try:
+                samples = metric.samples()
+            except Exception as e:
+                print(f"Metric {metric.name} failed: {e}")
+                continue
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            for suffix, names, values, extra, value in samples:
+                lines.append(f"{metric.name}{suffix}{_format_labels(names, values, extra)} {_format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+
+class StageTimer:
+    """Wall-clock seconds per pipeline stage for a single task.
+
+       Stages can overlap (images download while rows are read and reports
+       render), so the values are not meant to add up to the total."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._seconds = {}
+        self._started = {}
+
+    @contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - start)
+
+    def add(self, name, seconds):
+        with self._lock:
+            self._seconds[name] = self._seconds.get(name, 0.0) + seconds
+
+    def start(self, name):
+        """Marks the start of a stage that ends somewhere else (see stop()). Only the first call counts."""
+        with self._lock:
+            self._started.setdefault(name, time.perf_counter())
+
+    def stop(self, name):
+        with self._lock:
+            start = self._started.pop(name, None)
+            if start is not None:
+                self._seconds[name] = self._seconds.get(name, 0.0) + time.perf_counter() - start
+
+    def snapshot(self):
+        with self._lock:
+            return {name: round(seconds, 3) for name, seconds in self._seconds.items()}
+
+    def observe(self, histogram):
+        """Records each stage's total for this task in histogram (labelled by stage)."""
+        for name, seconds in self.snapshot().items():
+            histogram.observe(seconds, stage=name)
+
+
+# Off until the web app turns it on (METRICS_ENABLED in app.py)
+REGISTRY = MetricsRegistry(enabled=False)
+
+STAGE_SECONDS = REGISTRY.histogram(
+    "biochar_stage_seconds", "Seconds spent per pipeline stage, per task.", labels=("stage",))
+PARTNER_RENDER_SECONDS = REGISTRY.histogram(
+    "biochar_partner_render_seconds", "Seconds to render one partner's PDF (doc.build).")
+IMAGE_FETCH_SECONDS = REGISTRY.histogram(
+    "biochar_image_fetch_seconds", "Seconds per image download, including retries.", labels=("outcome",))
+IMAGE_BYTES = REGISTRY.histogram(
+    "biochar_image_bytes", "Size of downloaded images in bytes.", buckets=BYTES_BUCKETS)
+IMAGE_FETCH_RETRIES = REGISTRY.counter(
+    "biochar_image_fetch_retries_total", "Image download attempts that were retried.")
+IMAGE_FETCH_FAST_FAILS = REGISTRY.counter(
+    "biochar_image_fetch_fast_fails_total", "Image downloads skipped because the URL or its host is known to fail.",
+    labels=("reason",))
+IMAGE_FETCH_QUEUE = REGISTRY.gauge(
+    "biochar_image_fetch_queue", "Image downloads submitted and not finished yet.")
+RENDER_QUEUE = REGISTRY.gauge(
+    "biochar_render_queue", "Partner reports handed to the render pool and not finished yet.")
+ZIP_STREAM_SECONDS = REGISTRY.histogram(
+    "biochar_zip_stream_seconds", "Seconds to stream one task's ZIP download.")
+ZIP_BYTES = REGISTRY.counter(
+    "biochar_zip_bytes_total", "Bytes of ZIP archives produced.")
+TASKS = REGISTRY.counter(
+    "biochar_tasks_total", "Finished tasks by final status.", labels=("status",))
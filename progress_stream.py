@@ -0,0 +1,96 @@
+import asyncio
+import json
+import threading
+from collections import deque
+
+# Event types where only the newest value matters; a slow client just gets the latest.
+COALESCED_EVENTS = {"progress", "images"}
+# Terminal event, always delivered.
+DONE_EVENT = "done"
+
+
+def format_sse(event, data):
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+class Subscriber:
+    """One connected client. Producers (worker threads) push events; the client's
+       event loop drains them in batches.
+
+       Backpressure: coalesced events overwrite each other, other events sit in a
+       bounded deque (oldest dropped when full, counted in `dropped`), and the loop
+       is woken at most once per drain, so a fast producer cannot flood it."""
+
+    def __init__(self, task_id, loop, max_events=100):
+        self.task_id = task_id
+        self._loop = loop
+        self._lock = threading.Lock()
+        self._latest = {}
+        self._events = deque(maxlen=max_events)
+        self._done = None
+        self._wake_pending = False
+        self._wake = asyncio.Event()
+        self.dropped = 0
+
+    def push(self, event, data):
+        with self._lock:
+            if event == DONE_EVENT:
+                self._done = data
+            elif event in COALESCED_EVENTS:
+                self._latest[event] = data
+            else:
+                if len(self._events) == self._events.maxlen:
+                    self.dropped += 1
+                self._events.append((event, data))
+            if self._wake_pending:
+                return
+            self._wake_pending = True
+        try:
+            self._loop.call_soon_threadsafe(self._wake.set)
+        except RuntimeError:
+            pass  # client's loop is gone
+
+    async def next_batch(self, timeout=None):
+        """Waits for events and returns them as [(event, data)]; [] on timeout."""
+        try:
+            await asyncio.wait_for(self._wake.wait(), timeout)
+        except asyncio.TimeoutError:
+            return []
+        self._wake.clear()
+        with self._lock:
+            self._wake_pending = False
+            batch = list(self._events)
+            self._events.clear()
+            batch.extend(self._latest.items())
+            self._latest = {}
+            if self._done is not None:
+                batch.append((DONE_EVENT, self._done))
+        return batch
+
+
+class ProgressBroker:
+    """Fans task events out to every client subscribed to that task. Thread-safe."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._subscribers = {}
+
+    def subscribe(self, task_id, loop=None):
+        sub = Subscriber(task_id, loop or asyncio.get_running_loop())
+        with self._lock:
+            self._subscribers.setdefault(task_id, set()).add(sub)
+        return sub
+
+    def unsubscribe(self, sub):
+        with self._lock:
+            subs = self._subscribers.get(sub.task_id)
+            if subs is not None:
+                subs.discard(sub)
+                if not subs:
+                    del self._subscribers[sub.task_id]
+
+    def publish(self, task_id, event, data):
+        with self._lock:
+            subs = list(self._subscribers.get(task_id, ()))
+        for sub in subs:
+            sub.push(event, data)
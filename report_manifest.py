@@ -0,0 +1,106 @@
+import hashlib
+import json
+import os
+import shutil
+import threading
+import time
+
+
+def link_or_copy(src, dst):
+    """Hard-links src to dst (no extra disk space), copying if linking is not possible."""
+    if os.path.exists(dst):
+        os.remove(dst)
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copyfile(src, dst)
+
+
+class ReportManifest:
+    """Remembers which PDFs were rendered for each partner's exact batch lists.
+
+       manifest.json maps partner name -> {fingerprint: {file, updated_at}}, and each
+       stored report is kept as <store_dir>/<file>. A later run whose batches hash to a
+       stored fingerprint can reuse that PDF instead of rendering it again. Up to
+       `versions` fingerprints are kept per partner (least recently used dropped), so
+       inputs that share partner names (e.g. one file per region) don't evict each other."""
+
+    def __init__(self, store_dir, versions=8):
+        self.store_dir = store_dir
+        self.versions = versions
+        self.path = os.path.join(store_dir, "manifest.json")
+        self._lock = threading.Lock()
+        os.makedirs(store_dir, exist_ok=True)
+        self._entries = self._load()
+
+    def _load(self):
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                entries = json.load(f)
+        except (OSError, ValueError):
+            return {}
+        # Manifests written before versions were kept: {partner: {fingerprint, file, updated_at}}
+        for partner_name, entry in list(entries.items()):
+            if 'fingerprint' in entry:
+                entries[partner_name] = {entry['fingerprint']: {'file': entry['file'], 'updated_at': entry['updated_at']}}
+        return entries
+
+    def _save(self):
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(self._entries, f, indent=1)
+        os.replace(tmp_path, self.path)
+
+    def fingerprint(self, batches, salt=""):
+        """Hash of a partner's batches: meta, stages, reasons and image URLs, in order.
+           `salt` should capture the render settings, so changing them invalidates reuse."""
+        canonical = [
+            [sorted(batch['meta'].items()),
+             [[item['stage'], item['image'], item.get('reason', '')] for item in batch['images']]]
+            for batch in batches
+        ]
+        payload = json.dumps([salt, canonical], default=str, separators=(',', ':'))
+        return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+    @staticmethod
+    def _file_name(partner_name, fingerprint):
+        key = json.dumps([partner_name, fingerprint]).encode('utf-8')
+        return hashlib.sha256(key).hexdigest() + ".pdf"
+
+    def reuse(self, partner_name, fingerprint, target):
+        """Links the PDF stored for (partner_name, fingerprint) to target. Returns False
+           if there is none. Runs under the manifest lock, so a concurrent record() can't
+           drop the stored file halfway through."""
+        with self._lock:
+            entry = self._entries.get(partner_name, {}).get(fingerprint)
+            if not entry:
+                return False
+            try:
+                link_or_copy(os.path.join(self.store_dir, entry['file']), target)
+            except OSError:
+                # Store file removed behind our back: forget it and render again
+                del self._entries[partner_name][fingerprint]
+                return False
+            entry['updated_at'] = time.time()
+            return True
+
+    def record(self, partner_name, fingerprint, pdf_path):
+        """Stores a freshly rendered PDF for partner_name and drops the least recently
+           used versions beyond `versions`."""
+        file_name = self._file_name(partner_name, fingerprint)
+        with self._lock:
+            link_or_copy(pdf_path, os.path.join(self.store_dir, file_name))
+            versions = self._entries.setdefault(partner_name, {})
+            versions[fingerprint] = {'file': file_name, 'updated_at': time.time()}
+            dropped = sorted(versions, key=lambda fp: versions[fp]['updated_at'])[:-self.versions]
+            for old in dropped:
+                try:
+                    os.remove(os.path.join(self.store_dir, versions.pop(old)['file']))
+                except OSError:
+                    pass
+            self._save()
+
+    def save(self):
+        """Writes the manifest, e.g. after reuse() updated when versions were last used."""
+        with self._lock:
+            self._save()
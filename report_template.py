@@ -0,0 +1,142 @@
+import os
+import threading
+from collections import OrderedDict
+from io import BytesIO
+
+from reportlab.lib import colors
+from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
+from reportlab.lib.units import inch
+from reportlab.lib.utils import ImageReader
+from reportlab.platypus import Image as RLImage, TableStyle
+
+
+class ReportTemplate:
+    """Paragraph and table styles used by every partner report.
+
+       Styles are immutable once built, so one instance is shared by all
+       renders in the process (see get_report_template()) instead of every
+       report, header, cell and row allocating its own."""
+
+    HEADER_COL_WIDTHS = [1.2 * inch, 2.5 * inch, 1.2 * inch, 2.0 * inch]
+    CELL_COL_WIDTHS = [3.1 * inch]
+    ROW_COL_WIDTHS = [3.4 * inch, 3.4 * inch]
+
+    def __init__(self):
+        styles = getSampleStyleSheet()
+        self.normal = styles['Normal']
+        self.heading = styles['Heading2']
+        self.header_text = ParagraphStyle('HeaderVal', parent=self.normal, fontSize=9, leading=11)
+        self.header_lbl = ParagraphStyle('HeaderLbl', parent=self.normal, fontSize=9, leading=11, fontName='Helvetica-Bold')
+        self.reason = ParagraphStyle('Reason', parent=self.normal, textColor=colors.red, fontSize=10, leading=12)
+        self.stage = ParagraphStyle('Stage', parent=self.normal, textColor=colors.white, backColor=colors.darkgrey, fontSize=8, alignment=1, spaceBefore=4)
+
+        self.header_table = TableStyle([
+            ('BACKGROUND', (0, 0), (-1, -1), colors.whitesmoke),
+            ('GRID', (0, 0), (-1, -1), 0.5, colors.grey),
+            ('VALIGN', (0, 0), (-1, -1), 'MIDDLE'),
+            ('PADDING', (0, 0), (-1, -1), 6),
+        ])
+        self.cell_table = TableStyle([
+            ('BOX', (0, 0), (-1, -1), 1, colors.lightgrey),
+            ('ALIGN', (0, 0), (-1, -1), 'CENTER'),
+            ('VALIGN', (0, 0), (-1, -1), 'TOP'),
+            ('BOTTOMPADDING', (0, 0), (-1, -1), 10),
+        ])
+        self.row_table = TableStyle([
+            ('VALIGN', (0, 0), (-1, -1), 'TOP'),
+            ('LEFTPADDING', (0, 0), (-1, -1), 5),
+            ('RIGHTPADDING', (0, 0), (-1, -1), 5),
+            ('TOPPADDING', (0, 0), (-1, -1), 10),
+        ])
+
+
+_template = None
+_template_lock = threading.Lock()
+
+
+def get_report_template():
+    global _template
+    with _template_lock:
+        if _template is None:
+            _template = ReportTemplate()
+        return _template
+
+
+class SharedImageReader(ImageReader):
+    """ImageReader that is fully decoded up front and safe to share between
+       threads and documents: ReportLab decodes an image to compute its PDF
+       name, and with a shared reader that happens once instead of per use."""
+
+    def __init__(self, data):
+        self._raw = data
+        super().__init__(BytesIO(data))
+        self.getSize()
+        self.getRGBData()
+
+    def _jpeg_fh(self):
+        # A fresh handle per caller instead of seeking one shared BytesIO
+        return BytesIO(self._raw)
+
+
+class SharedImage(RLImage):
+    """Image flowable drawn from a SharedImageReader."""
+
+    def __init__(self, reader, width=None, height=None, hAlign='CENTER'):
+        self.hAlign = hAlign
+        self._mask = 'auto'
+        self._drawing = None
+        self._file = None
+        self._dpi = False
+        self._img = reader
+        self.filename = reader.fileName
+        self._setup(width, height, 'direct', 0)
+
+
+class ImageReaderCache:
+    """LRU of SharedImageReader per image URL, bounded by approximate decoded size."""
+
+    def __init__(self, max_bytes=128 * 1024**2):
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._readers = OrderedDict()  # url -> (source size, reader, cost)
+        self._bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, url, source):
+        """Reader for url, whose image is `source` (bytes, or a file path). None if it can't be decoded."""
+        size = os.path.getsize(source) if isinstance(source, str) else len(source)
+        with self._lock:
+            entry = self._readers.get(url)
+            if entry is not None and entry[0] == size:
+                self._readers.move_to_end(url)
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+        if isinstance(source, str):
+            with open(source, 'rb') as f:
+                data = f.read()
+        else:
+            data = source
+        try:
+            reader = SharedImageReader(data)
+        except Exception as e:
+            print(f"Could not decode image {url}: {e}")
+            return None
+        cost = len(data) + 2 * len(reader.getRGBData())  # raw pixels plus the loaded PIL image
+        with self._lock:
+            old = self._readers.pop(url, None)
+            if old is not None:
+                self._bytes -= old[2]
+            if cost <= self.max_bytes:
+                self._readers[url] = (len(data), reader, cost)
+                self._bytes += cost
+                while self._bytes > self.max_bytes:
+                    _, (_, _, evicted_cost) = self._readers.popitem(last=False)
+                    self._bytes -= evicted_cost
+        return reader
+
+    def clear(self):
+        with self._lock:
+            self._readers.clear()
+            self._bytes = 0
@@ -0,0 +1,114 @@
+import hashlib
+import os
+import pickle
+import threading
+
+_HASH_BLOCK = 1024**2
+
+
+class SheetCache:
+    """Parsed input sheets, stored as pickled DataFrames keyed by the file's content hash.
+
+       Parsing an .xlsx is the slowest step of reading an input; a file that was
+       parsed before (the same export uploaded again, or re-run from the CLI) is
+       loaded from <cache_dir>/<key>.pkl instead. Each entry is a sequence of
+       DataFrames (one per chunk), so streamed inputs are reloaded chunk by chunk
+       with the same bounded memory. Least recently used entries are removed once
+       the directory exceeds max_bytes."""
+
+    def __init__(self, cache_dir, max_bytes=2 * 1024**3):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def key(self, file_path, salt=""):
+        """Content hash of file_path; `salt` should capture how the file is read."""
+        digest = hashlib.sha256(salt.encode('utf-8'))
+        with open(file_path, 'rb') as f:
+            for block in iter(lambda: f.read(_HASH_BLOCK), b''):
+                digest.update(block)
+        return digest.hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, f"{key}.pkl")
+
+    def load(self, key):
+        """Iterator over the cached DataFrames for key, or None if not cached."""
+        path = self._path(key)
+        try:
+            f = open(path, 'rb')
+        except OSError:
+            with self._lock:
+                self.misses += 1
+            return None
+        with self._lock:
+            self.hits += 1
+        try:
+            os.utime(path)  # LRU order
+        except OSError:
+            pass
+
+        def frames():
+            with f:
+                while True:
+                    try:
+                        yield pickle.load(f)
+                    except EOFError:
+                        return
+        return frames()
+
+    def store(self, key, frames):
+        """Passes frames through, writing each one to the cache; the entry is only
+           kept if the iteration runs to the end."""
+        path = self._path(key)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        completed = False
+        try:
+            with open(tmp_path, 'wb') as f:
+                for frame in frames:
+                    pickle.dump(frame, f, protocol=pickle.HIGHEST_PROTOCOL)
+                    yield frame
+            os.replace(tmp_path, path)
+            completed = True
+        finally:
+            if not completed:
+                try:
+                    os.remove(tmp_path)
+                except OSError:
+                    pass
+        self._evict()
+
+    def _evict(self):
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            if not name.endswith('.pkl'):
+                continue
+            try:
+                st = os.stat(os.path.join(self.cache_dir, name))
+            except OSError:
+                continue
+            entries.append((st.st_mtime, st.st_size, name))
+        total = sum(size for _, size, _ in entries)
+        for _, size, name in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(os.path.join(self.cache_dir, name))
+                total -= size
+            except OSError:
+                pass
+
+    def stats(self):
+        with self._lock:
+            hits, misses = self.hits, self.misses
+        files = [name for name in os.listdir(self.cache_dir) if name.endswith('.pkl')]
+        disk_bytes = 0
+        for name in files:
+            try:
+                disk_bytes += os.path.getsize(os.path.join(self.cache_dir, name))
+            except OSError:
+                pass
+        return {'hits': hits, 'misses': misses, 'entries': len(files), 'disk_bytes': disk_bytes}
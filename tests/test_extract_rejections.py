@@ -0,0 +1,72 @@
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from automation import SHEET_CONFIG, extract_rejections  # noqa: E402
+from benchmark import legacy_extract_rejections, make_synthetic_sheet  # noqa: E402
+
+META = SHEET_CONFIG['meta_map']
+STATUS, _, _, IMAGE, REASON = SHEET_CONFIG['checks'][0]
+
+
+def messy_sheet(rows=300, seed=0):
+    """Synthetic sheet with blanks, numbers and stray spacing in every kind of column."""
+    rng = np.random.default_rng(seed)
+    df = make_synthetic_sheet(rows, partners=6, rejection_rate=0.8, seed=seed)
+    blank = rng.random(rows) < 0.2
+
+    partner = df[META['partner']].astype(object)
+    partner[rng.random(rows) < 0.05] = np.nan
+    partner[rng.random(rows) < 0.05] = 'nan'
+    partner[rng.random(rows) < 0.05] = '   '
+    partner[rng.random(rows) < 0.1] = '  Partner 1 '
+    df[META['partner']] = partner
+
+    df[META['kilnId']] = np.where(blank, np.nan, rng.integers(1, 50, rows))    # float column with NaN
+    df[META['artisan']] = rng.integers(1, 9, rows)                               # int column
+    df[META['slot']] = np.where(blank, np.nan, rng.random(rows).round(2))       # floats
+    df[META['date']] = pd.to_datetime('2024-01-01') + pd.to_timedelta(rng.integers(0, 30, rows), unit='D')
+
+    status = df[STATUS].astype(object)
+    status[rng.random(rows) < 0.1] = np.nan
+    df[STATUS] = status
+    df[IMAGE] = df[IMAGE].where(~blank, np.nan)
+    df[REASON] = pd.Series(np.where(rng.random(rows) < 0.3, 0, df[REASON]), dtype=object)
+    return df
+
+
+@pytest.mark.parametrize('seed', [0, 1, 2])
+def test_matches_the_legacy_loop(seed):
+    df = messy_sheet(seed=seed)
+    partners, stats = extract_rejections(df)
+    assert partners == legacy_extract_rejections(df)
+    assert stats['rows'] == len(df)
+
+
+def test_matches_the_legacy_loop_with_missing_and_renamed_columns():
+    df = messy_sheet(seed=3)
+    df = df.drop(columns=[SHEET_CONFIG['checks'][-1][4]])
+    df = df.rename(columns={META['kilnId']: META['kilnId'].upper().replace(' ', '_')})
+    partners, _ = extract_rejections(df, SHEET_CONFIG)
+    assert partners == legacy_extract_rejections(df)
+    assert any(batch['meta']['kilnId'] for batches in partners.values() for batch in batches)
+
+
+def test_blank_and_numeric_cells():
+    df = make_synthetic_sheet(1, partners=1, rejection_rate=0)
+    df[STATUS] = ' ' + str(SHEET_CONFIG['checks'][0][1]).upper()
+    df[META['kilnId']] = np.nan
+    df[META['artisan']] = 7
+    df[REASON] = np.nan
+    partners, stats = extract_rejections(df)
+
+    (batch,) = partners['Partner 0']
+    assert batch['meta']['kilnId'] == '' and batch['meta']['artisan'] == '7'
+    assert batch['images'][0]['reason'] == 'No Reason Provided'
+    assert stats == {'rows': 1, 'errors': 0, 'no_rejections': 0}
+    assert partners == legacy_extract_rejections(df)
@@ -0,0 +1,174 @@
+import json
+import os
+import sys
+import threading
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from image_fetcher import DownloadAttempts  # noqa: E402
+from image_health import ImageHealth  # noqa: E402
+
+HOST = 'http://img.example'
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+def make_health(**kwargs):
+    clock = FakeClock()
+    kwargs.setdefault('failure_threshold', 3)
+    kwargs.setdefault('cooldown', 60)
+    return ImageHealth(clock=clock, **kwargs), clock
+
+
+def trip(health, count=3):
+    for i in range(count):
+        health.record_host_failure(f'{HOST}/{i}.jpg')
+
+
+def test_trips_after_distinct_failing_urls():
+    health, _ = make_health()
+    trip(health, 2)
+    assert health.admit(f'{HOST}/new.jpg') == 0
+    trip(health, 3)
+    assert health.admit(f'{HOST}/new.jpg') is None
+    assert health.admit('http://other.example/a.jpg') == 0
+    assert health.stats()['open_hosts'] == ['img.example']
+
+
+def test_one_url_failing_repeatedly_does_not_trip():
+    health, _ = make_health()
+    for _ in range(10):
+        health.record_host_failure(f'{HOST}/same.jpg')
+    assert health.admit(f'{HOST}/other.jpg') == 0
+
+
+def test_any_response_resets_the_count():
+    health, _ = make_health()
+    trip(health, 2)
+    health.record_success(f'{HOST}/ok.jpg')
+    health.record_host_failure(f'{HOST}/9.jpg')
+    assert health.admit(f'{HOST}/new.jpg') == 0
+
+
+def test_one_probe_after_the_cooldown():
+    health, clock = make_health()
+    trip(health)
+    clock.now += 59
+    assert health.admit(f'{HOST}/a.jpg') is None
+    clock.now += 1
+    assert health.admit(f'{HOST}/probe.jpg') == 0
+    # Everything else keeps failing fast while the probe runs...
+    assert health.admit(f'{HOST}/b.jpg') is None
+    # ...except requests already in flight, which wait for it
+    assert health.admit(f'{HOST}/b.jpg', in_flight=True) == ImageHealth.PROBE_POLL_SECONDS
+
+    health.record_success(f'{HOST}/probe.jpg')
+    assert health.admit(f'{HOST}/b.jpg') == 0
+    assert health.stats()['open_hosts'] == []
+
+
+def test_failed_probe_reopens_for_another_cooldown():
+    health, clock = make_health()
+    trip(health)
+    clock.now += 60
+    assert health.admit(f'{HOST}/probe.jpg') == 0
+    # A late failure from before the trip doesn't count as the probe's
+    health.record_host_failure(f'{HOST}/0.jpg')
+    assert health.admit(f'{HOST}/b.jpg', in_flight=True) == ImageHealth.PROBE_POLL_SECONDS
+    health.record_host_failure(f'{HOST}/probe.jpg')
+    assert health.admit(f'{HOST}/b.jpg', in_flight=True) is None
+    clock.now += 60
+    assert health.admit(f'{HOST}/b.jpg') == 0
+
+
+def test_stuck_probe_is_replaced_after_a_cooldown():
+    health, clock = make_health()
+    trip(health)
+    clock.now += 60
+    assert health.admit(f'{HOST}/probe.jpg') == 0
+    clock.now += 61
+    assert health.admit(f'{HOST}/next.jpg') == 0
+
+
+def test_negative_cache_expires():
+    health, clock = make_health(negative_ttl=100, transient_ttl=10)
+    health.record_url_failure(f'{HOST}/gone.jpg', 'HTTP 404', permanent=True)
+    health.record_url_failure(f'{HOST}/slow.jpg', 'timed out', permanent=False)
+    assert health.check(f'{HOST}/gone.jpg') == 'known failure: HTTP 404'
+    assert health.check(f'{HOST}/slow.jpg') == 'known failure: timed out'
+    clock.now += 10
+    assert health.check(f'{HOST}/slow.jpg') is None
+    assert health.check(f'{HOST}/gone.jpg') is not None
+    clock.now += 90
+    assert health.check(f'{HOST}/gone.jpg') is None
+
+
+def test_negative_cache_is_kept_between_runs(tmp_path):
+    path = str(tmp_path / 'failures.json')
+    health, clock = make_health(path=path, negative_ttl=100)
+    health.record_url_failure(f'{HOST}/gone.jpg', 'HTTP 404', permanent=True)
+    health.save()
+
+    reloaded = ImageHealth(path=path, clock=clock)
+    assert reloaded.check(f'{HOST}/gone.jpg') == 'known failure: HTTP 404'
+    clock.now += 100
+    assert ImageHealth(path=path, clock=clock).check(f'{HOST}/gone.jpg') is None
+
+
+def test_concurrent_saves(tmp_path):
+    path = str(tmp_path / 'failures.json')
+    health, _ = make_health(path=path)
+
+    def worker(n):
+        for i in range(50):
+            health.record_url_failure(f'{HOST}/{n}-{i}.jpg', 'HTTP 404', permanent=True)
+            health.save()
+
+    threads = [threading.Thread(target=worker, args=(n,)) for n in range(4)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    with open(path, encoding='utf-8') as f:
+        assert len(json.load(f)) == 200
+    assert os.listdir(tmp_path) == ['failures.json']
+
+
+def test_attempts_give_up_on_an_open_circuit():
+    health, _ = make_health()
+    trip(health)
+    attempts = DownloadAttempts(f'{HOST}/new.jpg', retries=2, backoff=0, health=health)
+    assert attempts.host_ready() is None
+    assert attempts.reason == 'host unavailable (circuit open)'
+    # It never failed itself, so it isn't remembered as a dead link
+    assert health.check(f'{HOST}/new.jpg') is None
+
+
+def test_attempts_remember_a_timed_out_url_cut_short_by_the_circuit():
+    health, _ = make_health(failure_threshold=1)
+    attempts = DownloadAttempts(f'{HOST}/slow.jpg', retries=2, backoff=0, health=health)
+    assert attempts.host_ready() == 0
+    assert attempts.request_error(TimeoutError(), timed_out=True)  # retried...
+    attempts.next_attempt()
+    assert attempts.host_ready() is None  # ...but its failure tripped the circuit
+    assert health.check(f'{HOST}/slow.jpg') == 'known failure: timed out'
+
+
+def test_attempts_record_permanent_failures_and_5xx():
+    health, _ = make_health(failure_threshold=2)
+    gone = DownloadAttempts(f'{HOST}/gone.jpg', retries=2, backoff=0, health=health)
+    gone.responded(404)
+    assert not gone.http_error(404)
+    assert health.check(f'{HOST}/gone.jpg') == 'known failure: HTTP 404'
+
+    for name in ('a', 'b'):
+        attempts = DownloadAttempts(f'{HOST}/{name}.jpg', retries=0, backoff=0, health=health)
+        attempts.responded(503)
+        assert not attempts.http_error(503)
+    assert health.admit(f'{HOST}/c.jpg') is None
@@ -0,0 +1,67 @@
+import datetime
+import os
+import sys
+
+import pandas as pd
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import automation  # noqa: E402
+from automation import SHEET_CONFIG, extract_rejections, iter_sheet_chunks, read_sheet  # noqa: E402
+from benchmark import make_synthetic_sheet  # noqa: E402
+
+META = SHEET_CONFIG['meta_map']
+
+
+def awkward_sheet():
+    """Synthetic sheet with the cells type inference used to change."""
+    df = make_synthetic_sheet(60, partners=4, rejection_rate=0.9, seed=3)
+    rows = len(df)
+    df[META['inventoryId']] = [f"{i:03d}" for i in range(rows)]            # leading zeros
+    df[META['kilnId']] = pd.Series([None if i % 4 == 0 else 11 + i for i in range(rows)],
+                                   dtype=object)  # ints with blanks
+    df[META['artisan']] = [1.5 if i % 2 else None for i in range(rows)]
+    df[META['date']] = [datetime.datetime(2024, 1, 1 + i % 28) for i in range(rows)]
+    return df
+
+
+def streamed(file_path):
+    partners = {}
+    for chunk in iter_sheet_chunks(file_path, chunk_rows=7):
+        for name, batches in extract_rejections(chunk)[0].items():
+            partners.setdefault(name, []).extend(batches)
+    return partners
+
+
+@pytest.mark.parametrize('file_format', ['csv', 'xlsx'])
+def test_streamed_and_full_reads_give_the_same_cells(tmp_path, file_format):
+    df = awkward_sheet()
+    path = str(tmp_path / f'input.{file_format}')
+    if file_format == 'csv':
+        df.to_csv(path, index=False)
+    else:
+        df.to_excel(path, index=False)
+
+    full = extract_rejections(read_sheet(path))[0]
+    assert full == streamed(path)
+
+    metas = [batch['meta'] for batches in full.values() for batch in batches]
+    assert {meta['inventoryId'] for meta in metas} <= {f"{i:03d}" for i in range(60)}
+    assert all(meta['kilnId'] == '' or not meta['kilnId'].endswith('.0') for meta in metas)
+
+
+def test_ingest_mode_does_not_change_the_reports_input(tmp_path, monkeypatch):
+    path = str(tmp_path / 'input.csv')
+    awkward_sheet().to_csv(path, index=False)
+    monkeypatch.setattr(automation, 'SHEET_CACHE', None)
+
+    results = {}
+    for mode in ('full', 'stream'):
+        monkeypatch.setattr(automation, 'INGEST_MODE', mode)
+        partners = {}
+        for chunk_partners, _ in automation.iter_rejection_chunks(path):
+            for name, batches in chunk_partners.items():
+                partners.setdefault(name, []).extend(batches)
+        results[mode] = partners
+    assert results['full'] == results['stream']
@@ -0,0 +1,43 @@
+import os
+import sys
+import threading
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from jobs import JobScheduler  # noqa: E402
+
+
+def test_waiting_jobs_hear_about_every_dequeue():
+    updates = []
+    release = threading.Event()
+    finished = threading.Semaphore(0)
+    scheduler = JobScheduler(max_concurrent=1, on_dequeue=lambda waiting: updates.append(waiting))
+
+    def job(block):
+        if block:
+            release.wait(5)
+        finished.release()
+
+    # Queue everything before the worker starts, so the order is fixed
+    scheduler.submit('a', job, True)
+    for job_id in 'bcd':
+        scheduler.submit(job_id, job, False)
+    assert [scheduler.queue_position(job_id) for job_id in 'abcd'] == [1, 2, 3, 4]
+    scheduler.start()
+    release.set()
+    for _ in range(4):
+        assert finished.acquire(timeout=5)
+
+    assert updates == [['b', 'c', 'd'], ['c', 'd'], ['d'], []]
+
+
+def test_failing_callback_does_not_stop_the_queue():
+    done = threading.Event()
+
+    def broken(waiting):
+        raise RuntimeError("subscriber gone")
+
+    scheduler = JobScheduler(on_dequeue=broken)
+    scheduler.submit('a', done.set)
+    scheduler.start()
+    assert done.wait(5)
@@ -0,0 +1,37 @@
+import concurrent.futures
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import automation  # noqa: E402
+from automation import collect_image_urls, extract_rejections, render_reports  # noqa: E402
+from benchmark import make_synthetic_sheet  # noqa: E402
+
+
+def unavailable_images(partners):
+    # Every image failed: reports render with placeholders, no network needed
+    futures = {}
+    for batches in partners.values():
+        for url in collect_image_urls(batches):
+            futures[url] = concurrent.futures.Future()
+            futures[url].set_result(None)
+    return futures
+
+
+def test_spawned_render_pool_is_kept_between_runs(tmp_path, monkeypatch):
+    monkeypatch.setattr(automation, 'PDF_RENDER_MODE', 'process')
+    monkeypatch.setattr(automation, 'PDF_RENDER_START_METHOD', 'spawn')
+    monkeypatch.setattr(automation, 'PDF_RENDER_WORKERS', 2)
+    partners, _ = extract_rejections(make_synthetic_sheet(12, partners=3, rejection_rate=1.0, seed=1))
+    try:
+        first = render_reports(partners, unavailable_images(partners), output_dir=str(tmp_path / 'first'))
+        pool = automation.get_render_pool()
+        second = render_reports(partners, unavailable_images(partners), output_dir=str(tmp_path / 'second'))
+        assert automation.get_render_pool() is pool
+    finally:
+        automation.discard_render_pool()
+
+    assert len(first) == len(second) == len(partners)
+    assert all(os.path.getsize(path) > 0 for path in first + second)
+    assert automation._render_pool is None
@@ -0,0 +1,86 @@
+import json
+import os
+import sys
+import threading
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from report_manifest import ReportManifest  # noqa: E402
+
+
+def rendered(tmp_path, name, content):
+    path = tmp_path / name
+    path.write_bytes(content)
+    return str(path)
+
+
+def test_inputs_sharing_a_partner_name_keep_their_own_reports(tmp_path):
+    manifest = ReportManifest(str(tmp_path / 'store'))
+    manifest.record('Acme', 'north', rendered(tmp_path, 'north.pdf', b'north'))
+    manifest.record('Acme', 'south', rendered(tmp_path, 'south.pdf', b'south'))
+
+    target = str(tmp_path / 'Report_Acme.pdf')
+    assert manifest.reuse('Acme', 'north', target)
+    assert open(target, 'rb').read() == b'north'
+    assert manifest.reuse('Acme', 'south', target)
+    assert open(target, 'rb').read() == b'south'
+    assert not manifest.reuse('Acme', 'east', target)
+
+
+def test_least_recently_used_versions_are_dropped(tmp_path):
+    store = tmp_path / 'store'
+    manifest = ReportManifest(str(store), versions=2)
+    for fingerprint in ('a', 'b'):
+        manifest.record('Acme', fingerprint, rendered(tmp_path, f'{fingerprint}.pdf', fingerprint.encode()))
+    assert manifest.reuse('Acme', 'a', str(tmp_path / 'out.pdf'))
+    manifest.record('Acme', 'c', rendered(tmp_path, 'c.pdf', b'c'))
+
+    assert not manifest.reuse('Acme', 'b', str(tmp_path / 'out.pdf'))
+    assert manifest.reuse('Acme', 'a', str(tmp_path / 'out.pdf'))
+    assert len([f for f in os.listdir(store) if f.endswith('.pdf')]) == 2
+
+
+def test_vanished_store_file_is_a_miss(tmp_path):
+    store = tmp_path / 'store'
+    manifest = ReportManifest(str(store))
+    manifest.record('Acme', 'a', rendered(tmp_path, 'a.pdf', b'a'))
+    for name in os.listdir(store):
+        if name.endswith('.pdf'):
+            os.remove(store / name)
+    assert not manifest.reuse('Acme', 'a', str(tmp_path / 'out.pdf'))
+
+
+def test_concurrent_record_and_reuse(tmp_path):
+    manifest = ReportManifest(str(tmp_path / 'store'), versions=1)
+    manifest.record('Acme', 'fp0', rendered(tmp_path, 'fp0.pdf', b'0'))
+    errors = []
+
+    def recorder():
+        for i in range(1, 200):
+            manifest.record('Acme', f'fp{i}', rendered(tmp_path, f'fp{i}.pdf', b'x'))
+
+    def reuser(n):
+        try:
+            for i in range(200):
+                manifest.reuse('Acme', f'fp{i}', str(tmp_path / f'out{n}.pdf'))
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=recorder)] + [threading.Thread(target=reuser, args=(n,)) for n in range(3)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert errors == []
+
+
+def test_loads_manifest_from_before_versions(tmp_path):
+    store = tmp_path / 'store'
+    store.mkdir()
+    (store / 'abc.pdf').write_bytes(b'old')
+    (store / 'manifest.json').write_text(json.dumps(
+        {'Acme': {'fingerprint': 'abc', 'file': 'abc.pdf', 'updated_at': 1.0}}))
+
+    target = str(tmp_path / 'out.pdf')
+    assert ReportManifest(str(store)).reuse('Acme', 'abc', target)
+    assert open(target, 'rb').read() == b'old'
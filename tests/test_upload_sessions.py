@@ -0,0 +1,209 @@
+import asyncio
+import hashlib
+import io
+import os
+import struct
+import sys
+import zipfile
+import zlib
+
+import pandas as pd
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from upload_sessions import UploadError, UploadManager, sniff_header  # noqa: E402
+
+WORKBOOK = ('<workbook xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main" '
+            'xmlns:r="http://schemas.openxmlformats.org/officeDocument/2006/relationships"><sheets>{}</sheets></workbook>')
+RELS = '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">{}</Relationships>'
+SHEET = '<worksheet><sheetData><row r="1">{}</row>{}</sheetData></worksheet>'
+
+
+class _Unseekable(io.RawIOBase):
+    """Write-only stream; zipfile then writes sizes in data descriptors."""
+
+    def __init__(self):
+        self.data = bytearray()
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        self.data += b
+        return len(b)
+
+
+def make_xlsx(sheets, shared_strings=None, streamed=False, workbook_first=True,
+              compression=zipfile.ZIP_DEFLATED, rows=1):
+    """sheets: [(zip path, rows xml)] in workbook tab order."""
+    entries = []
+    tabs, rels = [], []
+    for i, (path, cells) in enumerate(sheets, 1):
+        tabs.append(f'<sheet name="Tab{i}" sheetId="{i}" r:id="rId{i}"/>')
+        rels.append(f'<Relationship Id="rId{i}" Target="{path[len("xl/"):]}" '
+                    f'Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/worksheet"/>')
+        body = ''.join(f'<row r="{r}"><c r="A{r}"><v>{r}</v></c></row>' for r in range(2, rows + 2))
+        entries.append((path, SHEET.format(cells, body)))
+    index = [('xl/workbook.xml', WORKBOOK.format(''.join(tabs))),
+             ('xl/_rels/workbook.xml.rels', RELS.format(''.join(rels)))]
+    entries = index + entries if workbook_first else entries + index
+    if shared_strings is not None:
+        items = ''.join(f'<si><t>{s}</t></si>' for s in shared_strings)
+        entries.append(('xl/sharedStrings.xml', f'<sst>{items}</sst>'))
+
+    out = _Unseekable() if streamed else io.BytesIO()
+    with zipfile.ZipFile(out, 'w', compression=compression) as zf:
+        for name, xml in entries:
+            zf.writestr(name, xml)
+    return bytes(out.data) if streamed else out.getvalue()
+
+
+def inline(ref, text):
+    return f'<c r="{ref}" t="inlineStr"><is><t>{text}</t></is></c>'
+
+
+def shared(ref, index):
+    return f'<c r="{ref}" t="s"><v>{index}</v></c>'
+
+
+def test_inline_strings():
+    data = make_xlsx([('xl/worksheets/sheet1.xml', inline('A1', 'Partner Name') + inline('C1', 'Batch &amp; Kiln'))])
+    assert sniff_header(data, 'input.xlsx') == ['Partner Name', '', 'Batch & Kiln']
+
+
+def test_shared_strings():
+    data = make_xlsx([('xl/worksheets/sheet1.xml', shared('A1', 1) + shared('B1', 0))],
+                     shared_strings=['Production Date', 'Partner Name'])
+    assert sniff_header(data, 'input.xlsx') == ['Partner Name', 'Production Date']
+
+
+def test_shared_strings_not_uploaded_yet():
+    data = make_xlsx([('xl/worksheets/sheet1.xml', shared('A1', 0))], shared_strings=['Partner Name'])
+    prefix = data[:data.index(b'xl/sharedStrings.xml') - 30]
+    assert sniff_header(prefix, 'input.xlsx') is None
+
+
+def test_data_descriptors():
+    data = make_xlsx([('xl/worksheets/sheet1.xml', shared('A1', 0) + inline('B1', 'Stage'))],
+                     shared_strings=['Partner Name'], streamed=True)
+    assert zipfile.ZipFile(io.BytesIO(data)).infolist()[0].flag_bits & 0x08
+    assert sniff_header(data, 'input.xlsx') == ['Partner Name', 'Stage']
+
+
+@pytest.mark.parametrize('streamed, compression', [(False, zipfile.ZIP_STORED), (False, zipfile.ZIP_DEFLATED),
+                                                   (True, zipfile.ZIP_DEFLATED)])
+def test_header_spanning_chunks(streamed, compression):
+    data = make_xlsx([('xl/worksheets/sheet1.xml', inline('A1', 'Partner Name') + inline('B1', 'Stage'))],
+                     streamed=streamed, compression=compression)
+    headers = [sniff_header(data[:end], 'input.xlsx') for end in range(0, len(data), 7)]
+    found = [h for h in headers if h is not None]
+    assert headers[0] is None and found
+    assert all(h == ['Partner Name', 'Stage'] for h in found)
+
+
+def test_first_tab_is_not_sheet1():
+    data = make_xlsx([('xl/worksheets/sheet2.xml', inline('A1', 'First Tab')),
+                      ('xl/worksheets/sheet1.xml', inline('A1', 'Second Tab'))])
+    assert sniff_header(data, 'input.xlsx') == ['First Tab']
+
+
+def test_workbook_index_after_sheets():
+    data = make_xlsx([('xl/worksheets/sheet1.xml', inline('A1', 'Partner Name'))], workbook_first=False)
+    assert sniff_header(data[:data.index(b'xl/workbook.xml') - 30], 'input.xlsx') is None
+    assert sniff_header(data, 'input.xlsx') == ['Partner Name']
+
+
+def test_not_a_workbook():
+    with pytest.raises(ValueError):
+        sniff_header(b'Partner Name,Stage\n', 'input.xlsx')
+
+
+def test_csv_header_spanning_chunks():
+    data = b'\xef\xbb\xbfPartner Name,"Batch, Kiln ID",Stage\r\nA,1,x\r\n'
+    assert sniff_header(data[:20], 'input.csv') is None
+    assert sniff_header(data, 'input.csv') == ['Partner Name', 'Batch, Kiln ID', 'Stage']
+    assert sniff_header(b'Partner Name,Stage', 'input.csv', complete=True) == ['Partner Name', 'Stage']
+
+
+def chunk_reader(data, chunk_size, chunks):
+    """read_range over data where only the given chunk indexes have arrived."""
+    def read_range(offset, length):
+        index = offset // chunk_size
+        if index not in chunks:
+            return None
+        while index + 1 in chunks:
+            index += 1
+        return data[offset:min(offset + length, (index + 1) * chunk_size)]
+    return read_range
+
+
+def pandas_xlsx(tmp_path, columns, rows=20000):
+    path = tmp_path / 'input.xlsx'
+    pd.DataFrame({col: [f'{col} {i}' for i in range(rows)] for col in columns}).to_excel(path, index=False)
+    return path.read_bytes()
+
+
+def test_pandas_workbook_from_first_and_last_chunk(tmp_path):
+    # openpyxl writes xl/workbook.xml after the sheet: the prefix alone never has it
+    data = pandas_xlsx(tmp_path, ['Partner Name', 'Stage'])
+    chunk_size = 64 * 1024
+    last = (len(data) - 1) // chunk_size
+    assert last > 2
+    assert sniff_header(data[:len(data) - 1000], 'input.xlsx') is None
+    read_range = chunk_reader(data, chunk_size, {0, last})
+    assert sniff_header(data[:chunk_size], 'input.xlsx', read_range=read_range, size=len(data)) == \
+        ['Partner Name', 'Stage']
+    assert sniff_header(data[:chunk_size], 'input.xlsx', read_range=chunk_reader(data, chunk_size, {0}),
+                        size=len(data)) is None
+
+
+def test_shared_strings_at_the_end(tmp_path):
+    # Excel's order: workbook index first, shared strings after the (large) sheets
+    data = make_xlsx([('xl/worksheets/sheet1.xml', shared('A1', 1) + shared('B1', 0))],
+                     shared_strings=['Stage', 'Partner Name'], compression=zipfile.ZIP_STORED, rows=20000)
+    chunk_size = 64 * 1024
+    last = (len(data) - 1) // chunk_size
+    assert data.index(b'xl/sharedStrings.xml') > chunk_size * last
+    assert sniff_header(data[:chunk_size], 'input.xlsx') is None
+    assert sniff_header(data[:chunk_size], 'input.xlsx', read_range=chunk_reader(data, chunk_size, {0, last}),
+                        size=len(data)) == ['Partner Name', 'Stage']
+
+
+def test_data_descriptor_inflation_is_bounded():
+    # A data-descriptor entry that inflates to 80 MB of zeros
+    deflater = zlib.compressobj(9, zlib.DEFLATED, -15)
+    body = b''.join(deflater.compress(bytes(1024**2)) for _ in range(80)) + deflater.flush()
+    name = b'xl/worksheets/sheet1.xml'
+    local = struct.pack('<IHHHHHIIIHH', 0x04034b50, 20, 0x08, 8, 0, 0, 0, 0, 0, len(name), 0)
+    with pytest.raises(ValueError):
+        sniff_header(local + name + body, 'input.xlsx')
+
+
+def test_manager_refuses_wrong_xlsx_after_first_and_last_chunk(tmp_path):
+    data = pandas_xlsx(tmp_path, ['Wrong', 'Columns'])
+    headers = []
+
+    def check_header(header):
+        headers.append(header)
+        return False, "unknown format"
+
+    async def upload():
+        manager = UploadManager(str(tmp_path / 'uploads'), check_header, chunk_size=64 * 1024)
+        session = manager.create('input.xlsx', len(data))
+        last = session.chunk_count - 1
+
+        async def body(index):
+            yield data[index * session.chunk_size:(index + 1) * session.chunk_size]
+
+        async def put(index):
+            chunk = data[index * session.chunk_size:(index + 1) * session.chunk_size]
+            await manager.write_chunk(session.upload_id, index, body(index), hashlib.sha256(chunk).hexdigest())
+
+        await put(0)
+        with pytest.raises(UploadError) as refused:
+            await put(last)
+        return refused.value
+
+    refused = asyncio.run(upload())
+    assert refused.status_code == 422 and headers == [['Wrong', 'Columns']]
@@ -0,0 +1,580 @@
+import asyncio
+import csv
+import hashlib
+import html
+import io
+import json
+import os
+import posixpath
+import re
+import struct
+import time
+import uuid
+import zlib
+
+import aiofiles
+
+DEFAULT_CHUNK_SIZE = 4 * 1024**2
+MAX_CHUNK_SIZE = 32 * 1024**2
+# Header sniffing only looks at this much of the start of a file; if the header
+# is not found by then it is checked once the upload is complete.
+SNIFF_MAX_BYTES = 8 * 1024**2
+# Of a sheet (or the shared strings) only this much is read to find the header row
+_PARTIAL_READ_BYTES = 1024**2
+_HASH_BLOCK = 1024**2
+
+
+class UploadError(Exception):
+    """Raised for a request the upload API must refuse; status_code is the HTTP status to return."""
+
+    def __init__(self, status_code, message):
+        super().__init__(message)
+        self.status_code = status_code
+        self.message = message
+
+
+# ==========================================
+# HEADER SNIFFING
+# ==========================================
+def _csv_header(prefix, complete):
+    if b"\x00" in prefix[:4096]:
+        raise ValueError("File does not look like a CSV (binary data)")
+    text = prefix.decode('utf-8-sig', errors='replace')
+    buffer = io.StringIO(text)
+    row = next(csv.reader(buffer), None)
+    if row is None:
+        return [] if complete else None
+    # The first row is only known to be whole once something follows it
+    if not complete and buffer.tell() >= len(text) and not text.endswith(('\n', '\r')):
+        return None
+    return row
+
+
+def _deflate_end(data, start, limit=64 * 1024**2):
+    """End offset of the deflate stream starting at data[start], or None if it runs
+       past data. Output is discarded as it is produced and bounded by limit, so a
+       crafted stream can't inflate to gigabytes."""
+    inflater = zlib.decompressobj(-15)
+    pending = data[start:]
+    produced = 0
+    while not inflater.eof:
+        out = inflater.decompress(pending, 256 * 1024)
+        produced += len(out)
+        if produced > limit:
+            raise ValueError("The .xlsx workbook is not readable (entry too large)")
+        pending = inflater.unconsumed_tail
+        if not out and not pending:
+            return None
+    return len(data) - len(inflater.unused_data)
+
+
+def _zip_entries(prefix):
+    """(name, method, data offset, data end or None) for each local file header in
+       prefix, in file order. Stops at the first entry whose data runs past the prefix."""
+    pos = 0
+    while pos + 30 <= len(prefix):
+        (signature, _, flags, method, _, _, _, compressed_size, _, name_len,
+         extra_len) = struct.unpack('<IHHHHHIIIHH', prefix[pos:pos + 30])
+        if signature != 0x04034b50:
+            return  # central directory reached
+        name = prefix[pos + 30:pos + 30 + name_len].decode('utf-8' if flags & 0x800 else 'cp437', errors='replace')
+        start = pos + 30 + name_len + extra_len
+        if start > len(prefix):
+            return
+        if not flags & 0x08 and compressed_size != 0xFFFFFFFF:
+            end = start + compressed_size
+        elif method == 8:
+            # Size is in a trailing data descriptor: find the end by inflating
+            end = _deflate_end(prefix, start)
+        else:
+            end = None
+        yield name, method, start, (end if end is not None and end <= len(prefix) else None)
+        if end is None or end > len(prefix):
+            return
+        pos = end
+        if flags & 0x08:
+            pos += 16 if prefix[pos:pos + 4] == b'PK\x07\x08' else 12
+
+
+def _read_all(read_range, offset, length):
+    data = read_range(offset, length)
+    return data if data is not None and len(data) == length else None
+
+
+def _central_directory(read_range, size):
+    """{name: (method, local header offset, compressed size)} from the zip's central
+       directory at the end of the file, or None if those bytes have not arrived."""
+    # The end record is the last 22 bytes unless the zip has a comment (up to 64 KB)
+    tail_start = max(0, size - 22)
+    tail = _read_all(read_range, tail_start, size - tail_start)
+    if tail is None:
+        return None
+    if not tail.startswith(b'PK\x05\x06'):
+        tail_start = max(0, size - 22 - 65535)
+        tail = _read_all(read_range, tail_start, size - tail_start)
+        if tail is None:
+            return None
+    pos = tail.rfind(b'PK\x05\x06')
+    if pos < 0 or pos + 22 > len(tail):
+        raise ValueError("File is not a valid .xlsx workbook")
+    _, _, _, _, count, cd_size, cd_offset, _ = struct.unpack('<IHHHHIIH', tail[pos:pos + 22])
+    if cd_offset == 0xFFFFFFFF or cd_size > SNIFF_MAX_BYTES:
+        return None  # zip64 or huge directory: leave it to the complete upload
+    if cd_offset + cd_size > tail_start + pos:
+        raise ValueError("File is not a valid .xlsx workbook")
+    directory = _read_all(read_range, cd_offset, cd_size)
+    if directory is None:
+        return None
+    entries = {}
+    pos = 0
+    for _ in range(count):
+        (signature, _, _, flags, method, _, _, _, compressed_size, _, name_len, extra_len, comment_len,
+         _, _, _, offset) = struct.unpack('<IHHHHHHIIIHHHHHII', directory[pos:pos + 46])
+        if signature != 0x02014b50:
+            raise ValueError("File is not a valid .xlsx workbook")
+        name = directory[pos + 46:pos + 46 + name_len].decode('utf-8' if flags & 0x800 else 'cp437', errors='replace')
+        entries[name] = (method, offset, compressed_size)
+        pos += 46 + name_len + extra_len + comment_len
+    return entries
+
+
+def _inflate(data, method, limit=4 * 1024**2):
+    if method == 0:
+        return data[:limit]
+    if method != 8:
+        raise ValueError("Unsupported .xlsx compression")
+    return zlib.decompressobj(-15).decompress(data, limit)
+
+
+def _prefix_reader(prefix):
+    """Member names and read_member(name, partial) for the zip entries in prefix."""
+    entries = {name: (method, start, end) for name, method, start, end in _zip_entries(prefix)}
+
+    def read_member(name, partial):
+        method, start, end = entries[name]
+        if end is None and not partial:
+            return None
+        return _inflate(prefix[start:end if end is not None else len(prefix)], method, _member_limit(name))
+    return entries, read_member
+
+
+def _directory_reader(read_range, size):
+    """Member names and read_member(name, partial) through the central directory;
+       read_member returns None while the bytes it needs have not arrived."""
+    entries = _central_directory(read_range, size)
+    if entries is None:
+        return None, None
+
+    def read_member(name, partial):
+        method, offset, compressed_size = entries[name]
+        if offset + 30 > size:
+            raise ValueError("File is not a valid .xlsx workbook")
+        local = _read_all(read_range, offset, 30)
+        if local is None:
+            return None
+        if local[:4] != b'PK\x03\x04':
+            raise ValueError("File is not a valid .xlsx workbook")
+        name_len, extra_len = struct.unpack('<HH', local[26:30])
+        start = offset + 30 + name_len + extra_len
+        length = min(compressed_size, _PARTIAL_READ_BYTES) if partial else compressed_size
+        if start + length > size:
+            raise ValueError("File is not a valid .xlsx workbook")
+        if length > SNIFF_MAX_BYTES:
+            return None
+        # A partial member only needs its start; anything that has arrived will do
+        data = read_range(start, length) if partial else _read_all(read_range, start, length)
+        return _inflate(data, method, _member_limit(name)) if data else None
+    return entries, read_member
+
+
+def _member_limit(name):
+    return 16 * 1024**2 if name == 'xl/sharedStrings.xml' else 4 * 1024**2
+
+
+def _column_index(ref):
+    letters = re.match(r'[A-Z]+', ref or '')
+    if not letters:
+        return None
+    index = 0
+    for ch in letters.group(0):
+        index = index * 26 + ord(ch) - 64
+    return index - 1
+
+
+def _xml_text(fragment):
+    return html.unescape("".join(re.findall(r'<t(?:\s[^>]*)?>(.*?)</t>', fragment, re.S)))
+
+
+def _member_text(read_member, name, partial=False):
+    data = read_member(name, partial)
+    return data.decode('utf-8', errors='replace') if data is not None else None
+
+
+def _first_sheet(entries, read_member):
+    """Zip path of the workbook's first sheet (the one pandas reads), resolved through
+       xl/workbook.xml and its relationships, or None if those are not here yet."""
+    index = ('xl/workbook.xml', 'xl/_rels/workbook.xml.rels')
+    if any(name not in entries for name in index):
+        return None
+    workbook, rels = (_member_text(read_member, name) for name in index)
+    if workbook is None or rels is None:
+        return None
+    first = re.search(r'<(?:\w+:)?sheet\b[^>]*?\br:id="([^"]+)"', workbook)
+    if not first:
+        raise ValueError("The .xlsx workbook has no sheets")
+    for attrs in re.findall(r'<(?:\w+:)?Relationship\b([^>]*)>', rels):
+        rel_id = re.search(r'\bId="([^"]+)"', attrs)
+        target = re.search(r'\bTarget="([^"]+)"', attrs)
+        if rel_id and target and rel_id.group(1) == first.group(1):
+            target = html.unescape(target.group(1))
+            return target.lstrip('/') if target.startswith('/') else posixpath.normpath(f"xl/{target}")
+    raise ValueError("The .xlsx workbook's first sheet is missing")
+
+
+def _workbook_header(entries, read_member):
+    sheet = _first_sheet(entries, read_member)
+    if sheet is None or sheet not in entries:
+        return None
+    xml = _member_text(read_member, sheet, partial=True)
+    if xml is None:
+        return None
+    if re.search(r'<sheetData\s*/>', xml):
+        return []
+    match = re.search(r'<row\b[^>]*>(.*?)</row>', xml, re.S)
+    if not match:
+        return None
+
+    cells = {}
+    shared = {}
+    for attrs, body in re.findall(r'<c\b([^>]*?)(?:/>|>(.*?)</c>)', match.group(1), re.S):
+        ref = re.search(r'\br="([A-Z]+)\d*"', attrs)
+        kind = re.search(r'\bt="(\w+)"', attrs)
+        index = _column_index(ref.group(1)) if ref else len(cells)
+        kind = kind.group(1) if kind else None
+        value = re.search(r'<v>(.*?)</v>', body or '', re.S)
+        if kind == 'inlineStr':
+            cells[index] = _xml_text(body or '')
+        elif kind == 's' and value:
+            shared[index] = int(value.group(1))
+        else:
+            cells[index] = html.unescape(value.group(1)) if value else ''
+
+    if shared:
+        if 'xl/sharedStrings.xml' not in entries:
+            return None
+        # The header's strings are usually the first ones: the start of the table is enough
+        strings_xml = _member_text(read_member, 'xl/sharedStrings.xml', partial=True)
+        if strings_xml is None:
+            return None
+        strings = [_xml_text(item) for item in re.findall(r'<si>(.*?)</si>', strings_xml, re.S)]
+        if max(shared.values()) >= len(strings):
+            return None
+        for index, string_index in shared.items():
+            cells[index] = strings[string_index]
+
+    width = max(cells) + 1 if cells else 0
+    return [cells.get(i, '') for i in range(width)]
+
+
+def _xlsx_header(prefix, complete, read_range=None, size=None):
+    if not prefix.startswith(b'PK\x03\x04') and (len(prefix) >= 4 or complete):
+        raise ValueError("File is not a valid .xlsx workbook")
+    if read_range is not None:
+        # The central directory (end of the file) says where everything is, so the
+        # header is found even if the workbook index or shared strings come last
+        entries, read_member = _directory_reader(read_range, size)
+        header = _workbook_header(entries, read_member) if entries is not None else None
+        if header is not None:
+            return header
+    if len(prefix) < 4:
+        return None
+    return _workbook_header(*_prefix_reader(prefix))
+
+
+def sniff_header(prefix, filename, complete=False, read_range=None, size=None):
+    """Header row from the first bytes of an uploaded .csv/.xlsx, or None if more data is
+       needed. Raises ValueError if the bytes cannot be that kind of file.
+       For an .xlsx, read_range(offset, length) -> the bytes from offset that have
+       arrived (up to length; None if none have) and the file size let it be read
+       through its central directory as well."""
+    if filename.lower().endswith('.csv'):
+        return _csv_header(prefix, complete)
+    try:
+        return _xlsx_header(prefix, complete, read_range, size)
+    except (zlib.error, struct.error) as e:
+        raise ValueError(f"File is not a valid .xlsx workbook ({e})")
+
+
+# ==========================================
+# UPLOAD SESSIONS
+# ==========================================
+class UploadSession:
+    def __init__(self, upload_id, filename, size, chunk_size, sha256=None, received=(), sheet_format=None,
+                 created_at=None, status="open", message=""):
+        self.upload_id = upload_id
+        self.filename = filename
+        self.size = size
+        self.chunk_size = chunk_size
+        self.sha256 = sha256
+        self.received = set(received)
+        self.sheet_format = sheet_format
+        self.created_at = created_at or time.time()
+        self.status = status
+        self.message = message
+        self.lock = asyncio.Lock()
+        self.sniffed_bytes = 0
+
+    @property
+    def chunk_count(self):
+        return -(-self.size // self.chunk_size)
+
+    def chunk_length(self, index):
+        return min(self.chunk_size, self.size - index * self.chunk_size)
+
+    def contiguous_bytes(self):
+        chunks = 0
+        while chunks in self.received:
+            chunks += 1
+        return min(chunks * self.chunk_size, self.size)
+
+    def to_dict(self):
+        return {
+            "upload_id": self.upload_id,
+            "filename": self.filename,
+            "size": self.size,
+            "chunk_size": self.chunk_size,
+            "chunk_count": self.chunk_count,
+            "received": sorted(self.received),
+            "missing": self.chunk_count - len(self.received),
+            "sheet_format": self.sheet_format,
+            "status": self.status,
+            "message": self.message,
+        }
+
+    def _state(self):
+        return {
+            "upload_id": self.upload_id, "filename": self.filename, "size": self.size,
+            "chunk_size": self.chunk_size, "sha256": self.sha256, "received": sorted(self.received),
+            "sheet_format": self.sheet_format, "created_at": self.created_at, "status": self.status,
+            "message": self.message,
+        }
+
+
+class UploadManager:
+    """Chunked, resumable uploads.
+
+       A client creates a session (filename, size, optional whole-file sha256), PUTs
+       chunks in any order, each with its sha256, and completes the session. Chunks
+       are streamed to their offset in a preallocated file, and the session state is
+       kept next to it as JSON, so an interrupted upload (or server restart) resumes
+       by sending only the missing chunks.
+
+       check_header(header) -> (ok, sheet format name or error message) is called as
+       soon as the chunks holding the header row are here, so a file with the wrong
+       columns is refused early instead of after the whole upload: a .csv needs its
+       first chunk, an .xlsx its first and last chunks (the last one holds the zip's
+       central directory; clients send it second), plus the chunk with the shared
+       strings if the header uses them. Headers that can't be sniffed are read with
+       read_header(path) once the upload is complete."""
+
+    def __init__(self, upload_dir, check_header, read_header=None, chunk_size=DEFAULT_CHUNK_SIZE, max_bytes=None,
+                 allowed_extensions=('csv', 'xlsx')):
+        self.upload_dir = upload_dir
+        self.check_header = check_header
+        self.read_header = read_header
+        self.chunk_size = chunk_size
+        self.max_bytes = max_bytes
+        self.allowed_extensions = set(allowed_extensions)
+        self._sessions = {}
+        os.makedirs(upload_dir, exist_ok=True)
+
+    # --- Paths & persistence ---
+    def _data_path(self, upload_id):
+        return os.path.join(self.upload_dir, f"{upload_id}.part")
+
+    def _state_path(self, upload_id):
+        return os.path.join(self.upload_dir, f"{upload_id}.json")
+
+    def _save(self, session):
+        path = self._state_path(session.upload_id)
+        with open(f"{path}.tmp", 'w', encoding='utf-8') as f:
+            json.dump(session._state(), f)
+        os.replace(f"{path}.tmp", path)
+
+    def get(self, upload_id):
+        session = self._sessions.get(upload_id)
+        if session is None and re.fullmatch(r'[0-9a-f]{32}', upload_id or ''):
+            try:
+                with open(self._state_path(upload_id), 'r', encoding='utf-8') as f:
+                    session = UploadSession(**json.load(f))
+            except (OSError, ValueError, TypeError):
+                return None
+            self._sessions[upload_id] = session
+        return session
+
+    def _require(self, upload_id):
+        session = self.get(upload_id)
+        if session is None:
+            raise UploadError(404, "Upload not found")
+        if session.status == "rejected":
+            raise UploadError(422, session.message)
+        if session.status != "open":
+            raise UploadError(409, "Upload is already complete")
+        return session
+
+    # --- API ---
+    def create(self, filename, size, chunk_size=None, sha256=None):
+        filename = os.path.basename(str(filename or '')).strip()
+        if not filename or '.' not in filename or filename.rsplit('.', 1)[1].lower() not in self.allowed_extensions:
+            raise UploadError(400, "Invalid file type")
+        if not isinstance(size, int) or size <= 0:
+            raise UploadError(400, "File is empty")
+        if self.max_bytes and size > self.max_bytes:
+            raise UploadError(413, f"File is larger than {self.max_bytes // 1024**2} MB")
+        chunk_size = chunk_size or self.chunk_size
+        if not isinstance(chunk_size, int) or not 0 < chunk_size <= MAX_CHUNK_SIZE:
+            raise UploadError(400, f"chunk_size must be between 1 and {MAX_CHUNK_SIZE} bytes")
+
+        session = UploadSession(uuid.uuid4().hex, filename, size, chunk_size, sha256=(sha256 or None))
+        with open(self._data_path(session.upload_id), 'wb') as f:
+            f.truncate(size)
+        self._save(session)
+        self._sessions[session.upload_id] = session
+        return session
+
+    async def write_chunk(self, upload_id, index, stream, checksum):
+        """Streams one chunk (an async iterator of bytes) to its place in the file.
+           The chunk only counts as received if its length and sha256 match."""
+        session = self._require(upload_id)
+        if not 0 <= index < session.chunk_count:
+            raise UploadError(400, f"Chunk index must be between 0 and {session.chunk_count - 1}")
+        if not checksum:
+            raise UploadError(400, "Missing chunk checksum (X-Chunk-Sha256)")
+        expected = session.chunk_length(index)
+
+        digest = hashlib.sha256()
+        written = 0
+        async with aiofiles.open(self._data_path(upload_id), 'r+b') as f:
+            await f.seek(index * session.chunk_size)
+            async for data in stream:
+                if written + len(data) > expected:
+                    raise UploadError(400, f"Chunk {index} is longer than {expected} bytes")
+                digest.update(data)
+                await f.write(data)
+                written += len(data)
+        if written != expected:
+            raise UploadError(400, f"Chunk {index} has {written} bytes, expected {expected}")
+        if digest.hexdigest() != checksum.lower():
+            raise UploadError(400, f"Checksum mismatch for chunk {index}")
+
+        async with session.lock:
+            session.received.add(index)
+            await self._sniff(session)
+            await asyncio.to_thread(self._save, session)
+        if session.status == "rejected":
+            raise UploadError(422, session.message)
+        return session
+
+    async def _sniff(self, session, complete=False):
+        """Checks the header row once the parts of the file that hold it are here: the
+           start of the file, and for an .xlsx its end (the zip's central directory)."""
+        if session.sheet_format is not None or session.status != "open":
+            return
+        available = session.size if complete else session.contiguous_bytes()
+        prefix_grew = available > session.sniffed_bytes and session.sniffed_bytes < SNIFF_MAX_BYTES
+        directory = session.filename.lower().endswith('.xlsx') and session.chunk_count - 1 in session.received
+        if not (complete or prefix_grew or directory):
+            return
+        session.sniffed_bytes = max(session.sniffed_bytes, available)
+        try:
+            header = await asyncio.to_thread(self._sniff_file, session, available, directory or complete)
+        except ValueError as e:
+            self._reject(session, str(e))
+            return
+        if header is None and complete and self.read_header is not None:
+            try:
+                header = await asyncio.to_thread(self.read_header, self._data_path(session.upload_id), session.filename)
+            except Exception as e:
+                self._reject(session, f"Could not read the file: {e}")
+                return
+        if header is None:
+            return
+        ok, result = self.check_header(header)
+        if ok:
+            session.sheet_format = result
+        else:
+            self._reject(session, result)
+
+    def _sniff_file(self, session, available, random_access):
+        received = frozenset(session.received)
+        with open(self._data_path(session.upload_id), 'rb') as f:
+            def read_range(offset, length):
+                index = offset // session.chunk_size
+                if index not in received:
+                    return None
+                while index + 1 in received and (index + 1) * session.chunk_size < offset + length:
+                    index += 1
+                f.seek(offset)
+                return f.read(min(length, (index + 1) * session.chunk_size - offset))
+
+            prefix = f.read(min(available, SNIFF_MAX_BYTES))
+            return sniff_header(prefix, session.filename, complete=available >= session.size,
+                                read_range=read_range if random_access else None, size=session.size)
+
+    def _reject(self, session, message):
+        session.status = "rejected"
+        session.message = message
+        try:
+            os.remove(self._data_path(session.upload_id))
+        except OSError:
+            pass
+
+    async def complete(self, upload_id, target_path):
+        """Verifies the finished upload and moves it to target_path."""
+        session = self._require(upload_id)
+        async with session.lock:
+            missing = session.chunk_count - len(session.received)
+            if missing:
+                raise UploadError(409, f"{missing} chunk(s) still missing")
+            if session.sha256:
+                actual = await asyncio.to_thread(self._file_sha256, self._data_path(upload_id))
+                if actual != session.sha256.lower():
+                    raise UploadError(400, "File checksum mismatch, please upload again")
+            await self._sniff(session, complete=True)
+            if session.status == "rejected":
+                await asyncio.to_thread(self._save, session)
+                raise UploadError(422, session.message)
+            os.replace(self._data_path(upload_id), target_path)
+            session.status = "complete"
+            self.discard(upload_id)
+        return session
+
+    def discard(self, upload_id):
+        self._sessions.pop(upload_id, None)
+        for path in (self._data_path(upload_id), self._state_path(upload_id)):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def expire(self, ttl_seconds):
+        """Discards sessions (finished or not) created more than ttl_seconds ago. Returns their ids."""
+        cutoff = time.time() - ttl_seconds
+        expired = []
+        for name in os.listdir(self.upload_dir):
+            if not name.endswith('.json'):
+                continue
+            upload_id = name[:-5]
+            session = self.get(upload_id)
+            if session is None or session.created_at < cutoff:
+                self.discard(upload_id)
+                expired.append(upload_id)
+        return expired
+
+    @staticmethod
+    def _file_sha256(path):
+        digest = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(_HASH_BLOCK), b''):
+                digest.update(block)
+        return digest.hexdigest()
@@ -0,0 +1,68 @@
+import os
+import zipfile
+import zlib
+
+READ_CHUNK = 1024 * 1024
+SAMPLE_BYTES = 64 * 1024
+# Deflate only when a sample compresses to less than this fraction of its size.
+# PDFs that are mostly JPEG data barely shrink, so they are STORED instead.
+DEFLATE_MAX_RATIO = 0.9
+
+
+def choose_compress_type(path):
+    """ZIP_DEFLATED if a sample of the file compresses well, otherwise ZIP_STORED."""
+    try:
+        with open(path, 'rb') as f:
+            sample = f.read(SAMPLE_BYTES)
+    except OSError:
+        return zipfile.ZIP_DEFLATED
+    if not sample:
+        return zipfile.ZIP_STORED
+    ratio = len(zlib.compress(sample, 6)) / len(sample)
+    return zipfile.ZIP_DEFLATED if ratio < DEFLATE_MAX_RATIO else zipfile.ZIP_STORED
+
+
+class _StreamBuffer:
+    """Write-only sink for ZipFile. It has no tell()/seek(), so zipfile writes in
+       streaming mode (data descriptors after each entry) and we drain what it wrote."""
+
+    def __init__(self):
+        self._chunks = []
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        chunks, self._chunks = self._chunks, []
+        return chunks
+
+
+def stream_zip(paths):
+    """Generator of ZIP archive bytes for the files yielded by `paths`.
+
+       `paths` may be a lazy iterator that blocks until the next file exists, so the
+       archive can be sent while later files are still being produced. Each entry is
+       STORED or DEFLATED depending on how compressible it is."""
+    buffer = _StreamBuffer()
+    seen = set()
+    with zipfile.ZipFile(buffer, 'w') as zipf:
+        for path in paths:
+            arcname = os.path.basename(path)
+            if arcname in seen or not os.path.exists(path):
+                continue
+            seen.add(arcname)
+            zinfo = zipfile.ZipInfo.from_file(path, arcname)
+            zinfo.compress_type = choose_compress_type(path)
+            with open(path, 'rb') as src, zipf.open(zinfo, 'w') as dest:
+                while True:
+                    chunk = src.read(READ_CHUNK)
+                    if not chunk:
+                        break
+                    dest.write(chunk)
+                    yield from buffer.drain()
+            yield from buffer.drain()
+    yield from buffer.drain()